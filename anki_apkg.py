@@ -0,0 +1,906 @@
+#!/usr/bin/env python3
+"""
+Outils communs pour lire et reecrire les fichiers .apkg
+Utilise par anki_deck_cleaner.py et anki_image_cropper.py
+"""
+
+import hashlib
+import html
+import json
+import os
+import re
+import shutil
+import sqlite3
+import struct
+import tempfile
+import time
+import urllib.parse
+import zipfile
+import zlib
+from pathlib import Path
+
+
+# Taille de l'en-tete local d'une entree ZIP (avant nom et champ extra)
+LOCAL_HEADER_SIZE = 30
+
+# Bit "data descriptor" : CRC et tailles ecrits apres les donnees
+FLAG_DATA_DESCRIPTOR = 0x08
+
+# Taille des blocs copies d'une archive a l'autre
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# Limite des tailles et positions d'une entree copiee sans decompression :
+# au-dela, il faudrait des en-tetes ZIP64, l'entree est recompressee
+RAW_COPY_LIMIT = zipfile.ZIP64_LIMIT
+
+# Attributs internes de ZipFile utilises par la copie sans decompression
+ZIPFILE_INTERNALS = ('_lock', '_writecheck', 'start_dir', 'fp', 'filelist', 'NameToInfo')
+
+# Niveau de compression deflate par defaut (0-9, comme zlib)
+DEFAULT_COMPRESS_LEVEL = 6
+
+# Entrees toujours compressees (base SQLite et index des medias)
+COMPRESSIBLE_NAMES = ('collection.anki2', 'collection.anki21', 'media', 'meta')
+
+# Bases de donnees possibles, de la plus recente a la plus ancienne
+# (collection.anki21b : SQLite compresse en zstd, exports Anki >= 2.1.50)
+DB_NAMES = ('collection.anki21b', 'collection.anki21', 'collection.anki2')
+ZSTD_DB_NAMES = ('collection.anki21b',)
+
+# Signature d'une trame zstd
+ZSTD_MAGIC = b'(\xb5/\xfd'
+
+# Signatures de formats deja compresses (images, zstd, audio/video...)
+INCOMPRESSIBLE_MAGICS = (
+    b'\x89PNG\r\n\x1a\n',   # PNG
+    b'\xff\xd8\xff',          # JPEG
+    b'(\xb5/\xfd',             # zstd
+    b'GIF8',                  # GIF
+    b'RIFF',                  # WebP, WAV (rare, compresse mal quand meme)
+    b'OggS',                  # Ogg
+    b'ID3',                   # MP3
+    b'PK\x03\x04',            # ZIP
+    b'\x1f\x8b',              # gzip
+)
+
+# Balise <img> d'un champ de note (groupe 1 : nom du fichier media)
+IMG_SRC_RE = re.compile(r'<img[^>]+src=["\']?([^"\'>]+)["\']?[^>]*>', re.IGNORECASE)
+
+# Reference a un son d'un champ de note (groupe 1 : nom du fichier media)
+SOUND_RE = re.compile(r'\[sound:([^\]]+)\]')
+
+# Balises HTML (retirees pour les colonnes sfld/csum et l'analyse des tags)
+HTML_TAG_RE = re.compile(r'<[^>]+>')
+
+# Separateurs des champs d'une note, et des niveaux d'un nom de paquet
+# dans la table decks du format anki21b
+FIELD_SEPARATOR = '\x1f'
+
+# Taille de l'echantillon utilise pour tester la compression d'une entree
+SAMPLE_SIZE = 64 * 1024
+
+# Ratio (compresse / original) au-dela duquel on stocke sans compresser
+MIN_GAIN_RATIO = 0.9
+
+
+def copy_entry_raw(source, info, zout, name=None):
+    """
+    Copie une entree d'une archive ZIP dans une autre sans la decompresser
+
+    Les donnees compressees sont recopiees telles quelles, avec le meme
+    CRC et la meme methode de compression. Les entrees qui demanderaient
+    des en-tetes ZIP64 (taille ou position au-dela de RAW_COPY_LIMIT), ou
+    une version de zipfile sans les attributs internes utilises, passent
+    par copy_entry_recompressed.
+
+    Args:
+        source: Fichier de l'archive source, ouvert en binaire
+        info: ZipInfo de l'entree dans l'archive source
+        zout: ZipFile de sortie, ouvert en ecriture
+        name: Nom de l'entree dans la sortie (None = meme nom)
+    """
+    if (max(info.file_size, info.compress_size, info.header_offset) >= RAW_COPY_LIMIT
+            or not all(hasattr(zout, attr) for attr in ZIPFILE_INTERNALS)
+            or not getattr(zout, '_seekable', True)
+            or zout.start_dir >= RAW_COPY_LIMIT):
+        copy_entry_recompressed(source, info, zout, name)
+        return
+
+    # Trouver le debut des donnees (apres l'en-tete local de l'entree)
+    source.seek(info.header_offset)
+    header = source.read(LOCAL_HEADER_SIZE)
+    name_length, extra_length = struct.unpack('<HH', header[26:30])
+    source.seek(info.header_offset + LOCAL_HEADER_SIZE + name_length + extra_length)
+
+    zinfo = zipfile.ZipInfo(name or info.filename, info.date_time)
+    zinfo.compress_type = info.compress_type
+    zinfo.comment = info.comment
+    zinfo.create_system = info.create_system
+    zinfo.external_attr = info.external_attr
+    zinfo.flag_bits = info.flag_bits & ~FLAG_DATA_DESCRIPTOR
+    zinfo.CRC = info.CRC
+    zinfo.compress_size = info.compress_size
+    zinfo.file_size = info.file_size
+
+    # zipfile n'a pas d'API publique pour ecrire des donnees deja compressees :
+    # on ecrit l'en-tete et les donnees nous-memes, comme ZipFile.write()
+    with zout._lock:
+        zout._writecheck(zinfo)
+        zout._didModify = True
+        zout.fp.seek(zout.start_dir)
+        zinfo.header_offset = zout.fp.tell()
+        zout.fp.write(zinfo.FileHeader())
+
+        remaining = info.compress_size
+        while remaining > 0:
+            chunk = source.read(min(COPY_CHUNK_SIZE, remaining))
+            if not chunk:
+                raise zipfile.BadZipFile(f"Entree tronquee : {info.filename}")
+            zout.fp.write(chunk)
+            remaining -= len(chunk)
+
+        zout.filelist.append(zinfo)
+        zout.NameToInfo[zinfo.filename] = zinfo
+        zout.start_dir = zout.fp.tell()
+
+
+def copy_entry_recompressed(source, info, zout, name=None):
+    """
+    Copie une entree d'une archive ZIP dans une autre en la decompressant
+
+    Passe par l'API publique de zipfile (ZIP64 compris), par blocs : plus
+    lent que copy_entry_raw, mais valable pour toutes les entrees.
+
+    Args:
+        source: Fichier de l'archive source, ouvert en binaire
+        info: ZipInfo de l'entree dans l'archive source
+        zout: ZipFile de sortie, ouvert en ecriture
+        name: Nom de l'entree dans la sortie (None = meme nom)
+    """
+    zinfo = zipfile.ZipInfo(name or info.filename, info.date_time)
+    zinfo.compress_type = info.compress_type
+    zinfo.comment = info.comment
+    zinfo.create_system = info.create_system
+    zinfo.external_attr = info.external_attr
+    # Taille attendue : zipfile en deduit s'il faut des en-tetes ZIP64
+    zinfo.file_size = info.file_size
+
+    with zipfile.ZipFile(source) as zin, zin.open(info) as src, zout.open(zinfo, 'w') as dst:
+        shutil.copyfileobj(src, dst, COPY_CHUNK_SIZE)
+
+
+def load_zstd():
+    """
+    Importe zstandard a la demande (necessaire seulement pour les nouveaux formats)
+
+    Returns:
+        Le module zstandard
+    """
+    try:
+        import zstandard
+    except ImportError:
+        raise RuntimeError("Ce deck utilise la compression zstd : installez le module "
+                           "zstandard (pip install zstandard)") from None
+    return zstandard
+
+
+def extract_entry(input_file, name, target, decompress=False):
+    """
+    Extrait une seule entree d'un .apkg
+
+    Args:
+        input_file: Chemin du .apkg
+        name: Nom de l'entree dans l'archive
+        target: Chemin du fichier a creer
+        decompress: True pour decompresser l'entree (zstd) a la volee
+    """
+    with zipfile.ZipFile(input_file, 'r') as zin:
+        with zin.open(name) as src, open(target, 'wb') as dst:
+            if decompress:
+                load_zstd().ZstdDecompressor().copy_stream(src, dst, read_size=COPY_CHUNK_SIZE)
+            else:
+                shutil.copyfileobj(src, dst, COPY_CHUNK_SIZE)
+
+
+def compress_file(source, target):
+    """
+    Compresse un fichier en zstd, par blocs
+
+    Args:
+        source: Chemin du fichier a compresser
+        target: Chemin du fichier compresse a creer
+    """
+    with open(source, 'rb') as src, open(target, 'wb') as dst:
+        load_zstd().ZstdCompressor().copy_stream(src, dst, read_size=COPY_CHUNK_SIZE)
+
+
+def find_database(names):
+    """
+    Trouve la base de donnees a utiliser parmi les entrees d'un .apkg
+
+    Args:
+        names: Noms des entrees de l'archive
+
+    Returns:
+        Nom de l'entree (la plus recente disponible), ou None
+    """
+    for db_name in DB_NAMES:
+        if db_name in names:
+            return db_name
+    return None
+
+
+def read_varint(data, pos):
+    """
+    Lit un entier varint (protobuf)
+
+    Returns:
+        Tuple (valeur, position suivante)
+    """
+    result = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def write_varint(value):
+    """Encode un entier en varint (protobuf)"""
+    data = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            data.append(byte | 0x80)
+        else:
+            data.append(byte)
+            return bytes(data)
+
+
+def iter_protobuf_fields(data):
+    """
+    Parcourt les champs d'un message protobuf (sans schema)
+
+    Yields:
+        Tuples (numero du champ, valeur) : entier pour les varints,
+        bytes pour les champs de longueur variable
+    """
+    pos = 0
+    while pos < len(data):
+        key, pos = read_varint(data, pos)
+        field, wire_type = key >> 3, key & 0x07
+        if wire_type == 0:
+            value, pos = read_varint(data, pos)
+        elif wire_type == 2:
+            length, pos = read_varint(data, pos)
+            value = data[pos:pos + length]
+            pos += length
+        elif wire_type == 1:
+            value = data[pos:pos + 8]
+            pos += 8
+        elif wire_type == 5:
+            value = data[pos:pos + 4]
+            pos += 4
+        else:
+            raise ValueError(f"Type protobuf non supporte : {wire_type}")
+        yield field, value
+
+
+def read_media_map(zin):
+    """
+    Lit l'index des medias d'un .apkg
+
+    Ancien format : JSON {"0": "image.png", ...}
+    Nouveau format : message protobuf MediaEntries compresse en zstd, ou
+    l'entree N de la liste correspond au fichier "N" de l'archive.
+
+    Args:
+        zin: ZipFile du .apkg, ouvert en lecture
+
+    Returns:
+        Dictionnaire {nom de l'entree dans l'archive: nom du fichier media}
+    """
+    try:
+        data = zin.read('media')
+    except KeyError:
+        return {}
+
+    if data.startswith(ZSTD_MAGIC):
+        data = load_zstd().ZstdDecompressor().stream_reader(data).read()
+        entries = [value for field, value in iter_protobuf_fields(data) if field == 1]
+        media = {}
+        for index, entry in enumerate(entries):
+            # MediaEntry : name = 1, size = 2, sha1 = 3, legacy_zip_filename = 255
+            name = None
+            zip_name = str(index)
+            for entry_field, value in iter_protobuf_fields(entry):
+                if entry_field == 1:
+                    name = value.decode('utf-8')
+                elif entry_field == 255:
+                    zip_name = str(value)
+            media[zip_name] = name
+        return media
+
+    return json.loads(data.decode('utf-8')) if data.strip() else {}
+
+
+def read_database(zin, db_name, temp_base=None):
+    """
+    Ouvre en memoire une copie de la base de donnees d'un .apkg
+
+    La base est decompressee si besoin (anki21b) et chargee dans une
+    connexion :memory: : rien n'est modifie ni laisse sur le disque.
+
+    Args:
+        zin: ZipFile du .apkg, ouvert en lecture
+        db_name: Nom de l'entree de la base (cf. find_database)
+        temp_base: Dossier du fichier temporaire, si sqlite3 ne sait pas
+                   charger une base depuis des octets (Python < 3.11)
+
+    Returns:
+        Connexion sqlite3 (a fermer par l'appelant)
+    """
+    data = zin.read(db_name)
+    if db_name in ZSTD_DB_NAMES:
+        data = load_zstd().ZstdDecompressor().stream_reader(data).read()
+
+    conn = sqlite3.connect(':memory:')
+    if hasattr(conn, 'deserialize'):
+        conn.deserialize(data)
+        return conn
+
+    fd, path = tempfile.mkstemp(suffix='.sqlite', dir=temp_base)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        source = sqlite3.connect(path)
+        try:
+            source.backup(conn)
+        finally:
+            source.close()
+    finally:
+        os.remove(path)
+    return conn
+
+
+def database_bytes(conn, db_name, temp_base=None):
+    """
+    Contenu d'une base ouverte par read_database, pret a remplacer l'original
+
+    Args:
+        conn: Connexion a la base (en memoire)
+        db_name: Nom de l'entree de la base (recompressee en zstd pour anki21b)
+        temp_base: Dossier du fichier temporaire, si sqlite3 ne sait pas
+                   exporter une base en octets (Python < 3.11)
+
+    Returns:
+        bytes (cf. rewrite_apkg)
+    """
+    if hasattr(conn, 'serialize'):
+        data = conn.serialize()
+    else:
+        fd, path = tempfile.mkstemp(suffix='.sqlite', dir=temp_base)
+        os.close(fd)
+        try:
+            target = sqlite3.connect(path)
+            try:
+                conn.backup(target)
+            finally:
+                target.close()
+            data = Path(path).read_bytes()
+        finally:
+            os.remove(path)
+
+    if db_name in ZSTD_DB_NAMES:
+        data = load_zstd().ZstdCompressor().compress(data)
+    return data
+
+
+def load_deck_names(conn):
+    """
+    Lit le nom de chaque paquet
+
+    Returns:
+        Dictionnaire {id du paquet: nom complet, niveaux separes par "::"}
+    """
+    # Ancien format : paquets en JSON dans col.decks
+    try:
+        row = conn.execute("SELECT decks FROM col").fetchone()
+        decks = json.loads(row[0]) if row and row[0] else {}
+    except (sqlite3.Error, ValueError):
+        decks = {}
+    if decks:
+        return {int(did): deck.get('name', '') for did, deck in decks.items()}
+
+    # Format anki21b : table decks
+    try:
+        return {did: name.replace(FIELD_SEPARATOR, '::')
+                for did, name in conn.execute("SELECT id, name FROM decks")}
+    except sqlite3.Error:
+        return {}
+
+
+def load_field_names(conn):
+    """
+    Lit le nom des champs de chaque type de note
+
+    Returns:
+        Dictionnaire {id du type de note: liste des noms, dans l'ordre des champs}
+    """
+    # Ancien format : types de note en JSON dans col.models
+    try:
+        row = conn.execute("SELECT models FROM col").fetchone()
+        models = json.loads(row[0]) if row and row[0] else {}
+    except (sqlite3.Error, ValueError):
+        models = {}
+    if models:
+        return {int(mid): [field['name'] for field in sorted(model.get('flds', []),
+                                                             key=lambda field: field.get('ord', 0))]
+                for mid, model in models.items()}
+
+    # Format anki21b : table fields
+    field_names = {}
+    try:
+        for mid, name in conn.execute("SELECT ntid, name FROM fields ORDER BY ntid, ord"):
+            field_names.setdefault(mid, []).append(name)
+    except sqlite3.Error:
+        pass
+    return field_names
+
+
+def in_hierarchy(name, wanted):
+    """
+    Verifie si un tag ou un paquet fait partie d'une selection
+
+    "geo" selectionne "geo" et ses enfants ("geo::europe"), sans tenir
+    compte de la casse (comme Anki).
+
+    Args:
+        name: Nom du tag ou du paquet
+        wanted: Noms selectionnes, en minuscules
+    """
+    name = name.lower()
+    return any(name == item or name.startswith(item + '::') for item in wanted)
+
+
+def referenced_media(conn, tags=None, decks=None, fields=None):
+    """
+    Fichiers media affiches par des balises <img> dans les notes
+
+    Args:
+        conn: Connexion a la base de donnees (cf. read_database)
+        tags: Garder seulement les notes qui ont l'un de ces tags (ou un
+              sous-tag), None = toutes les notes
+        decks: Garder seulement les notes dont une carte est dans l'un de
+               ces paquets (ou un sous-paquet), None = tous les paquets
+        fields: Chercher seulement dans les champs de ces noms,
+                None = tous les champs
+
+    Returns:
+        Ensemble des noms de fichiers media references
+    """
+    note_ids = None
+    if decks:
+        wanted = [deck.lower() for deck in decks]
+        deck_ids = [did for did, name in load_deck_names(conn).items() if in_hierarchy(name, wanted)]
+        placeholders = ','.join('?' * len(deck_ids))
+        # odid : paquet d'origine des cartes deplacees dans un paquet filtre
+        note_ids = {nid for (nid,) in conn.execute(
+            f"SELECT DISTINCT nid FROM cards WHERE did IN ({placeholders}) "
+            f"OR odid IN ({placeholders})", deck_ids + deck_ids)}
+
+    wanted_tags = [tag.lower() for tag in tags] if tags else None
+    field_names = load_field_names(conn) if fields else None
+    wanted_fields = {field.lower() for field in fields} if fields else None
+
+    filenames = set()
+    for nid, mid, flds, note_tags in conn.execute("SELECT id, mid, flds, tags FROM notes"):
+        if note_ids is not None and nid not in note_ids:
+            continue
+        if wanted_tags and not any(in_hierarchy(tag, wanted_tags) for tag in note_tags.split()):
+            continue
+
+        values = flds.split(FIELD_SEPARATOR)
+        if field_names is not None:
+            names = field_names.get(mid, [])
+            values = [value for name, value in zip(names, values) if name.lower() in wanted_fields]
+
+        for value in values:
+            for src in IMG_SRC_RE.findall(value):
+                # Les noms sont stockes echappes en HTML, parfois encodes en URL
+                name = html.unescape(src)
+                filenames.add(name)
+                filenames.add(urllib.parse.unquote(name))
+    return filenames
+
+
+def strip_html_tags(text):
+    """
+    Retire les balises HTML d'un texte (comme HTML_TAG_RE.sub('', text))
+
+    Un '<' sans '>' apres lui n'ouvre pas de balise : la fin du texte apres le
+    dernier '>' est gardee telle quelle, sans y chercher de balise. Sinon chaque
+    '<' de cette fin serait parcouru jusqu'au bout du texte (temps quadratique).
+
+    Args:
+        text: Texte a nettoyer
+
+    Returns:
+        Texte sans balises
+    """
+    end = text.rfind('>') + 1
+    return HTML_TAG_RE.sub('', text[:end]) + text[end:]
+
+
+def strip_html_media(text):
+    """
+    Retire le HTML d'un champ en gardant les noms des images (comme Anki)
+
+    Args:
+        text: Contenu du champ
+
+    Returns:
+        Texte brut, utilise pour les colonnes sfld et csum des notes
+    """
+    text = IMG_SRC_RE.sub(r' \1 ', text)
+    return html.unescape(strip_html_tags(text)).strip()
+
+
+def field_checksum(text):
+    """
+    Calcule la somme de controle du premier champ (colonne csum des notes)
+
+    Args:
+        text: Contenu du premier champ
+
+    Returns:
+        Entier forme des 8 premiers chiffres hexadecimaux du SHA-1
+    """
+    return int(hashlib.sha1(strip_html_media(text).encode('utf-8')).hexdigest()[:8], 16)
+
+
+def load_sort_fields(conn):
+    """
+    Lit l'index du champ de tri de chaque type de note
+
+    Returns:
+        Dictionnaire {id du type de note: index du champ de tri}
+    """
+    # Ancien format : types de note en JSON dans col.models
+    try:
+        row = conn.execute("SELECT models FROM col").fetchone()
+        models = json.loads(row[0]) if row and row[0] else {}
+    except (sqlite3.Error, ValueError):
+        models = {}
+    if models:
+        return {int(mid): model.get('sortf', 0) for mid, model in models.items()}
+
+    # Format anki21b : table notetypes, config en protobuf (sort_field_idx = 2)
+    sort_fields = {}
+    try:
+        for mid, config in conn.execute("SELECT id, config FROM notetypes"):
+            sort_fields[mid] = next(
+                (value for field, value in iter_protobuf_fields(config) if field == 2), 0)
+    except (sqlite3.Error, ValueError, IndexError):
+        pass
+    return sort_fields
+
+
+def find_duplicate_media(zin, media_map):
+    """
+    Trouve les medias de meme contenu
+
+    Les candidats (meme taille et meme CRC, lus dans l'index de l'archive,
+    sans rien decompresser) sont confirmes par une empreinte BLAKE2b de
+    leur contenu.
+
+    Args:
+        zin: ZipFile du .apkg, ouvert en lecture
+        media_map: Index des medias (cf. read_media_map)
+
+    Returns:
+        Dictionnaire {entree en double: entree gardee, la premiere de l'index}
+    """
+    candidates = {}
+    for entry in media_map:
+        try:
+            info = zin.getinfo(entry)
+        except KeyError:
+            continue
+        candidates.setdefault((info.file_size, info.CRC), []).append(entry)
+
+    duplicates = {}
+    for entries in candidates.values():
+        if len(entries) < 2:
+            continue
+        first_by_digest = {}
+        for entry in entries:
+            digest = hashlib.blake2b(digest_size=20)
+            with zin.open(entry) as f:
+                for chunk in iter(lambda: f.read(COPY_CHUNK_SIZE), b''):
+                    digest.update(chunk)
+            kept = first_by_digest.setdefault(digest.digest(), entry)
+            if kept != entry:
+                duplicates[entry] = kept
+    return duplicates
+
+
+def template_texts(conn):
+    """
+    Textes des modeles de cartes (recto, verso, CSS), qui peuvent citer des medias
+
+    Returns:
+        Liste de textes (JSON ou protobuf decode au mieux, selon le format)
+    """
+    texts = []
+    # Ancien format : types de note en JSON dans col.models
+    try:
+        row = conn.execute("SELECT models FROM col").fetchone()
+        if row and row[0]:
+            texts.append(row[0])
+    except sqlite3.Error:
+        pass
+
+    # Format anki21b : configuration des modeles et des types de note en protobuf
+    for query in ("SELECT config FROM templates", "SELECT config FROM notetypes"):
+        try:
+            texts.extend(bytes(config).decode('utf-8', 'replace') for (config,) in conn.execute(query))
+        except sqlite3.Error:
+            pass
+    return texts
+
+
+def find_mentions(texts, names):
+    """
+    Cherche des noms de fichiers dans des textes
+
+    Une alternative de milliers de noms serait essayee nom par nom a chaque
+    position : seules les extensions (peu nombreuses) sont cherchees, puis
+    le texte qui les precede est compare aux noms de meme longueur.
+
+    Args:
+        texts: Textes ou chercher
+        names: Ensemble des noms de fichiers
+
+    Returns:
+        Ensemble des noms trouves
+    """
+    lengths = {}
+    plain_names = []
+    for name in names:
+        dot = name.rfind('.')
+        if dot > 0:
+            lengths.setdefault(name[dot:], set()).add(len(name))
+        else:
+            plain_names.append(name)
+    suffix_re = re.compile('|'.join(re.escape(suffix) for suffix in lengths)) if lengths else None
+
+    found = set()
+    for text in texts:
+        if suffix_re is not None:
+            for match in suffix_re.finditer(text):
+                end = match.end()
+                for length in lengths[match.group()]:
+                    if text[end - length:end] in names:
+                        found.add(text[end - length:end])
+        found.update(name for name in plain_names if name in text)
+    return found
+
+
+def rename_media_references(text, filenames):
+    """
+    Redirige les references d'un champ (<img src>, [sound:]) vers d'autres medias
+
+    Args:
+        text: Contenu des champs de la note
+        filenames: Dictionnaire {ancien nom de fichier: nouveau nom}
+
+    Returns:
+        Texte modifie
+    """
+    def rename(match):
+        src = match.group(1)
+        # Les noms sont stockes echappes en HTML, parfois encodes en URL
+        name = html.unescape(src)
+        if name in filenames:
+            new_src = html.escape(filenames[name], quote=False)
+        elif urllib.parse.unquote(name) in filenames:
+            new_src = urllib.parse.quote(filenames[urllib.parse.unquote(name)])
+        else:
+            return match.group(0)
+        start = match.start(1) - match.start(0)
+        return match.group(0)[:start] + new_src + match.group(0)[start + len(src):]
+
+    if '<' in text:
+        text = IMG_SRC_RE.sub(rename, text)
+    if '[sound:' in text:
+        text = SOUND_RE.sub(rename, text)
+    return text
+
+
+def dedup_media(zin, conn):
+    """
+    Retire les medias en double d'un .apkg (meme contenu sous plusieurs noms)
+
+    Une copie est gardee par contenu, et les references des notes aux
+    autres copies sont redirigees vers elle, directement dans conn
+    (colonnes flds, sfld et csum). Un doublon est garde si son nom
+    commence par '_' (media des modeles de cartes) ou apparait ailleurs
+    que dans une reference (texte d'une note, modele de carte).
+
+    Args:
+        zin: ZipFile du .apkg source, ouvert en lecture
+        conn: Connexion a la base du deck, modifiee sur place (a enregistrer
+              par l'appelant, cf. database_bytes)
+
+    Returns:
+        None sans doublon, sinon dictionnaire :
+        - 'replacements' : {'media': nouvel index des medias} (cf. rewrite_apkg)
+        - 'renames' : {entree: nouveau nom, ou None si supprimee} (cf. rewrite_apkg)
+        - 'duplicates' : nombre de medias retires
+        - 'bytes_saved' : octets gagnes dans l'archive
+    """
+    media_map = read_media_map(zin)
+    duplicates = {entry: kept for entry, kept in find_duplicate_media(zin, media_map).items()
+                  if media_map[entry] and media_map[kept] and not media_map[entry].startswith('_')}
+    if not duplicates:
+        return None
+
+    # Noms cites ailleurs que dans une reference : ces doublons sont gardes
+    names = {media_map[entry] for entry in duplicates}
+    notes_text = (SOUND_RE.sub('', IMG_SRC_RE.sub('', flds))
+                  for (flds,) in conn.execute("SELECT flds FROM notes"))
+    mentioned = find_mentions(template_texts(conn), names) | find_mentions(notes_text, names)
+    duplicates = {entry: kept for entry, kept in duplicates.items()
+                  if media_map[entry] not in mentioned}
+    if not duplicates:
+        return None
+    filenames = {media_map[entry]: media_map[kept] for entry, kept in duplicates.items()}
+
+    # Redirection des references des notes (mod/usn a jour pour l'import dans Anki)
+    sort_fields = load_sort_fields(conn)
+    mod = int(time.time())
+    updates = []
+    for nid, mid, flds in conn.execute("SELECT id, mid, flds FROM notes"):
+        new_flds = rename_media_references(flds, filenames)
+        if new_flds != flds:
+            values = new_flds.split(FIELD_SEPARATOR)
+            sort_index = sort_fields.get(mid, 0)
+            sort_field = values[sort_index] if sort_index < len(values) else ''
+            updates.append((new_flds, mod, strip_html_media(sort_field),
+                            field_checksum(values[0]), nid))
+    conn.executemany("UPDATE notes SET flds = ?, mod = ?, usn = -1, sfld = ?, csum = ? "
+                     "WHERE id = ?", updates)
+    conn.commit()
+
+    # Nouvel index des medias. Format protobuf : l'entree N de la liste est le
+    # fichier "N" de l'archive, les entrees suivant un doublon sont renumerotees
+    data = zin.read('media')
+    renames = {}
+    if data.startswith(ZSTD_MAGIC):
+        data = load_zstd().ZstdDecompressor().stream_reader(data).read()
+        entries = [value for field, value in iter_protobuf_fields(data) if field == 1]
+        manifest = bytearray()
+        index = 0
+        for old_index, entry in enumerate(entries):
+            legacy = next((value for field, value in iter_protobuf_fields(entry) if field == 255), None)
+            zip_name = str(legacy if legacy is not None else old_index)
+            if zip_name in duplicates:
+                renames[zip_name] = None
+                continue
+            if legacy is None and index != old_index:
+                renames[zip_name] = str(index)
+            manifest += b'\x0a' + write_varint(len(entry)) + entry
+            index += 1
+        manifest = load_zstd().ZstdCompressor().compress(bytes(manifest))
+    else:
+        manifest = json.dumps({entry: name for entry, name in media_map.items()
+                               if entry not in duplicates}).encode('utf-8')
+        renames = dict.fromkeys(duplicates)
+
+    return {
+        'replacements': {'media': manifest},
+        'renames': renames,
+        'duplicates': len(duplicates),
+        'bytes_saved': sum(zin.getinfo(entry).compress_size for entry in duplicates),
+    }
+
+
+def is_compressible(name, sample):
+    """
+    Decide si une entree vaut la peine d'etre compressee
+
+    Args:
+        name: Nom de l'entree dans l'archive
+        sample: Premiers octets de l'entree (jusqu'a SAMPLE_SIZE)
+
+    Returns:
+        True pour ZIP_DEFLATED, False pour ZIP_STORED
+    """
+    if name in COMPRESSIBLE_NAMES:
+        return True
+    if sample.startswith(INCOMPRESSIBLE_MAGICS) or b'ftyp' in sample[4:12]:
+        # ftyp : AVIF, HEIF, MP4
+        return False
+    if not sample:
+        return False
+    # Format inconnu : essai rapide sur un echantillon
+    return len(zlib.compress(sample, 1)) < len(sample) * MIN_GAIN_RATIO
+
+
+def write_entry(zout, name, content, compresslevel=DEFAULT_COMPRESS_LEVEL):
+    """
+    Ecrit une entree dans l'archive de sortie
+
+    Les formats deja compresses (images, zstd...) sont stockes tels quels :
+    deflate ne les reduirait pas et couterait du temps.
+
+    Args:
+        zout: ZipFile de sortie, ouvert en ecriture
+        name: Nom de l'entree
+        content: Chemin du fichier a ajouter, ou bytes
+        compresslevel: Niveau de compression deflate (0-9)
+    """
+    if isinstance(content, bytes):
+        sample = content[:SAMPLE_SIZE]
+    else:
+        with open(content, 'rb') as f:
+            sample = f.read(SAMPLE_SIZE)
+
+    if is_compressible(name, sample):
+        compress_type = zipfile.ZIP_DEFLATED
+    else:
+        compress_type = zipfile.ZIP_STORED
+
+    if isinstance(content, bytes):
+        zout.writestr(name, content, compress_type=compress_type, compresslevel=compresslevel)
+    else:
+        zout.write(content, name, compress_type=compress_type, compresslevel=compresslevel)
+
+
+def rewrite_apkg(input_file, output_file, replacements,
+                 compresslevel=DEFAULT_COMPRESS_LEVEL, renames=None):
+    """
+    Cree un .apkg a partir d'un autre en remplacant certaines entrees
+
+    Les entrees non remplacees sont copiees sans decompression ni
+    recompression : seul le contenu modifie est recompresse.
+
+    Args:
+        input_file: Chemin du .apkg source
+        output_file: Chemin du .apkg a creer
+        replacements: Dictionnaire {nom d'entree: chemin du nouveau fichier ou bytes}
+                      (les noms absents de la source sont ajoutes a la fin)
+        compresslevel: Niveau de compression deflate des entrees remplacees (0-9)
+        renames: Dictionnaire {nom d'entree de la source: nouveau nom, ou None
+                 pour ne pas la recopier} (cf. dedup_media) ; les cles de
+                 replacements restent les noms de la source
+
+    Returns:
+        Chemin du fichier cree
+    """
+    output_path = Path(output_file)
+    renames = renames or {}
+
+    with zipfile.ZipFile(input_file, 'r') as zin, \
+            open(input_file, 'rb') as source, \
+            zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED) as zout:
+        for info in zin.infolist():
+            name = renames.get(info.filename, info.filename)
+            if name is None:
+                continue
+            if info.filename in replacements:
+                write_entry(zout, name, replacements[info.filename], compresslevel)
+            else:
+                copy_entry_raw(source, info, zout, name)
+
+        source_names = set(zin.namelist())
+        for name, replacement in replacements.items():
+            if name not in source_names:
+                write_entry(zout, name, replacement, compresslevel)
+
+    return output_path
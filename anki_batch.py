@@ -0,0 +1,467 @@
+#!/usr/bin/env python3
+"""
+Anki Batch
+Nettoie et/ou crop plusieurs decks Anki (.apkg) sans aucune question,
+en parallele : pour les traitements automatiques (ex: tache de nuit)
+
+Utilisation :
+    python anki_batch.py clean decks/ autre_deck.apkg --jobs 4
+    python anki_batch.py crop "decks/*.apkg" --mode mask --direction bottom_right
+    python anki_batch.py run decks/ --jobs 4 --quiet --report rapport.json
+
+Depuis Python :
+    from anki_batch import clean_deck, process_decks
+    result = clean_deck("mon_deck.apkg")
+    if result.ok:
+        print(result.output_file, result.stats['counters'])
+"""
+
+import argparse
+import contextlib
+import glob
+import io
+import json
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+from anki_apkg import DEFAULT_COMPRESS_LEVEL, rewrite_apkg
+from anki_deck_cleaner import DEFAULT_IN_MEMORY_MAX_MB, AnkiDeckCleaner
+from anki_image_cropper import (DEFAULT_CACHE_DIR, DEFAULT_CACHE_SIZE_MB, AnkiImageCropper,
+                                ImageCache, add_crop_arguments, crop_options_from_args)
+from anki_stats import ProcessStats
+
+
+# Suffixe des fichiers crees par chaque commande (<nom><suffixe>.apkg)
+OUTPUT_SUFFIXES = {
+    'clean': '_cleaned',
+    'crop': '_cropped',
+    'run': '_cleaned_cropped',
+}
+
+# Codes de sortie de la ligne de commande
+EXIT_OK = 0
+EXIT_FAILURES = 1
+EXIT_NO_DECK = 2
+
+
+class DeckResult:
+    """Resultat du traitement d'un deck"""
+
+    def __init__(self, action, input_file, output_file=None, error=None, stats=None, seconds=0.0):
+        """
+        Args:
+            action: 'clean', 'crop' ou 'run'
+            input_file: Chemin du deck traite
+            output_file: Chemin du fichier cree (None en cas d'erreur, ou si
+                         le cropper n'a trouve aucune image)
+            error: Message d'erreur (None si succes)
+            stats: Statistiques (cf. ProcessStats.to_dict) ; pour 'run',
+                   dictionnaire {'clean': ..., 'crop': ...}
+            seconds: Duree du traitement
+        """
+        self.action = action
+        self.input_file = Path(input_file)
+        self.output_file = Path(output_file) if output_file else None
+        self.error = error
+        self.stats = stats
+        self.seconds = seconds
+
+    @property
+    def ok(self):
+        """True si le deck a ete traite sans erreur"""
+        return self.error is None
+
+    def to_dict(self):
+        """Resultat serialisable en JSON"""
+        return {
+            'action': self.action,
+            'input_file': str(self.input_file),
+            'output_file': str(self.output_file) if self.output_file else None,
+            'ok': self.ok,
+            'error': self.error,
+            'seconds': round(self.seconds, 3),
+            'stats': self.stats,
+        }
+
+    def __repr__(self):
+        status = 'ok' if self.ok else f'error={self.error!r}'
+        return f"DeckResult({self.action}, {self.input_file.name}, {status})"
+
+
+def default_output(input_file, action, output_dir=None):
+    """
+    Chemin de sortie par defaut : <nom><suffixe>.apkg a cote du deck (ou dans output_dir)
+    """
+    input_file = Path(input_file)
+    directory = Path(output_dir) if output_dir else input_file.parent
+    return directory / (input_file.stem + OUTPUT_SUFFIXES[action] + '.apkg')
+
+
+def _run(action, input_file, func):
+    """
+    Execute un traitement et le convertit en DeckResult (les erreurs sont capturees)
+
+    Args:
+        func: Fonction sans argument renvoyant (fichier cree, statistiques)
+    """
+    start = time.perf_counter()
+    try:
+        output_file, stats = func()
+        return DeckResult(action, input_file, output_file, stats=stats,
+                          seconds=time.perf_counter() - start)
+    except Exception as e:
+        return DeckResult(action, input_file, error=f"{type(e).__name__}: {e}",
+                          seconds=time.perf_counter() - start)
+
+
+def _make_cleaner(input_file, cache=None, **options):
+    """Cree le cleaner d'un deck, avec son cache de notes (cf. clean_deck)"""
+    cleaner = AnkiDeckCleaner(input_file, **options)
+    if cache:
+        cleaner.cache_file = cleaner.default_cache_path() if cache is True else cache
+    return cleaner
+
+
+def _clean(input_file, output_file, cache=None, **options):
+    """Nettoie un deck, renvoie (fichier cree, statistiques)"""
+    cleaner = _make_cleaner(input_file, cache, **options)
+    output_path = cleaner.process(output_file)
+    return output_path, cleaner.stats.to_dict()
+
+
+def _crop(input_file, output_file, **options):
+    """Crop un deck, renvoie (fichier cree, statistiques)"""
+    cropper = AnkiImageCropper(input_file, **options)
+    output_path = cropper.process(output_file)
+    return output_path, cropper.stats.to_dict()
+
+
+def clean_deck(input_file, output_file=None, cache=None, **options):
+    """
+    Nettoie et tague un deck (cf. AnkiDeckCleaner)
+
+    Args:
+        input_file: Chemin du .apkg
+        output_file: Fichier de sortie (defaut: <nom>_cleaned.apkg a cote du deck)
+        cache: True pour le cache de notes par defaut (a cote du deck),
+               ou chemin du fichier de cache (None = pas de cache)
+        **options: Parametres de AnkiDeckCleaner (workers, compress_level...)
+
+    Returns:
+        DeckResult
+    """
+    output_file = output_file or default_output(input_file, 'clean')
+    return _run('clean', input_file, lambda: _clean(input_file, output_file, cache, **options))
+
+
+def crop_deck(input_file, output_file=None, **options):
+    """
+    Crop ou masque les images d'un deck (cf. AnkiImageCropper)
+
+    Args:
+        input_file: Chemin du .apkg
+        output_file: Fichier de sortie (defaut: <nom>_cropped.apkg a cote du deck)
+        **options: Parametres de AnkiImageCropper (mode, direction, workers,
+                   image_cache...)
+
+    Returns:
+        DeckResult (output_file vaut None si aucune image n'a ete traitee)
+    """
+    output_file = output_file or default_output(input_file, 'crop')
+    return _run('crop', input_file, lambda: _crop(input_file, output_file, **options))
+
+
+def run_pipeline(cleaner, cropper, output_file):
+    """
+    Nettoie les notes et traite les images d'un meme deck en une seule passe
+
+    L'archive source est lue une fois et le fichier de sortie ecrit une
+    fois, avec la base nettoyee et les images modifiees. Sans workers, le
+    nettoyage et le traitement des images tournent en meme temps (deux
+    threads : Pillow libere le GIL pendant le decodage et l'encodage) ;
+    avec des workers, les deux etapes se suivent, chacune utilisant deja
+    plusieurs processus.
+
+    Args:
+        cleaner: AnkiDeckCleaner du deck
+        cropper: AnkiImageCropper du meme deck
+        output_file: Fichier de sortie
+
+    Returns:
+        Tuple (chemin du fichier cree, ProcessStats du pipeline)
+    """
+    if Path(cleaner.input_file).resolve() != Path(cropper.input_file).resolve():
+        raise ValueError("Le cleaner et le cropper doivent traiter le meme deck")
+
+    stats = ProcessStats()
+    output_path = Path(output_file)
+    try:
+        with stats.timer('extract'):
+            cleaner.extract_apkg()
+            cropper.extract_apkg()
+
+        with stats.timer('transform'):
+            if cleaner.workers == 1 and cropper.workers == 1:
+                # Pas de fork depuis un processus a plusieurs threads : seulement sans workers
+                with ThreadPoolExecutor(max_workers=2) as executor:
+                    cleaning = executor.submit(cleaner.clean_cards)
+                    cropping = executor.submit(cropper.process_all_images)
+                    cleaning.result()
+                    cropping.result()
+            else:
+                cleaner.clean_cards()
+                cropper.process_all_images()
+
+        # La base est celle du cleaner : c'est elle qui suit les medias dedoublonnes
+        if cleaner.dedup_media or cropper.dedup_media:
+            with stats.timer('dedup_media'):
+                cleaner.deduplicate_media()
+
+        with stats.timer('repack'):
+            replacements = cleaner.database_replacement()
+            media, renames = cleaner.media_replacements()
+            replacements.update(media)
+            replacements.update(cropper.image_replacements())
+            rewrite_apkg(cleaner.input_file, output_path, replacements,
+                         compresslevel=cleaner.compress_level, renames=renames)
+        print(f"Fichier cree: {output_path.absolute()}")
+        return output_path, stats
+    finally:
+        with stats.timer('cleanup'):
+            cleaner.cleanup()
+            cropper.cleanup()
+
+
+def run_deck(input_file, output_file=None, cache=None, clean_options=None, crop_options=None):
+    """
+    Nettoie un deck et crop ses images en une seule passe (cf. run_pipeline)
+
+    Args:
+        input_file: Chemin du .apkg
+        output_file: Fichier de sortie (defaut: <nom>_cleaned_cropped.apkg a cote du deck)
+        cache: Cache de notes du nettoyage (cf. clean_deck)
+        clean_options: Parametres de AnkiDeckCleaner
+        crop_options: Parametres de AnkiImageCropper
+
+    Returns:
+        DeckResult, avec les statistiques {'clean', 'crop', 'pipeline'}
+    """
+    output_file = output_file or default_output(input_file, 'run')
+
+    def process():
+        cleaner = _make_cleaner(input_file, cache, **(clean_options or {}))
+        cropper = AnkiImageCropper(input_file, **(crop_options or {}))
+        output_path, stats = run_pipeline(cleaner, cropper, output_file)
+        return output_path, {'clean': cleaner.stats.to_dict(), 'crop': cropper.stats.to_dict(),
+                             'pipeline': stats.to_dict()}
+
+    return _run('run', input_file, process)
+
+
+# Fonction de traitement de chaque commande
+ACTIONS = {
+    'clean': clean_deck,
+    'crop': crop_deck,
+    'run': run_deck,
+}
+
+
+def _process_deck(action, input_file, output_file, options, verbose):
+    """Traite un deck (dans ce processus ou un worker), messages masques sauf si verbose"""
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    with output:
+        return ACTIONS[action](input_file, output_file, **options)
+
+
+def find_decks(inputs, skip_suffixes=tuple(OUTPUT_SUFFIXES.values())):
+    """
+    Liste les decks a traiter
+
+    Args:
+        inputs: Fichiers .apkg, dossiers (tous les .apkg du dossier) ou motifs
+                glob (ex: 'decks/*.apkg', 'decks/**/*.apkg')
+        skip_suffixes: Dans les dossiers et les motifs, ignorer les fichiers
+                       deja produits par ce script (<nom>_cleaned.apkg...)
+
+    Returns:
+        Liste de chemins, sans doublons, dans l'ordre des arguments
+    """
+    decks = []
+    for item in inputs:
+        path = Path(item)
+        if path.is_dir():
+            decks.extend(deck for deck in sorted(path.glob('*.apkg'))
+                         if not deck.stem.endswith(skip_suffixes))
+        elif glob.has_magic(item):
+            decks.extend(Path(match) for match in sorted(glob.glob(item, recursive=True))
+                         if not Path(match).stem.endswith(skip_suffixes))
+        else:
+            # Fichier (meme absent : l'erreur apparaitra dans son resultat)
+            decks.append(path)
+    return list(dict.fromkeys(decks))
+
+
+def process_decks(action, input_files, jobs=1, output_dir=None, verbose=False,
+                  on_result=None, **options):
+    """
+    Traite plusieurs decks, jusqu'a jobs decks en parallele
+
+    L'erreur d'un deck n'arrete pas les autres : elle est dans son resultat.
+
+    Args:
+        action: 'clean', 'crop' ou 'run'
+        input_files: Chemins des decks
+        jobs: Nombre de decks traites en meme temps (processus)
+        output_dir: Dossier des fichiers crees (defaut: a cote de chaque deck)
+        verbose: True pour afficher les messages de chaque traitement
+        on_result: Fonction appelee avec chaque DeckResult des qu'il est pret
+        **options: Parametres de clean_deck, crop_deck ou run_deck
+
+    Returns:
+        Liste de DeckResult, dans l'ordre de input_files
+    """
+    tasks = [(action, deck, default_output(deck, action, output_dir), options, verbose)
+             for deck in input_files]
+    results = [None] * len(tasks)
+
+    if jobs <= 1 or len(tasks) <= 1:
+        for index, task in enumerate(tasks):
+            results[index] = _process_deck(*task)
+            if on_result:
+                on_result(results[index])
+        return results
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(_process_deck, *task): index
+                   for index, task in enumerate(tasks)}
+        for future in as_completed(futures):
+            index = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                # Worker mort (memoire, signal...) : seul ce deck est en echec
+                result = DeckResult(action, tasks[index][1], error=f"{type(e).__name__}: {e}")
+            results[index] = result
+            if on_result:
+                on_result(result)
+    return results
+
+
+def build_parser():
+    """Parser de la ligne de commande (commandes clean, crop et run)"""
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('inputs', nargs='+', metavar='DECK',
+                        help="Fichiers .apkg, dossiers ou motifs (ex: 'decks/*.apkg')")
+    common.add_argument('-j', '--jobs', type=int, default=1,
+                        help="Nombre de decks traites en parallele (defaut: 1)")
+    common.add_argument('--workers', type=int, default=1,
+                        help="Processus par deck pour les notes/images (defaut: 1)")
+    common.add_argument('--compress-level', type=int, default=DEFAULT_COMPRESS_LEVEL,
+                        choices=range(10), metavar='0-9',
+                        help=f"Niveau de compression des fichiers crees (defaut: {DEFAULT_COMPRESS_LEVEL})")
+    common.add_argument('-o', '--output-dir', metavar='DOSSIER',
+                        help="Dossier des fichiers crees (defaut: a cote de chaque deck)")
+    common.add_argument('--temp-dir', metavar='DOSSIER',
+                        help="Dossier des fichiers temporaires (defaut: celui du systeme, "
+                             "ex: /dev/shm pour travailler en RAM)")
+    common.add_argument('--dedup-media', action='store_true',
+                        help="Ne garde qu'une copie des medias en double dans les fichiers crees")
+    common.add_argument('--report', metavar='FICHIER',
+                        help="Ecrit le resultat de chaque deck (et ses statistiques) en JSON")
+    verbosity = common.add_mutually_exclusive_group()
+    verbosity.add_argument('-q', '--quiet', action='store_true',
+                           help="N'affiche que les erreurs")
+    verbosity.add_argument('-v', '--verbose', action='store_true',
+                           help="Affiche les messages detailles de chaque traitement")
+
+    clean_options = argparse.ArgumentParser(add_help=False)
+    clean_options.add_argument('--cache', action='store_true',
+                               help="Cache des notes deja nettoyees, a cote de chaque deck")
+    clean_options.add_argument('--in-memory-max', type=int, default=DEFAULT_IN_MEMORY_MAX_MB, metavar='MO',
+                               help="Nettoie en memoire les bases jusqu'a cette taille "
+                                    f"(defaut: {DEFAULT_IN_MEMORY_MAX_MB}, 0 = jamais)")
+
+    crop_options = argparse.ArgumentParser(add_help=False)
+    add_crop_arguments(crop_options)
+    crop_options.add_argument('--image-cache', nargs='?', const=str(DEFAULT_CACHE_DIR), metavar='DOSSIER',
+                              help=f"Reutilise les images deja traitees (defaut: {DEFAULT_CACHE_DIR})")
+    crop_options.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_SIZE_MB, metavar='MO',
+                              help=f"Taille maximale du cache d'images en Mo (defaut: {DEFAULT_CACHE_SIZE_MB})")
+
+    parser = argparse.ArgumentParser(
+        description="Nettoie et/ou crop plusieurs decks Anki (.apkg), sans question",
+        epilog="Codes de sortie : 0 = tous les decks traites, 1 = au moins un echec, "
+               "2 = aucun deck trouve")
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('clean', parents=[common, clean_options],
+                        help="Nettoie et tague les cartes")
+    commands.add_parser('crop', parents=[common, crop_options],
+                        help="Crop ou masque les images")
+    commands.add_parser('run', parents=[common, clean_options, crop_options],
+                        help="Nettoie puis crop (un seul fichier en sortie)")
+    return parser
+
+
+def options_from_args(args, parser):
+    """Parametres de clean_deck, crop_deck ou run_deck selon la commande"""
+    shared = {'workers': args.workers, 'compress_level': args.compress_level,
+              'temp_base': args.temp_dir, 'dedup_media': args.dedup_media}
+
+    crop = None
+    if args.command in ('crop', 'run'):
+        crop = dict(shared, **crop_options_from_args(args, parser))
+        if args.image_cache:
+            crop['image_cache'] = ImageCache(args.image_cache, args.cache_size)
+
+    if args.command == 'crop':
+        return crop
+    clean = dict(shared, in_memory_max_mb=args.in_memory_max)
+    if args.command == 'clean':
+        return dict(clean, cache=args.cache)
+    return {'cache': args.cache, 'clean_options': clean, 'crop_options': crop}
+
+
+def main():
+    """
+    Fonction principale
+
+    Returns:
+        Code de sortie (EXIT_OK, EXIT_FAILURES ou EXIT_NO_DECK)
+    """
+    parser = build_parser()
+    args = parser.parse_args()
+    options = options_from_args(args, parser)
+
+    decks = find_decks(args.inputs)
+    if not decks:
+        print("Aucun deck .apkg trouve", file=sys.stderr)
+        return EXIT_NO_DECK
+    if args.output_dir:
+        Path(args.output_dir).mkdir(parents=True, exist_ok=True)
+
+    def report(result):
+        if not result.ok:
+            print(f"ECHEC {result.input_file} : {result.error}", file=sys.stderr)
+        elif not args.quiet:
+            output = result.output_file or "aucune image, pas de fichier"
+            print(f"OK    {result.input_file} -> {output} ({result.seconds:.1f} s)")
+
+    start = time.perf_counter()
+    results = process_decks(args.command, decks, jobs=args.jobs, output_dir=args.output_dir,
+                            verbose=args.verbose, on_result=report, **options)
+    failures = sum(1 for result in results if not result.ok)
+
+    if args.report:
+        Path(args.report).write_text(
+            json.dumps([result.to_dict() for result in results], indent=2, ensure_ascii=False) + '\n',
+            encoding='utf-8')
+    if not args.quiet:
+        print(f"{len(results)} deck(s) en {time.perf_counter() - start:.1f} s, {failures} echec(s)")
+
+    return EXIT_FAILURES if failures else EXIT_OK
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,894 @@
+#!/usr/bin/env python3
+"""
+Anki Benchmark
+Mesure le debit de anki_deck_cleaner.py et anki_image_cropper.py sur des
+decks synthetiques generes a la volee (aucun acces reseau necessaire)
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import platform
+import random
+import re
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+from pathlib import Path
+
+
+# Blocs HTML parasites des exports Plonkit/LearnableMeta (cf. BLOCK_RULES)
+NOISE_BLOCKS = [
+    '<div><div><div><div><h1>A Learnable {country}</h1><div>Meta List · 102 metas · '
+    '4 locations · by Someone</div><a href="https://learnablemeta.com/x">▶ Play Map</a>'
+    '<!--]--><!-- x --></div></div>',
+    '<!--[--><div>{n} of 102 metas</div><!--]-->',
+    '<button class="h" data-tooltip-trigger="" type="button"><div><svg><path fill="c" '
+    'd="M12 12q.825 0 1.413-.587T14 10z"></path></svg><span>{n}</span></div></button><!--]-->',
+    '<button data-slot="button" class="n">&lt;</button><button data-slot="button" class="n">&gt;</button>',
+    'Check out <a href="https://www.plonkit.net/{country}">Plonkit</a> for more clues.',
+    'Description and images taken from: <a href="https://www.plonkit.net">Plonkit</a>.',
+    '<div><!--[--><p>Source: <a href="https://www.plonkit.net">PlonkIt</a></p><!--]--></div>',
+    'For more info, check out the <a href="https://www.plonkit.net/{country}">{country} Plonkit</a> guide.',
+    '<svg class="i"><path d="M5 21q-.825 0-1.412-.587T3 19V5q0-.825z"></path></svg><!--]--><!-- -->',
+    '<h3 class="t">Images</h3><!--[--><span>({n})</span><!--]-->',
+]
+
+# Lignes parasites (cf. LINE_RULES)
+NOISE_LINES = ['{n} of 102 metas', '♥ {n}', '&lt; &gt;', 'Images', '({n})',
+               'Source: PlonkIt', 'For more info, check the guide']
+
+# Phrases de contenu utile (declenchent une partie des tags de tags_config.txt)
+CONTENT_SENTENCES = [
+    'Bollards are white with a red reflector.',
+    'The road has yellow outer lines and a dashed white centre line.',
+    'Look for the Google car with a snorkel antenna.',
+    'Utility poles are concrete with a hole pattern.',
+    'The license plate is long and white, cars drive on the left.',
+    'Chevrons are black and yellow on curves.',
+    'Houses have red tiled roofs and white walls.',
+    'Mountains, desert and sand dunes in the north.',
+    'Street signs are blue with white letters.',
+    'Palm trees along the coast, a bridge over the river.',
+    'Route 66 and BR-101 style highway numbering.',
+]
+
+COUNTRIES = ['Chile', 'Kenya', 'Japan', 'Brazil', 'Poland', 'Peru', 'Thailand', 'Spain']
+
+# Formats d'image disponibles pour les medias synthetiques
+IMAGE_FORMATS = ('avif', 'png', 'jpeg')
+
+# Budget de demarrage : duree maximale d'import de chaque script (python -X importtime)
+STARTUP_BUDGET_MS = 100
+STARTUP_MODULES = ('anki_image_cropper', 'anki_deck_cleaner', 'anki_batch')
+
+# Modules lourds qui ne doivent etre charges qu'a la demande (codecs, images, calcul)
+LAZY_MODULES = ('PIL', 'pillow_avif', 'zstandard', 'numpy')
+
+# Reglages d'encodage compares par --only encode (parametres de AnkiImageCropper)
+# ; une variante par encodeur AVIF disponible est ajoutee (cf. encode_profiles)
+ENCODE_PROFILES = [
+    ('avif q80 speed6 (defaut)', {}),
+    ('avif q80 speed8', {'avif_speed': 8}),
+    ('avif q80 speed10', {'avif_speed': 10}),
+    ('avif q60 speed8', {'avif_quality': 60, 'avif_speed': 8}),
+    ('avif q80 speed8 1 thread', {'avif_speed': 8, 'avif_threads': 1}),
+    ('webp q80', {'transcode_avif': 'webp'}),
+    ('jpeg q85', {'transcode_avif': 'jpeg'}),
+]
+
+# Champs pathologiques pour --only fuzz : (nom, debut, motif repete, fin).
+# Blocs parasites tronques ou jamais fermes, qui faisaient reessayer les
+# .*? des regles depuis chaque debut possible (temps quadratique ou pire)
+FUZZ_FIELDS = [
+    ('header_unclosed', '', '<div><div><h1>A</h1>Play Map', ''),
+    ('header_h1s', '', '<div><div><h1>A</h1>', 'Play Map </a>'),
+    ('div_run', '', '<div>', '<h1>x</h1> Play Map'),
+    ('heart_paths', '<button data-tooltip-trigger="">', '<path d="M12 12q.825 0z"></path>', ''),
+    ('heart_buttons', '', '<button class="h" data-tooltip-trigger="">x', '<path d="M12 12q.825'),
+    ('nav_unclosed', '', '<button data-slot="button">&lt;', ''),
+    ('nav_nested', '', '<button data-slot="button">&lt;', '</button>'),
+    ('check_out', '', 'Check out <a href="x">x</a>', ' for more clues.'),
+    ('check_out_spaces', 'Check out', ' ', 'x'),
+    ('description', '', 'Description and images taken from: <a href="x">', ''),
+    ('source', '<div>', '<!-- c -->', '<p>Source: <a>x</a></p>'),
+    ('svg_paths', '<svg class="i">', '<path d="M5 21q-.825 0-1.412-.587T3 19V5q"></path>', ''),
+    ('brs', '', '<br> ', ''),
+    ('open_tags', '', '<a ', ''),
+    ('short_lines', '', 'Check out x\n', ''),
+]
+
+# Regles de nettoyage d'origine (une re.sub par regle, avec .*? et [^>]*),
+# reference du nettoyage pour --only fuzz : lentes sur les champs mal formes,
+# elles ne servent qu'a comparer les resultats sur des champs courts
+BASELINE_BLOCK_RULES = [
+    ('header_block', r'(?:<div>)+<div><h1>[^<]+</h1>.*?Play Map.*?</a><!--\]--><!--[^>]*--></div></div>',
+     re.DOTALL),
+    ('counter_div', r'<!--\[--><div>\d+\s+of\s+\d+\s+metas?</div><!--\]-->', 0),
+    ('heart_button', r'<button[^>]*data-tooltip-trigger[^>]*>.*?<path[^>]*d="M12 12q\.825.*?</button><!--\]-->',
+     re.DOTALL),
+    ('nav_button', r'<button data-slot="button"[^>]*>.*?</button>', re.DOTALL),
+    ('check_out', r'Check out\s+<a[^>]*>.*?</a>\s+for more clues\.', re.DOTALL),
+    ('description', r'Description and images taken from:\s+<a[^>]*>.*?</a>\.?', re.DOTALL | re.IGNORECASE),
+    ('source', r'<div>(?:<!--[^>]*-->)*<p>Source:\s*<a[^>]*>[^<]*</a></p>(?:<!--[^>]*-->)*</div>',
+     re.DOTALL | re.IGNORECASE),
+    ('for_more_info', r'For more info,\s*check[^<]*(?:<a[^>]*>[^<]*</a>[^<]*)*[^<]*\.?', re.DOTALL | re.IGNORECASE),
+    ('image_icon', r'<svg[^>]*>.*?<path d="M5 21q-.825 0-1\.412-.587T3 19V5.*?</svg><!--\]--><!-- -->', re.DOTALL),
+    ('images', r'<h3[^>]*>Images</h3>|<!--\[--><span>\(\d+\)</span><!--\]-->', 0),
+]
+
+# Champs mal formes compares aux regles d'origine par --only fuzz : (nom,
+# champ, resultat attendu). None = meme resultat que BASELINE_BLOCK_RULES ;
+# sinon difference voulue, le resultat attendu est donne
+REGRESSION_FIELDS = [
+    ('nav_nested', '<button data-slot="button"><button data-slot="button">&lt;</button>x</button>y', None),
+    ('nav_unclosed', 'a<button data-slot="button">&lt;<br>b', None),
+    ('nav_unclosed_heart', '<button data-slot="button">&lt;' + NOISE_BLOCKS[2] + 'x', None),
+    ('nav_then_unclosed', NOISE_BLOCKS[3] + 'x<button data-slot="button" class="n">y', None),
+    ('heart_unclosed', '<button class="h" data-tooltip-trigger="">x' + NOISE_BLOCKS[2] + 'y', None),
+    ('heart_across_nav', '<button class="h" data-tooltip-trigger="">x' + NOISE_BLOCKS[3]
+     + '<path d="M12 12q.825"></path></button><!--]-->y', None),
+    ('heart_no_path', '<button class="h" data-tooltip-trigger="">x</button><!--]-->' + NOISE_BLOCKS[3] + 'y', None),
+    ('header_truncated', '<div><div><h1>A Learnable Chile</h1>x' + NOISE_BLOCKS[0] + 'y', None),
+    ('header_no_map', '<div><div><h1>A</h1>x</a><!--]--><!-- --></div></div>' + NOISE_BLOCKS[0] + 'y', None),
+    ('header_unclosed', NOISE_BLOCKS[0][:-12] + '<br>x', None),
+    ('svg_nested', '<svg>' + NOISE_BLOCKS[8] + 'x', None),
+    ('check_out_truncated', 'Check out <a href="x">x</a>, ' + NOISE_BLOCKS[4] + 'y', None),
+    ('description_truncated', 'Description and images taken from: <a href="x">' + NOISE_BLOCKS[5] + 'y', None),
+    # Balise coupee par un < avant son > : n'est plus prolongee jusqu'au > suivant
+    ('tag_cut', 'Description and images taken from: <a href="h<b>x</b></a>.<br>y', 'y'),
+]
+
+# Tailles (caracteres) des champs de --only fuzz, et limites : exposant de
+# croissance maximal entre les deux dernieres tailles (1 = temps lineaire,
+# 2 = quadratique) et duree au-dela de laquelle un cas n'est plus agrandi.
+# Les tailles croissent par petits pas pour qu'un cas quadratique s'arrete
+# avant de durer des heures
+FUZZ_SIZES = (10_000, 30_000, 100_000, 300_000)
+FUZZ_MAX_EXPONENT = 1.3
+FUZZ_TIMEOUT_SECONDS = 5.0
+
+
+def make_answer(rng):
+    """Genere un champ Answer realiste (contenu utile + blocs et lignes parasites)"""
+    country = rng.choice(COUNTRIES)
+    fill = {'country': country, 'n': rng.randint(1, 99)}
+
+    blocks = [block.format(**fill) for block in NOISE_BLOCKS if rng.random() < 0.4]
+    lines = []
+    for _ in range(rng.randint(2, 8)):
+        if rng.random() < 0.75:
+            lines.append(rng.choice(CONTENT_SENTENCES))
+        else:
+            lines.append(rng.choice(NOISE_LINES).format(**fill))
+
+    middle = len(blocks) // 2
+    return ''.join(blocks[:middle]) + '<br>'.join(lines) + ''.join(blocks[middle:])
+
+
+def make_image(rng, width, height):
+    """
+    Genere une image synthetique : fond degrade bruite + mini-carte en bas a droite
+
+    Returns:
+        Image PIL en mode RGB
+    """
+    from PIL import Image, ImageDraw
+
+    background = Image.linear_gradient('L').resize((width, height)).convert('RGB')
+    noise = Image.effect_noise((width, height), rng.randint(20, 60)).convert('RGB')
+    img = Image.blend(background, noise, 0.4)
+
+    # Mini-carte : rectangle uni avec quelques traits
+    draw = ImageDraw.Draw(img)
+    map_w = int(width * rng.uniform(0.25, 0.4))
+    map_h = int(height * rng.uniform(0.25, 0.4))
+    left, top = width - map_w - 5, height - map_h - 5
+    draw.rectangle([left, top, width - 5, height - 5], fill=(170, 200, 230))
+    for _ in range(6):
+        draw.line([rng.randint(left, width - 5), rng.randint(top, height - 5),
+                   rng.randint(left, width - 5), rng.randint(top, height - 5)],
+                  fill=(240, 240, 240), width=3)
+    return img
+
+
+def generate_deck(path, notes=1000, images=0, image_mix=None, image_size=(800, 600),
+                  zstd_ratio=0.0, seed=0):
+    """
+    Genere un fichier .apkg synthetique (format anki2 + index media JSON)
+
+    Args:
+        path: Chemin du .apkg a creer
+        notes: Nombre de notes
+        images: Nombre d'images dans les medias
+        image_mix: Dictionnaire {format: poids} parmi IMAGE_FORMATS
+        image_size: Tuple (largeur, hauteur) des images
+        zstd_ratio: Proportion d'images compressees en zstd (0 a 1)
+        seed: Graine du generateur aleatoire (decks reproductibles)
+
+    Returns:
+        Chemin du fichier cree
+    """
+    rng = random.Random(seed)
+    path = Path(path)
+    image_mix = image_mix or {'avif': 1, 'png': 1, 'jpeg': 1}
+
+    # Format de chaque image, tire a part pour que les notes referencent
+    # le vrai nom de fichier (cf. index media) sans changer le reste du deck
+    formats = list(image_mix)
+    weights = [image_mix[fmt] for fmt in formats]
+    format_rng = random.Random(f'{seed}-formats')
+    image_formats = format_rng.choices(formats, weights, k=images)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = Path(tmp) / 'collection.anki2'
+        conn = sqlite3.connect(db_path)
+        conn.execute("CREATE TABLE col (id integer primary key, models text not null)")
+        conn.execute(
+            "CREATE TABLE notes (id integer primary key, guid text not null, mid integer not null, "
+            "mod integer not null, usn integer not null, tags text not null, flds text not null, "
+            "sfld integer not null, csum integer not null, flags integer not null, data text not null)")
+        conn.execute("INSERT INTO col VALUES (1, ?)",
+                     (json.dumps({'1': {'name': 'Meta', 'sortf': 0}}),))
+
+        batch = []
+        for i in range(notes):
+            fields = [f'{rng.choice(COUNTRIES)} rule {i}']
+            if images and rng.random() < 0.5:
+                index = rng.randrange(images)
+                fields.append(f'<img src="{index}.{image_formats[index]}">')
+            fields.append(make_answer(rng))
+            tags = rng.choice(['', ' geo ', ' geo meta '])
+            batch.append((1_000_000 + i, f'g{i}', 1, 0, -1, tags, '\x1f'.join(fields),
+                          fields[0], 0, 0, ''))
+            if len(batch) >= 10_000:
+                conn.executemany("INSERT INTO notes VALUES (?,?,?,?,?,?,?,?,?,?,?)", batch)
+                batch = []
+        conn.executemany("INSERT INTO notes VALUES (?,?,?,?,?,?,?,?,?,?,?)", batch)
+        conn.commit()
+        conn.close()
+
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zout:
+            zout.write(db_path, 'collection.anki2')
+            media = {}
+            if images:
+                cctx = None
+                for i, fmt in enumerate(image_formats):
+                    buffer = io.BytesIO()
+                    make_image(rng, *image_size).save(buffer, fmt.upper())
+                    data = buffer.getvalue()
+                    if rng.random() < zstd_ratio:
+                        if cctx is None:
+                            import zstandard
+                            cctx = zstandard.ZstdCompressor()
+                        data = cctx.compress(data)
+                    zout.writestr(str(i), data, compress_type=zipfile.ZIP_STORED)
+                    media[str(i)] = f'{i}.{fmt}'
+            zout.writestr('media', json.dumps(media))
+
+    return path
+
+
+def time_stages(stages, cleanup=None, verbose=False):
+    """
+    Execute des etapes dans l'ordre et mesure la duree de chacune
+
+    Args:
+        stages: Liste de tuples (nom, fonction sans argument)
+        cleanup: Fonction appelee a la fin, meme en cas d'erreur
+        verbose: True pour laisser passer les messages des scripts
+
+    Returns:
+        Dictionnaire {nom de l'etape: duree en secondes, 'total': ...}
+    """
+    timings = {}
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    start = time.perf_counter()
+    with output:
+        try:
+            for name, stage in stages:
+                stage_start = time.perf_counter()
+                stage()
+                timings[name] = round(time.perf_counter() - stage_start, 4)
+        finally:
+            if cleanup is not None:
+                cleanup_start = time.perf_counter()
+                cleanup()
+                timings['cleanup'] = round(time.perf_counter() - cleanup_start, 4)
+    timings['total'] = round(time.perf_counter() - start, 4)
+    return timings
+
+
+def bench_cleaner(deck, work_dir, workers=1, verbose=False):
+    """
+    Mesure chaque etape de AnkiDeckCleaner.process sur un deck
+
+    Le detail interne des etapes (lecture/ecriture de la base, nettoyage,
+    tags) et les compteurs viennent de cleaner.stats.
+    """
+    from anki_deck_cleaner import AnkiDeckCleaner
+
+    cleaner = AnkiDeckCleaner(deck, workers=workers)
+    output_file = Path(work_dir) / 'bench_cleaned.apkg'
+    timings = time_stages([
+        ('extract_apkg', cleaner.extract_apkg),
+        ('clean_cards', cleaner.clean_cards),
+        ('create_cleaned_apkg', lambda: cleaner.create_cleaned_apkg(output_file)),
+    ], cleanup=cleaner.cleanup, verbose=verbose)
+    timings['details'] = {'timings': cleaner.stats.to_dict()['timings'],
+                          'counters': cleaner.stats.counters}
+    return timings
+
+
+def bench_cropper(deck, work_dir, workers=1, verbose=False):
+    """
+    Mesure AnkiImageCropper.process sur un deck
+
+    Le detail interne (lecture, decodage, encodage, ecriture...), les
+    compteurs et le pic de memoire par image viennent de cropper.stats.
+    unpipelined est le temps des memes etapes sans pipeline (traiter toutes
+    les images, puis ecrire l'archive), a comparer a total.
+    """
+    from anki_image_cropper import AnkiImageCropper
+
+    cropper = AnkiImageCropper(deck, workers=workers)
+    output_file = Path(work_dir) / 'bench_cropped.apkg'
+    timings = time_stages([
+        ('process', lambda: cropper.process(output_file)),
+    ], verbose=verbose)
+    timings['details'] = {'timings': cropper.stats.to_dict()['timings'],
+                          'counters': cropper.stats.counters,
+                          'peaks': cropper.stats.peaks}
+
+    staged = AnkiImageCropper(deck, workers=workers)
+    timings['unpipelined'] = time_stages([
+        ('extract_apkg', staged.extract_apkg),
+        ('process_all_images', staged.process_all_images),
+        ('create_cropped_apkg', lambda: staged.create_cropped_apkg(output_file)),
+    ], cleanup=staged.cleanup, verbose=verbose)['total']
+    return timings
+
+
+def bench_pipeline(deck, work_dir, workers=1, verbose=False):
+    """
+    Mesure le pipeline combine (nettoyage + images en une passe, cf. anki_batch.run_pipeline)
+
+    A comparer a la somme des totaux du cleaner et du cropper.
+    """
+    from anki_batch import run_pipeline
+    from anki_deck_cleaner import AnkiDeckCleaner
+    from anki_image_cropper import AnkiImageCropper
+
+    cleaner = AnkiDeckCleaner(deck, workers=workers)
+    cropper = AnkiImageCropper(deck, workers=workers)
+    output_file = Path(work_dir) / 'bench_pipeline.apkg'
+    result = {}
+    timings = time_stages([
+        ('run_pipeline', lambda: result.update(stats=run_pipeline(cleaner, cropper, output_file)[1])),
+    ], verbose=verbose)
+    timings['details'] = {'timings': result['stats'].to_dict()['timings']}
+    return timings
+
+
+def encode_profiles():
+    """Reglages d'encodage a comparer : ENCODE_PROFILES + un par encodeur AVIF disponible"""
+    from anki_image_cropper import avif_encoder_codecs
+
+    codecs = [(f'avif q80 speed8 {codec}', {'avif_speed': 8, 'avif_codec': codec})
+              for codec in avif_encoder_codecs()]
+    return ENCODE_PROFILES + codecs
+
+
+def bench_encode(deck, sample=20, seed=0, verbose=False):
+    """
+    Compare les reglages d'encodage AVIF sur un echantillon des images du deck
+
+    Les images sont decodees et recadrees une seule fois (reglages par
+    defaut du cropper), puis encodees avec chaque reglage de encode_profiles.
+
+    Args:
+        deck: Chemin du .apkg
+        sample: Nombre d'images AVIF tirees au hasard dans le deck
+        seed: Graine du tirage
+
+    Returns:
+        Dictionnaire avec, pour chaque reglage, la duree et la taille totales
+    """
+    from PIL import Image
+    from anki_image_cropper import AnkiImageCropper
+
+    cropper = AnkiImageCropper(deck)
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    with output:
+        cropper.extract_apkg()
+        try:
+            images = [info for info in cropper.find_media_files() if info['type'] == 'avif']
+        finally:
+            cropper.cleanup()
+    images = random.Random(seed).sample(images, min(sample, len(images)))
+
+    decoded = []
+    source_bytes = 0
+    for info in images:
+        data = cropper.zip_file.read(info['id'])
+        if info['compressed']:
+            data = cropper.decompress_zstd(data)
+        source_bytes += len(data)
+        img = Image.open(io.BytesIO(data))
+        img.load()
+        decoded.append((cropper._crop_directional(img, *img.size), img))
+
+    profiles = []
+    for name, options in encode_profiles():
+        encoder = AnkiImageCropper(deck, **options)
+        total_bytes = 0
+        start = time.perf_counter()
+        for result, source in decoded:
+            total_bytes += len(encoder._encode(result, source, 'avif'))
+        seconds = time.perf_counter() - start
+        profiles.append({
+            'name': name,
+            'options': options,
+            'seconds': round(seconds, 4),
+            'ms_per_image': round(1000 * seconds / len(decoded), 1) if decoded else None,
+            'bytes': total_bytes,
+            'ratio': round(total_bytes / source_bytes, 3) if source_bytes else None,
+        })
+
+    return {'images': len(decoded), 'source_bytes': source_bytes, 'profiles': profiles}
+
+
+def fuzz_field(start, unit, end, size):
+    """Champ pathologique d'environ size caracteres (cf. FUZZ_FIELDS)"""
+    return start + unit * max(1, (size - len(start) - len(end)) // len(unit)) + end
+
+
+def check_regressions():
+    """
+    Compare le nettoyage des champs de REGRESSION_FIELDS a celui des regles d'origine
+
+    Returns:
+        Dictionnaire des resultats par champ, avec 'ok' False si un champ
+        s'ecarte du resultat attendu (cf. REGRESSION_FIELDS)
+    """
+    from anki_deck_cleaner import CleanupRules
+
+    baseline = CleanupRules(block_rules=[(name, pattern, flags, (), str(step))
+                                         for step, (name, pattern, flags) in enumerate(BASELINE_BLOCK_RULES)])
+    rules = CleanupRules()
+    results = {'fields': {}, 'ok': True}
+    for name, field, expected in REGRESSION_FIELDS:
+        before = baseline.clean(field)
+        after = rules.clean(field)
+        ok = after == (before if expected is None else expected)
+        results['fields'][name] = {'same': after == before, 'ok': ok}
+        if not ok:
+            results['fields'][name].update(before=before, after=after)
+        results['ok'] = results['ok'] and ok
+    return results
+
+
+def bench_fuzz(work_dir, sizes=FUZZ_SIZES, repeat=5, verbose=False):
+    """
+    Mesure le nettoyage et le tagging de champs pathologiques de taille croissante
+
+    Chaque champ de FUZZ_FIELDS passe par AnkiDeckCleaner.clean_note (regles
+    de nettoyage et tags de tags_config.txt). La croissance entre deux tailles
+    est donnee en exposant : temps ~ taille ** exposant. Verifie aussi que
+    le nettoyage garde le resultat des regles d'origine (cf. check_regressions).
+
+    Args:
+        work_dir: Dossier ou creer le deck d'une note dont le cleaner a besoin
+        sizes: Tailles des champs, croissantes
+        repeat: Nombre de mesures par taille (la plus rapide est gardee)
+
+    Returns:
+        Dictionnaire des mesures par champ, avec 'ok' False si un champ croit
+        plus vite que FUZZ_MAX_EXPONENT ou depasse FUZZ_TIMEOUT_SECONDS, ou
+        si un champ de REGRESSION_FIELDS s'ecarte du resultat attendu
+    """
+    import math
+    from anki_deck_cleaner import AnkiDeckCleaner
+
+    deck = Path(work_dir) / 'fuzz.apkg'
+    generate_deck(deck, notes=1)
+    cleaner = AnkiDeckCleaner(deck)
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    with output:
+        cleaner.detect_tags('')
+
+    results = {'max_exponent': FUZZ_MAX_EXPONENT, 'fields': {}, 'ok': True}
+    results['regressions'] = check_regressions()
+    results['ok'] = results['regressions']['ok']
+    for name, start, unit, end in FUZZ_FIELDS:
+        measures = []
+        for size in sizes:
+            fields = 'Fuzz\x1f' + fuzz_field(start, unit, end, size)
+            best = None
+            for _ in range(repeat):
+                begin = time.perf_counter()
+                cleaner.clean_note(fields, '')
+                seconds = time.perf_counter() - begin
+                best = seconds if best is None else min(best, seconds)
+                if seconds > FUZZ_TIMEOUT_SECONDS:
+                    break
+            measures.append((len(fields), best))
+            if best > FUZZ_TIMEOUT_SECONDS:
+                break
+
+        exponent = None
+        if len(measures) >= 2:
+            (small, small_time), (large, large_time) = measures[-2:]
+            exponent = (math.log(max(large_time, 1e-6) / max(small_time, 1e-6))
+                        / math.log(large / small))
+        ok = (len(measures) == len(sizes) and measures[-1][1] <= FUZZ_TIMEOUT_SECONDS
+              and exponent is not None and exponent <= FUZZ_MAX_EXPONENT)
+        results['fields'][name] = {
+            'chars': [chars for chars, _ in measures],
+            'ms': [round(seconds * 1000, 2) for _, seconds in measures],
+            'exponent': round(exponent, 2) if exponent is not None else None,
+            'ok': ok,
+        }
+        results['ok'] = results['ok'] and ok
+    return results
+
+
+def measure_import(module, repeat=5):
+    """
+    Mesure l'import d'un module dans un nouvel interpreteur (python -X importtime)
+
+    Args:
+        module: Nom du module
+        repeat: Nombre de mesures (la plus rapide est gardee)
+
+    Returns:
+        Tuple (duree cumulee en ms, lignes de importtime de la mesure gardee)
+    """
+    best = None
+    for _ in range(repeat):
+        stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                                cwd=Path(__file__).parent, capture_output=True, text=True,
+                                check=True).stderr
+        # Format : "import time: self [us] | cumulative | module"
+        rows = []
+        for line in stderr.splitlines():
+            parts = line.split('|')
+            if line.startswith('import time:') and len(parts) == 3 and parts[1].strip().isdigit():
+                rows.append((int(parts[0].split(':')[1]), int(parts[1]), parts[2].rstrip()))
+        total = next(cumulative for _, cumulative, name in rows if name.strip() == module) / 1000
+        if best is None or total < best[0]:
+            best = (total, rows)
+    return best
+
+
+def bench_startup(modules=STARTUP_MODULES, budget_ms=STARTUP_BUDGET_MS, repeat=5):
+    """
+    Verifie le temps de demarrage des scripts
+
+    Pour chaque module : duree d'import, imports les plus couteux, et
+    modules lourds (LAZY_MODULES) charges des l'import alors qu'ils
+    devraient l'etre a la demande.
+
+    Returns:
+        Dictionnaire des mesures, avec 'ok' False si un module depasse le
+        budget ou charge un module lourd
+    """
+    results = {'budget_ms': budget_ms, 'modules': {}, 'ok': True}
+    for module in modules:
+        total, rows = measure_import(module, repeat)
+        names = {name.strip() for _, _, name in rows}
+        eager = sorted(name for name in names if name.split('.')[0] in LAZY_MODULES)
+        heaviest = sorted(rows, key=lambda row: row[0], reverse=True)[:5]
+        ok = total <= budget_ms and not eager
+        results['modules'][module] = {
+            'import_ms': round(total, 1),
+            'heaviest': [{'module': name.strip(), 'self_ms': round(own / 1000, 1)}
+                         for own, _, name in heaviest],
+            'eager_imports': eager,
+            'ok': ok,
+        }
+        results['ok'] = results['ok'] and ok
+    return results
+
+
+def check_raw_copy_fallback(work_dir):
+    """
+    Verifie la copie recompressee des entrees (cf. anki_apkg.copy_entry_raw)
+
+    RAW_COPY_LIMIT est ramene a 0 : toutes les entrees passent par
+    copy_entry_recompressed, comme une entree ZIP64. Le .apkg reecrit doit
+    contenir les memes entrees, avec le meme contenu et la meme methode.
+
+    Args:
+        work_dir: Dossier ou creer les decks
+
+    Returns:
+        Dictionnaire avec 'status' ('ok' ou 'failed') et les entrees en ecart
+    """
+    import anki_apkg
+
+    deck = generate_deck(Path(work_dir) / 'raw_copy.apkg', notes=20, images=6, zstd_ratio=0.5)
+    output = Path(work_dir) / 'raw_copy_out.apkg'
+    limit = anki_apkg.RAW_COPY_LIMIT
+    anki_apkg.RAW_COPY_LIMIT = 0
+    try:
+        anki_apkg.rewrite_apkg(deck, output, {})
+    finally:
+        anki_apkg.RAW_COPY_LIMIT = limit
+
+    with zipfile.ZipFile(deck) as zin, zipfile.ZipFile(output) as zout:
+        expected = {info.filename: (zin.read(info), info.compress_type) for info in zin.infolist()}
+        actual = {info.filename: (zout.read(info), info.compress_type) for info in zout.infolist()}
+        corrupted = zout.testzip()
+    mismatched = sorted(name for name in expected.keys() | actual.keys()
+                        if expected.get(name) != actual.get(name))
+    ok = not mismatched and corrupted is None
+    return {'status': 'ok' if ok else 'failed', 'mismatched': mismatched, 'corrupted': corrupted}
+
+
+def check_jpeg_lossless_crop(work_dir):
+    """
+    Verifie que le recadrage des JPEG par jpegtran garde les blocs a l'identique
+
+    Des JPEG de taille quelconque (4:4:4 et 4:2:0) sont recadres dans les
+    quatre directions par AnkiImageCropper._process_source. Une fois decodee,
+    la zone gardee doit etre identique au pixel pres a celle de l'original,
+    sauf sur un MCU le long des bords : le lissage du sous-echantillonnage
+    y lit les pixels voisins, retires par la coupe.
+
+    Args:
+        work_dir: Dossier ou creer le deck dont le cropper a besoin
+
+    Returns:
+        Dictionnaire avec 'status' ('ok', 'failed', ou 'skipped' sans
+        jpegtran) et les cas en ecart
+    """
+    from PIL import Image, ImageChops
+    from anki_image_cropper import CROP_DIRECTIONS, AnkiImageCropper
+
+    if shutil.which('jpegtran') is None:
+        return {'status': 'skipped', 'reason': "jpegtran absent"}
+
+    deck = generate_deck(Path(work_dir) / 'jpeg.apkg', notes=1)
+    image = Image.merge('RGB', [Image.effect_noise((203, 157), sigma) for sigma in (40, 60, 80)])
+    failures = []
+    for subsampling in (0, 2):
+        buffer = io.BytesIO()
+        image.save(buffer, 'JPEG', quality=85, subsampling=subsampling)
+        original = Image.open(io.BytesIO(buffer.getvalue()))
+        for direction in CROP_DIRECTIONS:
+            case = f'{direction} {subsampling}'
+            with contextlib.redirect_stdout(io.StringIO()):
+                cropper = AnkiImageCropper(deck, mode='crop', direction=direction)
+                data = cropper._process_source(io.BytesIO(buffer.getvalue()), 'jpeg')
+            if not data or not cropper.stats.counters.get('jpeg_lossless'):
+                failures.append(case + ' : jpegtran non utilise')
+                continue
+            grid_x, grid_y = cropper._jpeg_grid(original)
+            left, top, right, bottom = cropper._crop_box(*original.size, (grid_x, grid_y))
+            result = Image.open(io.BytesIO(data)).convert('RGB')
+            if result.size != (right - left, bottom - top):
+                failures.append(f'{case} : taille {result.size}')
+                continue
+            inner = (grid_x, grid_y, result.width - grid_x, result.height - grid_y)
+            kept = original.convert('RGB').crop((left, top, right, bottom)).crop(inner)
+            if ImageChops.difference(kept, result.crop(inner)).getbbox() is not None:
+                failures.append(case + ' : pixels differents')
+    return {'status': 'failed' if failures else 'ok', 'failures': failures}
+
+
+def check_over_budget_skip(work_dir):
+    """
+    Verifie que les images au-dela de --memory-budget sont ignorees, pas en echec
+
+    Avec max_size, les JPEG sont decodes en taille reduite et tiennent dans
+    le budget, pas les PNG. Sequentiellement puis avec deux workers, les PNG
+    doivent etre comptes dans images_over_budget (pas dans images_failed),
+    affiches IGNOREE et gardes a l'identique dans le .apkg cree.
+
+    Args:
+        work_dir: Dossier ou creer les decks
+
+    Returns:
+        Dictionnaire avec 'status' ('ok' ou 'failed') et les ecarts par mode
+    """
+    from anki_image_cropper import AnkiImageCropper
+
+    deck = generate_deck(Path(work_dir) / 'budget.apkg', notes=10, images=6,
+                         image_mix={'png': 1, 'jpeg': 1}, image_size=(1200, 900))
+    with zipfile.ZipFile(deck) as zin:
+        media = json.loads(zin.read('media'))
+        original = {name: zin.read(name) for name in media}
+    skipped = sorted(name for name, filename in media.items() if filename.endswith('.png'))
+
+    failures = []
+    for workers in (1, 2):
+        case = f'{workers} worker(s)'
+        output = Path(work_dir) / f'budget_{workers}.apkg'
+        printed = io.StringIO()
+        with contextlib.redirect_stdout(printed):
+            cropper = AnkiImageCropper(deck, workers=workers, memory_budget_mb=4, max_size=600)
+            try:
+                cropper.process(output)
+            finally:
+                cropper.cleanup()
+        counters = cropper.stats.counters
+        if counters.get('images_failed', 0):
+            failures.append(f"{case} : {counters['images_failed']} image(s) en echec")
+        if counters.get('images_over_budget', 0) != len(skipped):
+            failures.append(f"{case} : images_over_budget = {counters.get('images_over_budget', 0)}")
+        if printed.getvalue().count('IGNOREE') != len(skipped) or 'ECHEC' in printed.getvalue():
+            failures.append(f'{case} : progression sans IGNOREE ou avec ECHEC')
+        if not output.exists():
+            failures.append(f'{case} : pas de .apkg cree')
+            continue
+        with zipfile.ZipFile(output) as zout:
+            changed = sorted(name for name in media if zout.read(name) != original[name])
+        if changed != sorted(set(media) - set(skipped)):
+            failures.append(f'{case} : entrees modifiees {changed}')
+    return {'status': 'failed' if failures else 'ok', 'skipped_images': len(skipped),
+            'failures': failures}
+
+
+def run_checks(work_dir):
+    """
+    Lance les verifications de --only checks
+
+    Args:
+        work_dir: Dossier de travail des verifications
+
+    Returns:
+        Dictionnaire des resultats par verification, avec 'ok' False si
+        l'une d'elles echoue ('skipped' quand un outil externe manque)
+    """
+    checks = (
+        ('raw_copy_fallback', check_raw_copy_fallback),
+        ('jpeg_lossless_crop', check_jpeg_lossless_crop),
+        ('over_budget_skip', check_over_budget_skip),
+    )
+    results = {'checks': {}, 'ok': True}
+    for name, check in checks:
+        check_dir = Path(work_dir) / name
+        check_dir.mkdir()
+        result = check(check_dir)
+        results['checks'][name] = result
+        results['ok'] = results['ok'] and result['status'] != 'failed'
+    return results
+
+
+def git_revision():
+    """Revision git du depot, si disponible (pour comparer les versions)"""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              cwd=Path(__file__).parent, capture_output=True,
+                              text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def parse_mix(text):
+    """Lit un melange de formats 'avif=1,png=2,jpeg=1'"""
+    mix = {}
+    for part in text.split(','):
+        fmt, _, weight = part.partition('=')
+        fmt = fmt.strip().lower()
+        if fmt not in IMAGE_FORMATS:
+            raise argparse.ArgumentTypeError(f"Format inconnu : {fmt}")
+        mix[fmt] = float(weight or 1)
+    return mix
+
+
+def parse_size(text):
+    """Lit une taille '800x600'"""
+    width, _, height = text.lower().partition('x')
+    return int(width), int(height)
+
+
+def main():
+    """Fonction principale"""
+    parser = argparse.ArgumentParser(description="Benchmark du cleaner et du cropper sur des decks synthetiques")
+    parser.add_argument('--notes', type=int, default=10_000, help="Nombre de notes (defaut: 10000)")
+    parser.add_argument('--images', type=int, default=100, help="Nombre d'images (defaut: 100)")
+    parser.add_argument('--image-mix', type=parse_mix, default='avif=1,png=1,jpeg=1',
+                        help="Proportions des formats d'image (defaut: avif=1,png=1,jpeg=1)")
+    parser.add_argument('--image-size', type=parse_size, default='800x600',
+                        help="Taille des images (defaut: 800x600)")
+    parser.add_argument('--zstd-ratio', type=float, default=0.5,
+                        help="Proportion d'images compressees en zstd (defaut: 0.5)")
+    parser.add_argument('--workers', type=int, default=1, help="Processus pour le cleaner et le cropper")
+    parser.add_argument('--only', choices=['cleaner', 'cropper', 'encode', 'startup', 'fuzz', 'checks'],
+                        help="Ne mesurer qu'un des deux outils, comparer les reglages "
+                             "d'encodage AVIF (encode), verifier le temps de demarrage "
+                             "des scripts (startup), le temps de nettoyage de champs "
+                             "pathologiques (fuzz) ou le comportement de cas limites "
+                             "(checks) ; code de sortie 1 si hors budget ou en echec")
+    parser.add_argument('--deck', help="Utiliser ce .apkg au lieu d'un deck synthetique")
+    parser.add_argument('--encode-sample', type=int, default=20,
+                        help="Images AVIF tirees au hasard pour --only encode (defaut: 20)")
+    parser.add_argument('--seed', type=int, default=0, help="Graine du generateur (defaut: 0)")
+    parser.add_argument('--output', help="Fichier JSON des resultats (defaut: sortie standard)")
+    parser.add_argument('--verbose', action='store_true', help="Afficher les messages des scripts")
+    args = parser.parse_args()
+
+    work_dir = Path(tempfile.mkdtemp(prefix='anki_bench_'))
+    try:
+        generation_start = time.perf_counter()
+        if args.deck:
+            deck = Path(args.deck)
+        elif args.only in ('startup', 'fuzz', 'checks'):
+            deck = None
+        else:
+            deck = work_dir / 'bench.apkg'
+            generate_deck(deck, notes=args.notes,
+                          images=0 if args.only == 'cleaner' else args.images,
+                          image_mix=args.image_mix, image_size=args.image_size,
+                          zstd_ratio=args.zstd_ratio, seed=args.seed)
+
+        results = {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'params': {
+                'deck': args.deck,
+                'notes': args.notes,
+                'images': args.images,
+                'image_mix': args.image_mix,
+                'image_size': list(args.image_size),
+                'zstd_ratio': args.zstd_ratio,
+                'workers': args.workers,
+                'seed': args.seed,
+            },
+            'deck_bytes': deck.stat().st_size if deck else None,
+            'generation_seconds': round(time.perf_counter() - generation_start, 4),
+        }
+
+        if args.only in (None, 'startup'):
+            results['startup'] = bench_startup()
+
+        if args.only == 'fuzz':
+            results['fuzz'] = bench_fuzz(work_dir, verbose=args.verbose)
+
+        if args.only == 'checks':
+            results['checks'] = run_checks(work_dir)
+
+        if args.only == 'encode':
+            results['encode'] = bench_encode(deck, args.encode_sample, args.seed, args.verbose)
+
+        if args.only in (None, 'cleaner'):
+            timings = bench_cleaner(deck, work_dir, args.workers, args.verbose)
+            notes = timings['details']['counters'].get('notes_scanned', args.notes)
+            timings['notes_per_second'] = round(notes / timings['total'], 1)
+            results['cleaner'] = timings
+
+        if args.only in (None, 'cropper') and (args.images or args.deck):
+            timings = bench_cropper(deck, work_dir, args.workers, args.verbose)
+            images = timings['details']['counters'].get('images_found', args.images)
+            timings['images_per_second'] = round(images / timings['total'], 1)
+            results['cropper'] = timings
+
+        if args.only is None and (args.images or args.deck):
+            results['pipeline'] = bench_pipeline(deck, work_dir, args.workers, args.verbose)
+
+        report = json.dumps(results, indent=2)
+        if args.output:
+            Path(args.output).write_text(report + '\n', encoding='utf-8')
+        else:
+            print(report)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    # Code de sortie 1 si un script demarre trop lentement, si un champ
+    # pathologique se nettoie en temps plus que lineaire ou si une
+    # verification echoue (utilisable en CI)
+    ok = all(results.get(check, {}).get('ok', True) for check in ('startup', 'fuzz', 'checks'))
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
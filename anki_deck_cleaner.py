@@ -8,52 +8,661 @@ import zipfile
 import sqlite3
 import os
 import shutil
+import sys
+import tempfile
 import re
+import json
+import time
+import hashlib
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
+from anki_apkg import (DEFAULT_COMPRESS_LEVEL, ZSTD_DB_NAMES, compress_file, dedup_media,
+                       extract_entry, field_checksum, find_database, load_sort_fields,
+                       load_zstd, read_media_map, rewrite_apkg, strip_html_media,
+                       strip_html_tags)
+from anki_stats import ProcessStats, run_profiled
+
+
+# Mots (suites maximales de caractères \w) du texte à analyser
+WORD_RE = re.compile(r'\w+')
+
+# Pattern de la forme \bmot\b ou \bmot composé\b sans métacaractère regex
+LITERAL_PATTERN_RE = re.compile(r'\\b(\w[^\\.^$*+?{}\[\]|()#]*)\\b')
+
+# Règles de nettoyage appliquées sur tout le champ Answer, dans l'ordre
+# (nom, pattern, flags, textes obligatoirement présents, étape)
+# Une règle n'est essayée que si tous ses textes sont présents dans le champ
+# (en minuscules pour les règles IGNORECASE). Les règles d'une même étape sont
+# fusionnées en une seule regex et appliquées en un seul passage.
+# Attention : une étape voit le texte déjà nettoyé par les précédentes (ex: 5d
+# s'étend plus loin une fois la ligne Source retirée par 5c). Ne fusionner
+# que des règles qui ne peuvent pas créer ou masquer des occurrences l'une de
+# l'autre, sinon le résultat du nettoyage change.
+#
+# Temps linéaire : sur un champ mal formé (bloc jamais fermé, répété des
+# milliers de fois), un .*? réessayé depuis chaque début possible coûte un
+# temps quadratique, voire cubique avec deux .*? à la suite. D'où :
+# - pattern en deux parties (début, suite) : la regex complète n'est essayée
+#   qu'au premier début trouvé ; si elle échoue, la règle s'arrête là. Un
+#   début suivant échouerait aussi : il ne voit que la fin du texte, où les
+#   repères de la suite manquent déjà. Seule dans son étape (pas de fusion)
+# - (?=(?P<x>.*?...))(?P=x) : le premier repère trouvé (ex: Play Map) est
+#   gardé sans retour arrière (un lookahead ne revient jamais en arrière) ;
+#   le suivant n'apporterait pas de correspondance que le premier n'a pas
+# - [^<>]* dans les balises, pour ne pas sortir de la balise
+# - (?<!<div>) : un essai par suite de <div>, pas un par <div>
+# Le résultat reste celui des anciennes regex, sauf pour une balise coupée
+# par un < avant son > (cf. anki_benchmark.py --only fuzz)
+BLOCK_RULES = [
+    # Étape 1 : Bloc d'en-tête complet (A Learnable X, Learnable X, Ultimate X, etc.)
+    ('header_block',
+     (r'(?<!<div>)(?:<div>)+<div><h1>[^<]+</h1>',
+      r'(?=(?P<header_map>.*?Play Map))(?P=header_map).*?</a><!--\]--><!--[^>]*--></div></div>'),
+     re.DOTALL, ('<h1>', 'Play Map'), '1'),
+    # Étape 2 : Divs avec compteurs (ex: <div>4 of 102 metas</div>)
+    ('counter_div',
+     r'<!--\[--><div>\d+\s+of\s+\d+\s+metas?</div><!--\]-->',
+     0, ('<!--[--><div>', 'meta'), '2'),
+    # Étape 3 : Bouton avec cœur et compteur
+    ('heart_button',
+     (r'<button[^<>]*data-tooltip-trigger[^<>]*>',
+      r'(?=(?P<heart_path>.*?<path[^<>]*d="M12 12q\.825))(?P=heart_path).*?</button><!--\]-->'),
+     re.DOTALL, ('data-tooltip-trigger', 'd="M12 12q.825'), '3'),
+    # Étape 4 : Boutons de navigation (< et >) avec data-slot="button"
+    ('nav_button',
+     (r'<button data-slot="button"[^<>]*>', r'.*?</button>'),
+     re.DOTALL, ('<button data-slot="button"',), '4'),
+    # Étape 5 : "Check out ... for more clues" avec lien
+    ('check_out',
+     (r'Check out\s+<a[^<>]*>', r'.*?</a>\s+for more clues\.'),
+     re.DOTALL, ('Check out', 'for more clues.'), '5'),
+    # Étape 5b : "Description and images taken from: [lien]"
+    ('description',
+     (r'Description and images taken from:\s+<a[^<>]*>', r'.*?</a>\.?'),
+     re.DOTALL | re.IGNORECASE, ('description and images taken from:',), '5b'),
+    # Étape 5c : "Source: [lien]" (ex: Source: PlonkIt)
+    ('source',
+     r'<div>(?:<!--[^>]*-->)*<p>Source:\s*<a[^>]*>[^<]*</a></p>(?:<!--[^>]*-->)*</div>',
+     re.DOTALL | re.IGNORECASE, ('<p>source:',), '5c'),
+    # Étape 5d : "For more info, check..." (ex: check out the UK Plonkit...)
+    ('for_more_info',
+     r'For more info,\s*check[^<]*(?:<a[^>]*>[^<]*</a>[^<]*)*[^<]*\.?',
+     re.DOTALL | re.IGNORECASE, ('for more info,',), '5d'),
+    # Étape 6 : Icône d'image (SVG avec path contenant "M5 21q-.825...")
+    ('image_icon',
+     (r'<svg[^<>]*>',
+      r'(?=(?P<icon_path>.*?<path d="M5 21q-.825 0-1\.412-.587T3 19V5))(?P=icon_path)'
+      r'.*?</svg><!--\]--><!-- -->'),
+     re.DOTALL, ('<svg', '<path d="M5 21q-'), '6'),
+    # Étape 7 : Titre "Images" et numéros "(1)", "(2)", etc.
+    ('images_title',
+     r'<h3[^>]*>Images</h3>',
+     0, ('Images</h3>',), '7'),
+    ('image_number',
+     r'<!--\[--><span>\(\d+\)</span><!--\]-->',
+     0, ('<!--[--><span>(',), '7'),
+]
+
+# Étape 8 : Lignes (séparées par <br>) supprimées si leur texte, avec ou
+# sans balises HTML, correspond à l'un de ces patterns (insensible à la casse)
+LINE_RULES = [
+    ('counter', r'^\d+\s+of\s+\d+\s+metas?\s*$'),
+    ('heart', r'^♥\s*\d+\s*$'),
+    ('nav', r'^[<>\s]+$'),
+    ('check_out', r'^Check out(?=(?P<check_out_space>\s+))(?P=check_out_space).*?for more clues\.\s*$'),
+    ('description', r'^Description and images taken from:.*$'),
+    ('images_title', r'^Images\s*$'),
+    ('image_number', r'^\(\d+\)\s*$'),
+    ('source', r'^Source\s*:\s*.*$'),
+    ('for_more_info', r'^For more info,\s*check.*$'),
+]
+
+# <br> multiples consécutifs (plus de 2)
+MULTIPLE_BR_RE = re.compile(r'(<br>\s*){3,}')
+
+# Nombre de notes lues et écrites par lot dans clean_cards
+BATCH_SIZE = 1000
+
+# Taille maximale (Mo, dans l'archive) d'une base chargée en mémoire plutôt
+# qu'extraite sur disque
+DEFAULT_IN_MEMORY_MAX_MB = 256
+
+# Version du cache de notes : à incrémenter si le code de nettoyage change
+# sans que les règles (BLOCK_RULES, LINE_RULES) ne changent
+CACHE_VERSION = 2
+
+# Taille (caractères) au-delà de laquelle le champ Answer est laissé tel quel :
+# le module re ne peut pas interrompre une recherche, ce garde-fou borne le
+# temps passé sur un champ anormal (HTML collé par erreur, fichier entier...)
+MAX_FIELD_CHARS = 1_000_000
+
+# Durée (secondes) de nettoyage au-delà de laquelle un champ est compté comme lent
+SLOW_FIELD_SECONDS = 1.0
+
+
+def fingerprint(*parts):
+    """
+    Calcule une empreinte stable de données (règles, configuration, champs)
+    
+    Args:
+        parts: Valeurs sérialisables en JSON
+        
+    Returns:
+        Empreinte hexadécimale (BLAKE2b, 128 bits)
+    """
+    data = json.dumps(parts, ensure_ascii=False, sort_keys=True).encode('utf-8')
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+class TagMatcher:
+    r"""
+    Moteur de détection des tags, construit une seule fois depuis tags_config.txt
+
+    Les patterns littéraux (\bmot\b, \bla paz\b...) sont indexés par leur
+    premier mot : un seul découpage du texte en mots suffit pour tous les
+    trouver. Les autres patterns sont compilés une fois et fusionnés en une
+    seule regex par tag.
+    """
+
+    def __init__(self, tags_config):
+        """
+        Compile la configuration des tags
+
+        Args:
+            tags_config: Dictionnaire {tag: [liste de patterns]} (cf. load_tags_config)
+        """
+        self.tags = list(tags_config)
+        self.invalid_patterns = []
+        # {premier mot: [(tag, expression complète)]}
+        self.keywords = {}
+        # {tag: [regex compilées]} pour les patterns non littéraux
+        self.regexes = {}
+
+        for tag, patterns in tags_config.items():
+            sources = []
+            for pattern in patterns:
+                try:
+                    re.compile(pattern)
+                except re.error as e:
+                    self.invalid_patterns.append((tag, pattern, str(e)))
+                    continue
+
+                phrase = self._literal_phrase(pattern)
+                if phrase is not None:
+                    head = WORD_RE.match(phrase).group()
+                    self.keywords.setdefault(head, []).append((tag, phrase))
+                else:
+                    sources.append(pattern)
+
+            if sources:
+                self.regexes[tag] = self._combine(sources)
+
+        for tag, pattern, error in self.invalid_patterns:
+            print(f"⚠️  Pattern invalide ignoré dans [{tag}] : {pattern} ({error})")
+
+    @staticmethod
+    def _literal_phrase(pattern):
+        r"""
+        Retourne l'expression littérale d'un pattern \b...\b, ou None
+
+        Le texte doit commencer et finir par un caractère de mot pour que les
+        frontières \b correspondent exactement à des débuts/fins de mots.
+        """
+        match = LITERAL_PATTERN_RE.fullmatch(pattern)
+        if not match:
+            return None
+        phrase = match.group(1)
+        if not WORD_RE.fullmatch(phrase[-1]):
+            return None
+        return phrase
+
+    @staticmethod
+    def _combine(sources):
+        """
+        Fusionne les patterns d'un tag en une seule regex
+
+        Si la fusion échoue (références arrière, flags inline, groupes nommés
+        en double...), les patterns sont gardés séparément.
+        """
+        try:
+            return [re.compile('|'.join(f'(?:{source})' for source in sources))]
+        except re.error:
+            return [re.compile(source) for source in sources]
+
+    def detect(self, text, stats=None):
+        """
+        Détecte les tags correspondant au texte
+
+        Args:
+            text: Le texte à analyser (nom de la carte + contenu)
+            stats: ProcessStats pour mesurer chaque tag (None = pas de mesure).
+                   Le temps de l'index des mots est compté dans 'tags:mots-clés'
+
+        Returns:
+            Liste de tags détectés, dans l'ordre de la configuration
+        """
+        # Normaliser le texte (minuscules, sans HTML)
+        text_clean = strip_html_tags(text.lower())
+
+        if stats is not None:
+            started = time.perf_counter()
+        found = set()
+        for word in WORD_RE.finditer(text_clean):
+            candidates = self.keywords.get(word.group())
+            if not candidates:
+                continue
+            start = word.start()
+            for tag, phrase in candidates:
+                if tag in found:
+                    continue
+                end = start + len(phrase)
+                if end == word.end() or (
+                        text_clean.startswith(phrase, start)
+                        and (end == len(text_clean) or not WORD_RE.match(text_clean, end))):
+                    found.add(tag)
+
+        if stats is not None:
+            stats.rule('tags:mots-clés', time.perf_counter() - started, len(found))
+            for tag in found:
+                stats.rule(f'tag:{tag}', hits=1)
+
+        detected_tags = []
+        for tag in self.tags:
+            if tag not in found:
+                regexes = self.regexes.get(tag)
+                if not regexes:
+                    continue
+                if stats is None:
+                    matched = any(regex.search(text_clean) for regex in regexes)
+                else:
+                    started = time.perf_counter()
+                    matched = any(regex.search(text_clean) for regex in regexes)
+                    stats.rule(f'tag:{tag}', time.perf_counter() - started, int(matched))
+                if not matched:
+                    continue
+            detected_tags.append(tag)
+
+        return detected_tags
+
+
+class CleanupRules:
+    """
+    Règles de nettoyage du champ Answer, compilées une seule fois
+
+    Construit à partir de BLOCK_RULES et LINE_RULES. Les champs qui ne
+    contiennent aucun des textes d'une règle ne passent jamais par sa regex.
+    """
+
+    # Correspondance entre flags re et flags inline pour la fusion des règles
+    INLINE_FLAGS = ((re.DOTALL, 's'), (re.IGNORECASE, 'i'))
+
+    def __init__(self, block_rules=BLOCK_RULES, line_rules=LINE_RULES):
+        """
+        Compile les règles de nettoyage
+
+        Args:
+            block_rules: Règles appliquées sur tout le champ (cf. BLOCK_RULES)
+            line_rules: Règles appliquées ligne par ligne (cf. LINE_RULES)
+        """
+        # Règles groupées par étape, dans l'ordre d'application :
+        # [[(nom, regex, fragment, textes, ignorecase, regex du début ou None)]]
+        self.groups = []
+        current_step = None
+        for name, pattern, flags, literals, step in block_rules:
+            if step != current_step:
+                self.groups.append([])
+                current_step = step
+            ignorecase = bool(flags & re.IGNORECASE)
+            if ignorecase:
+                literals = tuple(literal.lower() for literal in literals)
+            head = None
+            if isinstance(pattern, (tuple, list)):
+                head = re.compile(pattern[0], flags)
+                pattern = ''.join(pattern)
+            self.groups[-1].append(
+                (name, re.compile(pattern, flags), self._scoped(pattern, flags), literals, ignorecase, head))
+        for rules in self.groups:
+            if len(rules) > 1 and any(rule[5] for rule in rules):
+                raise ValueError(f"Règle en deux parties non seule dans son étape : {rules[0][0]}")
+
+        # Regex fusionnées par combinaison de règles actives
+        self._fused = {}
+        for rules in self.groups:
+            self._fused_regex(rules)
+
+        # Un groupe nommé par règle : match.lastgroup donne la règle appliquée
+        self.line_regex = re.compile(
+            '|'.join(f'(?P<{name}>{pattern})' for name, pattern in line_rules), re.IGNORECASE)
+        
+        # Empreinte des règles, pour invalider le cache des notes si elles changent
+        self.fingerprint = fingerprint(CACHE_VERSION, block_rules, line_rules)
+
+    @classmethod
+    def _scoped(cls, pattern, flags):
+        """Encapsule un pattern avec ses flags inline pour pouvoir le fusionner"""
+        inline = ''.join(letter for flag, letter in cls.INLINE_FLAGS if flags & flag)
+        return f'(?{inline}:{pattern})' if inline else f'(?:{pattern})'
+
+    @staticmethod
+    def _sub_from_head(rule, text):
+        """
+        Applique une règle en deux parties (début, suite), cf. BLOCK_RULES
+
+        Même résultat que rule[1].subn('', text) : la regex complète n'est
+        essayée qu'au premier début trouvé, et si elle échoue aucun début
+        suivant ne peut réussir.
+
+        Args:
+            rule: Règle compilée (cf. CleanupRules.groups)
+            text: Le texte à nettoyer
+
+        Returns:
+            Tuple (texte nettoyé, nombre de blocs supprimés)
+        """
+        regex, head = rule[1], rule[5]
+        parts = []
+        pos = 0
+        while True:
+            start = head.search(text, pos)
+            if start is None:
+                break
+            match = regex.match(text, start.start())
+            if match is None:
+                break
+            parts.append(text[pos:match.start()])
+            pos = match.end()
+        if not parts:
+            return text, 0
+        parts.append(text[pos:])
+        return ''.join(parts), len(parts) - 1
+
+    def _fused_regex(self, rules):
+        """Retourne la regex fusionnée pour une liste de règles (mise en cache)"""
+        if len(rules) == 1:
+            return rules[0][1]
+        key = tuple(rule[0] for rule in rules)
+        regex = self._fused.get(key)
+        if regex is None:
+            regex = re.compile('|'.join(rule[2] for rule in rules))
+            self._fused[key] = regex
+        return regex
+
+    def clean(self, text, stats=None):
+        """
+        Supprime les blocs et les lignes indésirables dans le texte
+
+        Args:
+            text: Le texte à nettoyer
+            stats: ProcessStats pour mesurer chaque règle (None = pas de mesure).
+                   Les règles de ligne partagent une seule regex : leur temps
+                   est compté dans 'lignes', leurs correspondances par règle
+
+        Returns:
+            Le texte nettoyé
+        """
+        # Étapes 1 à 7 : blocs, en ignorant les règles dont les textes sont absents
+        text_lower = None
+        for rules in self.groups:
+            active = []
+            for rule in rules:
+                haystack = text
+                if rule[4]:
+                    if text_lower is None:
+                        text_lower = text.lower()
+                    haystack = text_lower
+                if all(literal in haystack for literal in rule[3]):
+                    active.append(rule)
+            if not active:
+                continue
+            if active[0][5] is not None:
+                # Règle en deux parties, seule dans son étape
+                if stats is not None:
+                    start = time.perf_counter()
+                text, hits = self._sub_from_head(active[0], text)
+                if stats is not None:
+                    stats.rule('bloc:' + active[0][0], time.perf_counter() - start, hits)
+            elif stats is None:
+                text = self._fused_regex(active).sub('', text)
+            else:
+                # Règles appliquées une par une pour mesurer chacune : même
+                # résultat, les règles d'une étape étant indépendantes
+                for rule in active:
+                    start = time.perf_counter()
+                    text, hits = rule[1].subn('', text)
+                    stats.rule('bloc:' + rule[0], time.perf_counter() - start, hits)
+            text_lower = None
+
+        # Étape 8 : Nettoyer ligne par ligne pour les éléments restants
+        if stats is not None:
+            start = time.perf_counter()
+        line_match = self.line_regex.match
+        cleaned_lines = []
+        lines = text.split('<br>')
+        for line in lines:
+            raw_stripped = line.strip()
+            clean_line = strip_html_tags(line).strip() if '<' in line else raw_stripped
+
+            match = clean_line and line_match(clean_line)
+            if not match and raw_stripped and raw_stripped != clean_line:
+                match = line_match(raw_stripped)
+            if match:
+                if stats is not None:
+                    stats.rule('ligne:' + match.lastgroup, hits=1, calls=0)
+                continue
+            cleaned_lines.append(line)
+        if stats is not None:
+            stats.rule('lignes', time.perf_counter() - start, len(lines) - len(cleaned_lines))
+
+        result = '<br>'.join(cleaned_lines)
+
+        # Nettoyer les <br> multiples consécutifs (plus de 2)
+        if '<br>' in result:
+            result = MULTIPLE_BR_RE.sub('<br><br>', result)
+
+        return result
+
+
+class NoteCache:
+    """
+    Cache sur disque des résultats du nettoyage, par note
+    
+    Pour chaque note : empreinte des champs, champ Answer nettoyé et tags
+    détectés, avec les empreintes des règles utilisées. Un changement de
+    tags_config.txt n'invalide que les tags, pas le nettoyage.
+    """
+    
+    def __init__(self, path, clean_fingerprint, tags_fingerprint):
+        """
+        Ouvre (ou crée) le cache
+        
+        Args:
+            path: Chemin du fichier de cache (SQLite)
+            clean_fingerprint: Empreinte des règles de nettoyage actives
+            tags_fingerprint: Empreinte de la configuration des tags active
+        """
+        self.path = Path(path)
+        self.clean_fingerprint = clean_fingerprint
+        self.tags_fingerprint = tags_fingerprint
+        
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute("PRAGMA synchronous = OFF")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS notes ("
+            "id INTEGER PRIMARY KEY, fields_hash TEXT, "
+            "clean_hash TEXT, cleaned_answer TEXT, "
+            "tags_hash TEXT, detected_tags TEXT)")
+    
+    def lookup(self, note_ids):
+        """
+        Récupère les résultats en cache d'un lot de notes
+        
+        Args:
+            note_ids: Identifiants des notes
+            
+        Returns:
+            Dictionnaire {id: (empreinte des champs, Answer nettoyé ou None,
+            tags détectés ou None)}, seulement pour les résultats encore valides
+        """
+        cached = {}
+        for start in range(0, len(note_ids), 500):
+            chunk = note_ids[start:start + 500]
+            rows = self.conn.execute(
+                "SELECT id, fields_hash, clean_hash, cleaned_answer, tags_hash, detected_tags "
+                f"FROM notes WHERE id IN ({','.join('?' * len(chunk))})", chunk)
+            for note_id, fields_hash, clean_hash, answer, tags_hash, detected in rows:
+                if clean_hash != self.clean_fingerprint:
+                    continue
+                if tags_hash != self.tags_fingerprint:
+                    detected = None
+                else:
+                    detected = detected.split()
+                cached[note_id] = (fields_hash, answer, detected)
+        return cached
+    
+    def store(self, rows):
+        """
+        Enregistre les résultats d'un lot de notes
+        
+        Args:
+            rows: Liste de tuples (id, empreinte des champs, Answer nettoyé, tags détectés)
+        """
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO notes VALUES (?, ?, ?, ?, ?, ?)",
+            [(note_id, fields_hash, self.clean_fingerprint, answer,
+              self.tags_fingerprint, ' '.join(detected))
+             for note_id, fields_hash, answer, detected in rows])
+    
+    def close(self):
+        """Sauvegarde et ferme le cache"""
+        self.conn.commit()
+        self.conn.close()
+
 
 class AnkiDeckCleaner:
     """Classe pour nettoyer les decks Anki"""
     
-    def __init__(self, input_file):
+    def __init__(self, input_file, workers=1, compress_level=DEFAULT_COMPRESS_LEVEL,
+                 cache_file=None, detailed_stats=False, temp_base=None,
+                 in_memory_max_mb=DEFAULT_IN_MEMORY_MAX_MB, dedup_media=False):
         """
         Initialise le nettoyeur de deck
         
         Args:
             input_file: Chemin vers le fichier .apkg à nettoyer
+            workers: Nombre de processus pour nettoyer les notes (1 = pas de parallélisme)
+            compress_level: Niveau de compression de la base dans le fichier de sortie (0-9)
+            cache_file: Fichier de cache des notes déjà nettoyées (None = pas de cache)
+            detailed_stats: True pour mesurer chaque règle de nettoyage et chaque tag
+                            (plus lent, cf. self.stats.rules)
+            temp_base: Dossier où créer le dossier temporaire de ce traitement
+                       (None = dossier temporaire du système, ex: /dev/shm pour
+                       travailler en RAM)
+            in_memory_max_mb: Les bases jusqu'à cette taille sont nettoyées en
+                              mémoire, sans fichier temporaire (0 = jamais)
+            dedup_media: True pour ne garder qu'une copie des médias en double
+                         (cf. deduplicate_media)
         """
         self.input_file = Path(input_file)
-        self.temp_dir = Path("temp_anki_deck")
+        self.workers = max(1, workers)
+        self.compress_level = compress_level
+        self.cache_file = cache_file
+        self.temp_base = temp_base
+        self.in_memory_max_mb = in_memory_max_mb
+        self.dedup_media = dedup_media
+        self.media_dedup = None
+        self.temp_dir = None
         self.db_path = None
+        self.db_name = None
+        self.db_data = None
+        self.cleanup_rules = CleanupRules()
+        self.detailed_stats = detailed_stats
+        self.stats = ProcessStats()
         
         # Vérifier que le fichier existe
         if not self.input_file.exists():
             raise FileNotFoundError(f"Le fichier {input_file} n'existe pas")
     
+    @classmethod
+    def for_worker(cls, cleanup_rules, tags_config, tag_matcher, detailed_stats):
+        """
+        Crée un nettoyeur de notes pour un processus de _clean_batches_parallel
+        
+        Les règles viennent du processus principal, déjà compilées et
+        validées : pas de vérification du deck ni de message (les patterns
+        invalides ne sont signalés qu'une fois, par le processus principal).
+        
+        Args:
+            cleanup_rules: CleanupRules du processus principal
+            tags_config: Configuration des tags (cf. load_tags_config)
+            tag_matcher: TagMatcher construit depuis tags_config
+            detailed_stats: True pour mesurer chaque règle et chaque tag
+            
+        Returns:
+            Nettoyeur limité à clean_batch et clean_note
+        """
+        cleaner = cls.__new__(cls)
+        cleaner.cleanup_rules = cleanup_rules
+        cleaner.tags_config = tags_config
+        cleaner.tag_matcher = tag_matcher
+        cleaner.detailed_stats = detailed_stats
+        cleaner.stats = ProcessStats()
+        return cleaner
+    
+    def default_cache_path(self):
+        """Chemin du cache par défaut : à côté du deck (mon_deck.cleaner_cache)"""
+        return self.input_file.with_name(self.input_file.stem + ".cleaner_cache")
+    
     def extract_apkg(self):
-        """Extrait le contenu du fichier .apkg dans un dossier temporaire"""
+        """
+        Extrait la base de données du fichier .apkg
+        
+        Seule la base est extraite : les médias, que le nettoyeur ne modifie
+        pas, sont recopiés directement de l'archive d'origine à la création
+        du fichier nettoyé. Les petites bases (cf. in_memory_max_mb) sont
+        gardées en mémoire (self.db_data), les autres sont extraites dans un
+        dossier temporaire propre à ce traitement : plusieurs nettoyages
+        peuvent tourner en même temps.
+        """
         print(f"📦 Extraction de {self.input_file.name}...")
         
-        # Créer le dossier temporaire
-        if self.temp_dir.exists():
-            shutil.rmtree(self.temp_dir)
-        self.temp_dir.mkdir()
+        # Créer un dossier temporaire unique
+        self.temp_dir = Path(tempfile.mkdtemp(prefix="anki_deck_", dir=self.temp_base))
         
-        # Extraire le fichier ZIP
+        # Trouver le fichier de base de données
+        # Essayer d'abord anki21b (format récent, compressé en zstd), puis anki21, puis anki2
         with zipfile.ZipFile(self.input_file, 'r') as zip_ref:
-            zip_ref.extractall(self.temp_dir)
+            names = set(zip_ref.namelist())
+            media_count = len(read_media_map(zip_ref))
+            db_name = find_database(names)
+            if db_name is None:
+                raise FileNotFoundError("Base de données Anki non trouvée (ni .anki21b, ni .anki21, ni .anki2)")
+            
+            # sqlite3 sait charger une base depuis la mémoire depuis Python 3.11
+            in_memory = (hasattr(sqlite3.Connection, 'deserialize') and
+                         zip_ref.getinfo(db_name).file_size <= self.in_memory_max_mb * 1024 * 1024)
+            if in_memory:
+                self.db_data = zip_ref.read(db_name)
         
-        # Trouver le fichier de base de données
-        # Essayer d'abord anki21 (format plus récent)
-        self.db_path = self.temp_dir / "collection.anki21"
-        if not self.db_path.exists():
-            # Sinon essayer anki2 (ancien format)
-            self.db_path = self.temp_dir / "collection.anki2"
+        self.db_name = db_name
+        if in_memory:
+            if db_name in ZSTD_DB_NAMES:
+                self.db_data = load_zstd().ZstdDecompressor().stream_reader(self.db_data).read()
+            print(f"✅ Base de données trouvée : {self.db_name} (chargée en mémoire, "
+                  f"{media_count} médias recopiés tels quels)")
+            return
         
-        if not self.db_path.exists():
-            raise FileNotFoundError("Base de données Anki non trouvée (ni .anki21 ni .anki2)")
+        if db_name in ZSTD_DB_NAMES:
+            # Décompresser la base à la volée dans un fichier SQLite temporaire
+            self.db_path = self.temp_dir / (db_name + ".sqlite")
+            extract_entry(self.input_file, db_name, self.db_path, decompress=True)
+        else:
+            self.db_path = self.temp_dir / db_name
+            extract_entry(self.input_file, db_name, self.db_path)
         
-        print(f"✅ Base de données trouvée : {self.db_path.name}")
+        print(f"✅ Base de données trouvée : {self.db_name} ({media_count} médias, recopiés tels quels)")
     
     def load_tags_config(self, config_file='tags_config.txt'):
         """
@@ -119,185 +728,352 @@ class AnkiDeckCleaner:
         Returns:
             Liste de tags détectés
         """
-        import re
-        
-        # Charger la configuration si pas déjà chargée
+        # Charger et compiler la configuration si pas déjà fait
         if not hasattr(self, 'tags_config'):
             self.tags_config = self.load_tags_config()
+        if not hasattr(self, 'tag_matcher'):
+            self.tag_matcher = TagMatcher(self.tags_config)
         
-        # Si pas de configuration, retourner une liste vide
-        if not self.tags_config:
-            return []
+        return self.tag_matcher.detect(text, self.stats if self.detailed_stats else None)
+    
+    def clean_note(self, fields, existing_tags, cached=None):
+        """
+        Nettoie et tague une note
         
-        # Normaliser le texte (minuscules, sans HTML)
-        text_lower = text.lower()
-        text_clean = re.sub(r'<[^>]+>', '', text_lower)
+        Args:
+            fields: Champs de la note, séparés par '\x1f'
+            existing_tags: Tags actuels de la note (séparés par des espaces)
+            cached: Tuple (Answer nettoyé ou None, tags détectés ou None)
+                    issu du cache, pour ne pas refaire ce travail
+            
+        Returns:
+            Tuple (nouveaux champs, nouveaux tags, Answer nettoyé, tags détectés)
+        """
+        cleaned_answer, detected_tags = cached or (None, None)
         
-        detected_tags = []
+        # Les champs sont séparés par '\x1f' dans Anki
+        field_list = fields.split('\x1f')
         
-        # Détecter les tags basés sur les patterns de la configuration
-        for tag, patterns in self.tags_config.items():
-            for pattern in patterns:
-                try:
-                    if re.search(pattern, text_clean):
-                        if tag not in detected_tags:
-                            detected_tags.append(tag)
-                        break  # Pas besoin de vérifier les autres patterns pour ce tag
-                except re.error:
-                    # Pattern regex invalide, on l'ignore
-                    continue
-        
-        return detected_tags
-    
-    def clean_cards(self):
-        """Nettoie les cartes en supprimant les lignes indésirables"""
-        print("🧹 Nettoyage des cartes...")
+        # Ne nettoyer que le DERNIER champ (généralement le champ "answer")
+        # Cela fonctionne que la carte ait 2, 3 ou plus de champs
+        if cleaned_answer is None:
+            answer = field_list[-1]
+            if len(answer) > MAX_FIELD_CHARS:
+                # Champ anormalement long : laissé tel quel (cf. MAX_FIELD_CHARS)
+                cleaned_answer = answer
+                self.stats.count('fields_too_large')
+            else:
+                start = time.perf_counter()
+                cleaned_answer = self.remove_unwanted_lines(answer)
+                elapsed = time.perf_counter() - start
+                self.stats.add_time('clean', elapsed)
+                if elapsed > SLOW_FIELD_SECONDS:
+                    self.stats.count('slow_fields')
+        new_fields = '\x1f'.join(field_list[:-1] + [cleaned_answer])
         
-        # Connexion à la base de données SQLite
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        # Détecter les tags automatiquement
+        # Analyser le premier champ (nom) + dernier champ (answer) pour plus de précision
+        if detected_tags is None:
+            start = time.perf_counter()
+            text_to_analyze = field_list[0] + " " + cleaned_answer
+            detected_tags = self.detect_tags(text_to_analyze)
+            self.stats.add_time('tag', time.perf_counter() - start)
         
-        # Récupérer toutes les notes
-        cursor.execute("SELECT id, flds, tags FROM notes")
-        notes = cursor.fetchall()
+        # Combiner avec les tags existants (sans doublons, dans un ordre stable
+        # pour que le résultat ne dépende pas du processus qui nettoie la note)
+        all_tags = dict.fromkeys(existing_tags.split())
+        all_tags.update(dict.fromkeys(detected_tags))
+        new_tags = ' '.join(all_tags)
         
-        cleaned_count = 0
+        return new_fields, new_tags, cleaned_answer, detected_tags
+    
+    def clean_batch(self, notes, sort_fields, mod, cached=None):
+        """
+        Nettoie un lot de notes
         
-        for note_id, fields, existing_tags in notes:
-            # Les champs sont séparés par '\x1f' dans Anki
-            field_list = fields.split('\x1f')
-            
-            # Ne nettoyer que le DERNIER champ (généralement le champ "answer")
-            # Cela fonctionne que la carte ait 2, 3 ou plus de champs
-            cleaned_fields = []
-            for i, field in enumerate(field_list):
-                if i == len(field_list) - 1:  # Dernier champ = answer
-                    cleaned_field = self.remove_unwanted_lines(field)
-                    cleaned_fields.append(cleaned_field)
-                else:
-                    # Garder les autres champs intacts
-                    cleaned_fields.append(field)
+        Args:
+            notes: Liste de tuples (id, id du type de note, champs, tags)
+            sort_fields: Dictionnaire {id du type de note: index du champ de tri}
+            mod: Horodatage de modification à enregistrer
+            cached: Résultats en cache du lot (cf. NoteCache.lookup), None sans cache
             
-            # Reconstituer les champs
-            new_fields = '\x1f'.join(cleaned_fields)
+        Returns:
+            Tuple (mises à jour, lignes de cache) :
+            - mises à jour (champs, tags, mod, sfld, csum, id) pour les notes
+              modifiées, dans l'ordre du lot
+            - lignes à enregistrer dans le cache (cf. NoteCache.store)
+        """
+        updates = []
+        cache_rows = []
+        for note_id, mid, fields, existing_tags in notes:
+            note_cache = None
+            if cached is not None:
+                fields_hash = fingerprint(fields)
+                entry = cached.get(note_id)
+                if entry is not None and entry[0] == fields_hash:
+                    note_cache = entry[1:]
             
-            # Détecter les tags automatiquement
-            # Analyser le premier champ (nom) + dernier champ (answer) pour plus de précision
-            text_to_analyze = field_list[0] + " " + cleaned_fields[-1]
-            detected_tags = self.detect_tags(text_to_analyze)
+            new_fields, new_tags, cleaned_answer, detected_tags = self.clean_note(
+                fields, existing_tags, note_cache)
             
-            # Combiner avec les tags existants
-            existing_tags_list = existing_tags.strip().split() if existing_tags.strip() else []
-            all_tags = list(set(existing_tags_list + detected_tags))  # Éliminer les doublons
-            new_tags = ' '.join(all_tags)
+            if cached is not None:
+                if note_cache is None or None in note_cache:
+                    cache_rows.append((note_id, fields_hash, cleaned_answer, detected_tags))
+                else:
+                    self.stats.count('notes_from_cache')
             
             # Mettre à jour si des modifications ont été faites
             if new_fields != fields or new_tags != existing_tags:
-                cursor.execute("UPDATE notes SET flds = ?, tags = ? WHERE id = ?", 
-                             (new_fields, new_tags, note_id))
-                cleaned_count += 1
-        
-        # Sauvegarder les modifications
-        conn.commit()
-        conn.close()
-        
-        print(f"✅ {cleaned_count} cartes nettoyées et taguées")
+                field_list = new_fields.split('\x1f')
+                sort_index = sort_fields.get(mid, 0)
+                sort_field = field_list[sort_index] if sort_index < len(field_list) else ''
+                updates.append((new_fields, new_tags, mod,
+                                strip_html_media(sort_field),
+                                field_checksum(field_list[0]), note_id))
+        self.stats.count('notes_scanned', len(notes))
+        return updates, cache_rows
     
-    def remove_unwanted_lines(self, text):
+    def iter_note_batches(self, conn, batch_size, cache=None):
         """
-        Supprime les lignes indésirables dans le texte
+        Lit les notes par lots (pagination par id)
         
         Args:
-            text: Le texte à nettoyer
+            conn: Connexion à la base de données
+            batch_size: Nombre de notes par lot
+            cache: NoteCache dont lire les résultats de chaque lot (optionnel)
             
-        Returns:
-            Le texte nettoyé
+        Yields:
+            Tuples (liste de tuples (id, id du type de note, champs, tags),
+            résultats en cache du lot ou None)
         """
-        import re
+        with self.stats.timer('db_read'):
+            notes = conn.execute(
+                "SELECT id, mid, flds, tags FROM notes ORDER BY id LIMIT ?",
+                (batch_size,)).fetchall()
+        while notes:
+            cached = None
+            if cache:
+                with self.stats.timer('cache'):
+                    cached = cache.lookup([note[0] for note in notes])
+            yield notes, cached
+            with self.stats.timer('db_read'):
+                notes = conn.execute(
+                    "SELECT id, mid, flds, tags FROM notes WHERE id > ? ORDER BY id LIMIT ?",
+                    (notes[-1][0], batch_size)).fetchall()
+    
+    def clean_cards(self, batch_size=BATCH_SIZE):
+        """
+        Nettoie les cartes en supprimant les lignes indésirables
         
-        # Étape 1 : Supprimer le bloc d'en-tête complet s'il existe
-        # Pattern générique qui fonctionne pour tous les titres (A Learnable X, Learnable X, Ultimate X, etc.)
-        header_block_pattern = r'(?:<div>)+<div><h1>[^<]+</h1>.*?Play Map.*?</a><!--\]--><!--[^>]*--></div></div>'
-        text = re.sub(header_block_pattern, '', text, flags=re.DOTALL)
+        Les notes sont lues et mises à jour par lots de batch_size, dans une
+        seule transaction : la mémoire reste stable quelle que soit la taille
+        du deck. Avec plusieurs workers, les lots sont nettoyés en parallèle
+        et écrits dans l'ordre par ce processus.
         
-        # Étape 2 : Supprimer les divs avec compteurs (ex: <div>4 of 102 metas</div>)
-        counter_div_pattern = r'<!--\[--><div>\d+\s+of\s+\d+\s+metas?</div><!--\]-->'
-        text = re.sub(counter_div_pattern, '', text)
+        Avec un cache (cache_file), les notes dont les champs et les règles
+        n'ont pas changé depuis le dernier lancement ne sont pas retraitées.
         
-        # Étape 3 : Supprimer le bouton avec cœur et compteur
-        # Pattern : <button ... ><div>...<svg avec heart>... <span>3</span></div>...</button>
-        heart_button_pattern = r'<button[^>]*data-tooltip-trigger[^>]*>.*?<path[^>]*d="M12 12q\.825.*?</button><!--\]-->'
-        text = re.sub(heart_button_pattern, '', text, flags=re.DOTALL)
+        La base nettoyée est une copie (extraite ou en mémoire), sans journal :
+        en cas d'erreur, le ROLLBACK ne restaure pas les notes déjà écrites,
+        mais la copie est abandonnée et le fichier de sortie n'est pas créé.
         
-        # Étape 4 : Supprimer les boutons de navigation (< et >) 
-        # Pattern simple pour tous les boutons avec data-slot="button"
-        nav_button_pattern = r'<button data-slot="button"[^>]*>.*?</button>'
-        text = re.sub(nav_button_pattern, '', text, flags=re.DOTALL)
+        Args:
+            batch_size: Nombre de notes lues et écrites par lot
+        """
+        print("🧹 Nettoyage des cartes...")
         
-        # Étape 5 : Supprimer "Check out ... for more clues" avec lien
-        check_out_pattern = r'Check out\s+<a[^>]*>.*?</a>\s+for more clues\.'
-        text = re.sub(check_out_pattern, '', text, flags=re.DOTALL)
+        # Charger et compiler la configuration des tags une seule fois : les
+        # patterns invalides sont signalés ici, les workers reçoivent le résultat
+        with self.stats.timer('load_config'):
+            if not hasattr(self, 'tags_config'):
+                self.tags_config = self.load_tags_config()
+            if not hasattr(self, 'tag_matcher'):
+                self.tag_matcher = TagMatcher(self.tags_config)
         
-        # Étape 5b : Supprimer "Description and images taken from: [lien]"
-        description_pattern = r'Description and images taken from:\s+<a[^>]*>.*?</a>\.?'
-        text = re.sub(description_pattern, '', text, flags=re.DOTALL | re.IGNORECASE)
-
-        # Étape 5c : Supprimer "Source: [lien]" (ex: Source: PlonkIt)
-        source_pattern = r'<div>(?:<!--[^>]*-->)*<p>Source:\s*<a[^>]*>[^<]*</a></p>(?:<!--[^>]*-->)*</div>'
-        text = re.sub(source_pattern, '', text, flags=re.DOTALL | re.IGNORECASE)
-
-        # Étape 5d : Supprimer "For more info, check..." (ex: check out the UK Plonkit...)
-        for_more_info_pattern = r'For more info,\s*check[^<]*(?:<a[^>]*>[^<]*</a>[^<]*)*[^<]*\.?'
-        text = re.sub(for_more_info_pattern, '', text, flags=re.DOTALL | re.IGNORECASE)
-
-        # Étape 6 : Supprimer l'icône d'image (SVG avec path contenant "M5 21q-.825...")
-        # C'est le petit symbole d'image qui s'affiche
-        image_icon_pattern = r'<svg[^>]*>.*?<path d="M5 21q-.825 0-1\.412-.587T3 19V5.*?</svg><!--\]--><!-- -->'
-        text = re.sub(image_icon_pattern, '', text, flags=re.DOTALL)
+        cache = None
+        if self.cache_file is not None:
+            cache = NoteCache(self.cache_file, self.cleanup_rules.fingerprint,
+                              fingerprint(self.tags_config))
         
-        # Étape 7 : Supprimer "Images" et "(1)", "(2)", etc.
-        images_pattern = r'<h3[^>]*>Images</h3>|<!--\[--><span>\(\d+\)</span><!--\]-->'
-        text = re.sub(images_pattern, '', text)
+        # Connexion à la base de données SQLite
+        # La base est une copie extraite et jetable : pas besoin de journal
+        # ni de synchronisation disque. Sans journal, le ROLLBACK n'annule
+        # rien de sûr : une erreur abandonne la copie, jamais réutilisée
+        in_memory = self.db_data is not None
+        if in_memory:
+            conn = sqlite3.connect(':memory:', isolation_level=None)
+            conn.deserialize(self.db_data)
+            self.db_data = None
+        else:
+            conn = sqlite3.connect(self.db_path, isolation_level=None)
+        conn.execute("PRAGMA journal_mode = OFF")
+        conn.execute("PRAGMA synchronous = OFF")
         
-        # Étape 8 : Nettoyer ligne par ligne pour les éléments restants
-        patterns_to_remove = [
-            r'^\d+\s+of\s+\d+\s+metas?\s*$',
-            r'^♥\s*\d+\s*$',
-            r'^[<>\s]+$',
-            r'^Check out\s+.*?for more clues\.\s*$',
-            r'^Description and images taken from:.*$',
-            r'^Images\s*$',
-            r'^\(\d+\)\s*$',
-            r'^Source\s*:\s*.*$',
-            r'^For more info,\s*check.*$',
-        ]
+        sort_fields = load_sort_fields(conn)
+        mod = int(time.time())
+        cleaned_count = 0
         
-        lines = text.split('<br>')
-        cleaned_lines = []
+        computed_count = 0
         
-        for line in lines:
-            clean_line = re.sub(r'<[^>]+>', '', line).strip()
-            raw_stripped = line.strip()
+        conn.execute("BEGIN")
+        try:
+            # Lots de notes, avec leurs résultats en cache
+            batches = self.iter_note_batches(conn, batch_size, cache)
+            if self.workers > 1:
+                results = self._clean_batches_parallel(batches, sort_fields, mod)
+            else:
+                results = (self.clean_batch(notes, sort_fields, mod, cached)
+                           for notes, cached in batches)
             
-            should_remove = False
+            for updates, cache_rows in results:
+                # mod/usn à jour pour qu'Anki prenne en compte les modifications à l'import
+                with self.stats.timer('db_write'):
+                    conn.executemany(
+                        "UPDATE notes SET flds = ?, tags = ?, mod = ?, usn = -1, sfld = ?, csum = ? "
+                        "WHERE id = ?", updates)
+                cleaned_count += len(updates)
+                if cache:
+                    with self.stats.timer('cache'):
+                        cache.store(cache_rows)
+                    computed_count += len(cache_rows)
             
-            for pattern in patterns_to_remove:
-                if clean_line and re.match(pattern, clean_line, re.IGNORECASE):
-                    should_remove = True
-                    break
-                if raw_stripped and re.match(pattern, raw_stripped, re.IGNORECASE):
-                    should_remove = True
-                    break
+            # Sauvegarder les modifications
+            with self.stats.timer('db_write'):
+                conn.execute("COMMIT")
+                if in_memory:
+                    self.db_data = conn.serialize()
+        except BaseException:
+            # Termine la transaction ; la copie, incomplète, est abandonnée
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+            if cache:
+                cache.close()
+        
+        self.stats.count('notes_changed', cleaned_count)
+        print(f"✅ {cleaned_count} cartes nettoyées et taguées")
+        too_large = self.stats.counters.get('fields_too_large', 0)
+        slow = self.stats.counters.get('slow_fields', 0)
+        if too_large or slow:
+            print(f"⚠️  {too_large} champs trop longs laissés tels quels (> {MAX_FIELD_CHARS} caractères), "
+                  f"{slow} champs lents (> {SLOW_FIELD_SECONDS:g} s)")
+        if cache:
+            print(f"   {computed_count} notes retraitées, les autres reprises du cache ({cache.path.name})")
+    
+    def _clean_batches_parallel(self, batches, sort_fields, mod):
+        """
+        Nettoie les lots dans un pool de processus
+        
+        Chaque processus reçoit une seule fois les règles déjà compilées et
+        validées par le processus principal (_init_worker).
+        Le nombre de lots en cours est borné pour garder la mémoire stable.
+        Les statistiques de chaque lot sont ajoutées à self.stats.
+        
+        Args:
+            batches: Itérateur de tuples (lot de notes, résultats en cache)
+            sort_fields: Dictionnaire {id du type de note: index du champ de tri}
+            mod: Horodatage de modification à enregistrer
             
-            if not should_remove:
-                cleaned_lines.append(line)
+        Yields:
+            Les résultats de chaque lot (cf. clean_batch), dans l'ordre de lecture
+        """
+        print(f"   {self.workers} processus en parallèle")
+        max_pending = self.workers * 2
         
-        result = '<br>'.join(cleaned_lines)
+        with ProcessPoolExecutor(
+                max_workers=self.workers,
+                initializer=_init_worker,
+                initargs=(type(self), self.cleanup_rules, self.tags_config,
+                          self.tag_matcher, self.detailed_stats)) as executor:
+            pending = deque()
+            for notes, cached in batches:
+                pending.append(executor.submit(
+                    _clean_batch_in_worker, notes, sort_fields, mod, cached))
+                if len(pending) >= max_pending:
+                    yield self._merge_worker_result(pending.popleft())
+            while pending:
+                yield self._merge_worker_result(pending.popleft())
+    
+    def _merge_worker_result(self, future):
+        """Attend le résultat d'un lot et ajoute ses statistiques à self.stats"""
+        updates, cache_rows, stats = future.result()
+        self.stats.merge(stats)
+        return updates, cache_rows
+    
+    def remove_unwanted_lines(self, text):
+        """
+        Supprime les lignes indésirables dans le texte
         
-        # Nettoyer les <br> multiples consécutifs (plus de 2)
-        result = re.sub(r'(<br>\s*){3,}', '<br><br>', result)
+        Args:
+            text: Le texte à nettoyer
+            
+        Returns:
+            Le texte nettoyé
+        """
+        return self.cleanup_rules.clean(text, self.stats if self.detailed_stats else None)
+    
+    def deduplicate_media(self):
+        """
+        Ne garde qu'une copie de chaque média en double (même contenu sous plusieurs noms)
         
-        return result
+        Les notes qui affichaient une copie retirée affichent celle qui est
+        gardée (cf. anki_apkg.dedup_media). Les changements de l'archive
+        sont gardés dans self.media_dedup pour create_cleaned_apkg.
+        """
+        print("♻️  Recherche des médias en double...")
+        if self.db_data is not None:
+            conn = sqlite3.connect(':memory:')
+            conn.deserialize(self.db_data)
+        else:
+            conn = sqlite3.connect(self.db_path)
+        try:
+            with zipfile.ZipFile(self.input_file, 'r') as zin:
+                self.media_dedup = dedup_media(zin, conn)
+            if self.media_dedup and self.db_data is not None:
+                self.db_data = conn.serialize()
+        finally:
+            conn.close()
+        
+        if self.media_dedup is None:
+            print("✅ Aucun média en double")
+            return
+        duplicates = self.media_dedup['duplicates']
+        bytes_saved = self.media_dedup['bytes_saved']
+        self.stats.count('media_duplicates', duplicates)
+        self.stats.count('media_bytes_saved', bytes_saved)
+        print(f"✅ {duplicates} médias en double retirés ({bytes_saved / 1024 / 1024:.1f} Mo gagnés)")
+    
+    def media_replacements(self):
+        """
+        Changements des médias de l'archive après deduplicate_media
+        
+        Returns:
+            Tuple (remplacements, renommages) (cf. rewrite_apkg)
+        """
+        if self.media_dedup is None:
+            return {}, None
+        return self.media_dedup['replacements'], self.media_dedup['renames']
+    
+    def database_replacement(self):
+        """
+        Base nettoyée, prête à remplacer l'originale dans l'archive
+        
+        Returns:
+            Dictionnaire {nom de la base: chemin du fichier ou bytes}
+            (cf. rewrite_apkg)
+        """
+        # Recompresser la base si le deck est au format anki21b
+        if self.db_data is not None:
+            db_file = self.db_data
+            if self.db_name in ZSTD_DB_NAMES:
+                db_file = load_zstd().ZstdCompressor().compress(db_file)
+        elif self.db_name in ZSTD_DB_NAMES:
+            db_file = self.temp_dir / self.db_name
+            compress_file(self.db_path, db_file)
+        else:
+            db_file = self.db_path
+        return {self.db_name: db_file}
     
     def create_cleaned_apkg(self, output_file=None):
         """
@@ -313,20 +1089,21 @@ class AnkiDeckCleaner:
         output_path = Path(output_file)
         print(f"📦 Création du fichier nettoyé : {output_path.name}...")
         
-        # Créer le fichier ZIP
-        with zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            # Ajouter tous les fichiers du dossier temporaire
-            for file_path in self.temp_dir.rglob('*'):
-                if file_path.is_file():
-                    arcname = file_path.relative_to(self.temp_dir)
-                    zipf.write(file_path, arcname)
+        # Copier l'archive d'origine en remplaçant seulement la base de données
+        # (et l'index des médias s'il y avait des doublons)
+        replacements = self.database_replacement()
+        media, renames = self.media_replacements()
+        replacements.update(media)
+        rewrite_apkg(self.input_file, output_path, replacements,
+                     compresslevel=self.compress_level, renames=renames)
         
         print(f"✅ Fichier créé : {output_path.absolute()}")
         return output_path
     
     def cleanup(self):
-        """Supprime les fichiers temporaires"""
-        if self.temp_dir.exists():
+        """Supprime les fichiers temporaires et libère la base en mémoire"""
+        self.db_data = None
+        if self.temp_dir is not None and self.temp_dir.exists():
             shutil.rmtree(self.temp_dir)
         print("🗑️  Fichiers temporaires supprimés")
     
@@ -334,6 +1111,8 @@ class AnkiDeckCleaner:
         """
         Processus complet de nettoyage
         
+        Les durées de chaque étape et les compteurs sont dans self.stats.
+        
         Args:
             output_file: Nom du fichier de sortie (optionnel)
             
@@ -341,31 +1120,107 @@ class AnkiDeckCleaner:
             Chemin vers le fichier nettoyé
         """
         try:
-            self.extract_apkg()
-            self.clean_cards()
-            output_path = self.create_cleaned_apkg(output_file)
+            with self.stats.timer('extract'):
+                self.extract_apkg()
+            with self.stats.timer('clean_cards'):
+                self.clean_cards()
+            if self.dedup_media:
+                with self.stats.timer('dedup_media'):
+                    self.deduplicate_media()
+            with self.stats.timer('repack'):
+                output_path = self.create_cleaned_apkg(output_file)
             return output_path
         finally:
-            self.cleanup()
+            with self.stats.timer('cleanup'):
+                self.cleanup()
+
+
+# Nettoyeur du processus courant, quand il sert de worker à clean_cards
+_worker_cleaner = None
+
+
+def _init_worker(cleaner_class, cleanup_rules, tags_config, tag_matcher, detailed_stats):
+    """Prépare un worker avec les règles de nettoyage et de tags du processus principal"""
+    global _worker_cleaner
+    _worker_cleaner = cleaner_class.for_worker(cleanup_rules, tags_config, tag_matcher, detailed_stats)
+
+
+def _clean_batch_in_worker(notes, sort_fields, mod, cached):
+    """Nettoie un lot de notes dans un worker, avec les statistiques du lot"""
+    _worker_cleaner.stats = ProcessStats()
+    updates, cache_rows = _worker_cleaner.clean_batch(notes, sort_fields, mod, cached)
+    return updates, cache_rows, _worker_cleaner.stats
 
 
 def main():
-    """Fonction principale"""
+    """
+    Fonction principale
+    
+    Returns:
+        Code de sortie (0 = succès, 1 = erreur)
+    """
+    parser = argparse.ArgumentParser(description="Nettoie et tague les cartes d'un deck Anki (.apkg)")
+    parser.add_argument('input_file', nargs='?',
+                        help="Fichier .apkg à nettoyer (demandé si absent)")
+    parser.add_argument('--output', metavar='FICHIER',
+                        help="Fichier de sortie (défaut : <nom>_cleaned.apkg)")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Nombre de processus pour nettoyer les notes (défaut : 1)")
+    parser.add_argument('--compress-level', type=int, default=DEFAULT_COMPRESS_LEVEL,
+                        choices=range(10), metavar='0-9',
+                        help=f"Niveau de compression de la base (défaut : {DEFAULT_COMPRESS_LEVEL})")
+    parser.add_argument('--cache', nargs='?', const='', metavar='FICHIER',
+                        help="Ne retraite que les notes modifiées depuis le dernier lancement "
+                             "(cache à côté du deck si FICHIER est omis)")
+    parser.add_argument('--temp-dir', metavar='DOSSIER',
+                        help="Dossier des fichiers temporaires (défaut : celui du système, "
+                             "ex: /dev/shm pour travailler en RAM)")
+    parser.add_argument('--in-memory-max', type=int, default=DEFAULT_IN_MEMORY_MAX_MB, metavar='MO',
+                        help="Nettoie en mémoire les bases jusqu'à cette taille "
+                             f"(défaut : {DEFAULT_IN_MEMORY_MAX_MB}, 0 = jamais)")
+    parser.add_argument('--dedup-media', action='store_true',
+                        help="Ne garde qu'une copie des médias en double (même contenu "
+                             "sous plusieurs noms) et met à jour les notes qui les affichent")
+    parser.add_argument('--stats', metavar='FICHIER',
+                        help="Mesure chaque étape, règle et tag, et écrit les statistiques en JSON")
+    parser.add_argument('--profile', metavar='FICHIER',
+                        help="Écrit un profil cProfile du traitement (ex: profil.prof)")
+    args = parser.parse_args()
+    
     print("=" * 60)
     print("🎴 ANKI DECK CLEANER")
     print("=" * 60)
     print()
     
     # Demander le fichier à l'utilisateur
-    input_file = input("📁 Entrez le chemin vers votre fichier .apkg : ").strip()
+    input_file = args.input_file
+    if input_file is None:
+        input_file = input("📁 Entrez le chemin vers votre fichier .apkg : ").strip()
     
     # Retirer les guillemets si présents
     input_file = input_file.strip('"').strip("'")
     
     try:
         # Créer le nettoyeur et traiter le deck
-        cleaner = AnkiDeckCleaner(input_file)
-        output_path = cleaner.process()
+        cleaner = AnkiDeckCleaner(input_file, workers=args.workers,
+                                  compress_level=args.compress_level,
+                                  detailed_stats=args.stats is not None,
+                                  temp_base=args.temp_dir,
+                                  in_memory_max_mb=args.in_memory_max,
+                                  dedup_media=args.dedup_media)
+        if args.cache is not None:
+            cleaner.cache_file = args.cache or cleaner.default_cache_path()
+        if args.profile:
+            output_path = run_profiled(args.profile, cleaner.process, args.output)
+        else:
+            output_path = cleaner.process(args.output)
+        
+        if args.stats:
+            cleaner.stats.write_json(args.stats)
+            print()
+            print(f"📊 Statistiques ({args.stats}) :")
+            for line in cleaner.stats.summary():
+                print(line)
         
         print()
         print("=" * 60)
@@ -375,6 +1230,7 @@ def main():
         print(f"Fichier nettoyé  : {output_path}")
         print()
         print("Vous pouvez maintenant importer le fichier nettoyé dans Anki.")
+        return 0
         
     except Exception as e:
         print()
@@ -385,11 +1241,13 @@ def main():
         print()
         import traceback
         traceback.print_exc()
+        return 1
 
 
 if __name__ == "__main__":
+    exit_code = 1
     try:
-        main()
+        exit_code = main()
     except Exception as e:
         print()
         print("=" * 60)
@@ -399,5 +1257,8 @@ if __name__ == "__main__":
         import traceback
         traceback.print_exc()
     finally:
-        print()
-        input("Appuyez sur Entrée pour fermer cette fenêtre...")
+        # Garder la fenêtre ouverte seulement en mode interactif (double-clic)
+        if len(sys.argv) == 1 and sys.stdin.isatty():
+            print()
+            input("Appuyez sur Entrée pour fermer cette fenêtre...")
+    sys.exit(exit_code)
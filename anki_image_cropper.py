@@ -8,24 +8,117 @@ Supporte: crop depuis une direction (droite/gauche/haut/bas) ou masquage d'un co
 import zipfile
 import shutil
 import os
+import sys
+import tempfile
+import argparse
+import copy
+import hashlib
+import json
+import math
+import time
+from collections import deque
 from pathlib import Path
 from io import BytesIO
 
-try:
-    import pillow_avif
-except ImportError:
-    print("Installation de pillow-avif-plugin...")
-    os.system("pip install pillow-avif-plugin")
-    import pillow_avif
+# Pillow, les codecs (AVIF, zstd), NumPy et concurrent.futures sont importes
+# a la demande : le script demarre vite, et seuls les formats presents dans
+# le deck sont charges
+from anki_apkg import (DEFAULT_COMPRESS_LEVEL, copy_entry_raw, database_bytes, dedup_media,
+                       find_database, load_zstd, read_database, read_media_map,
+                       referenced_media, rewrite_apkg, write_entry)
+from anki_stats import ProcessStats, peak_memory, reset_peak_memory, run_profiled
 
-try:
-    import zstandard as zstd
-except ImportError:
-    print("Installation de zstandard...")
-    os.system("pip install zstandard")
-    import zstandard as zstd
 
-from PIL import Image
+# Dossier par defaut du cache d'images (partage entre les decks)
+DEFAULT_CACHE_DIR = Path.home() / ".cache" / "anki_image_cropper"
+
+# Taille maximale par defaut du cache d'images, en Mo
+DEFAULT_CACHE_SIZE_MB = 1024
+
+
+class ImageCache:
+    """
+    Cache sur disque des images traitees, adresse par contenu
+
+    La cle combine le contenu de l'image source et les parametres du
+    traitement : une meme image traitee avec les memes reglages (dans ce
+    deck ou un autre, cette semaine ou la precedente) n'est encodee qu'une
+    fois. Au-dela de la taille maximale, les entrees les moins recemment
+    utilisees sont supprimees.
+    """
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_size_mb=DEFAULT_CACHE_SIZE_MB):
+        """
+        Args:
+            directory: Dossier du cache
+            max_size_mb: Taille maximale du cache, en Mo
+        """
+        self.directory = Path(directory)
+        self.max_bytes = max_size_mb * 1024 * 1024
+
+    def _entry_path(self, key):
+        """Chemin du fichier d'une entree (sous-dossier selon les 2 premiers caracteres)"""
+        return self.directory / key[:2] / key
+
+    def get(self, key, target):
+        """
+        Copie l'image en cache vers target, si elle existe
+
+        Returns:
+            True si l'image etait en cache
+        """
+        path = self._entry_path(key)
+        try:
+            shutil.copyfile(path, target)
+        except FileNotFoundError:
+            return False
+        # Marquer l'entree comme recemment utilisee (LRU) ; un autre
+        # processus a pu la supprimer entre-temps, la copie reste valide
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return True
+
+    def put(self, key, source):
+        """Ajoute une image traitee au cache (ecriture atomique, sure entre processus)"""
+        path = self._entry_path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f"{key}.{os.getpid()}.tmp")
+        shutil.copyfile(source, tmp_path)
+        os.replace(tmp_path, path)
+
+    def prune(self):
+        """
+        Supprime les entrees les moins recemment utilisees au-dela de la taille maximale
+
+        Returns:
+            Nombre d'entrees supprimees
+        """
+        if not self.directory.exists():
+            return 0
+
+        entries = []
+        total = 0
+        for path in self.directory.glob('*/*'):
+            if path.suffix == '.tmp':
+                # Ecriture en cours dans un autre processus
+                continue
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+
+        removed = 0
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+            removed += 1
+        return removed
 
 
 class AnkiImageCropper:
@@ -41,6 +134,12 @@ class AnkiImageCropper:
     DIR_TOP = "top"
     DIR_BOTTOM = "bottom"
 
+    # Resultats de process_image, et leur libelle dans la progression
+    IMAGE_OK = "ok"
+    IMAGE_SKIPPED = "skipped"
+    IMAGE_FAILED = "failed"
+    IMAGE_LABELS = {IMAGE_OK: "OK", IMAGE_SKIPPED: "IGNOREE", IMAGE_FAILED: "ECHEC"}
+
     # Coins pour masquage
     CORNER_TOP_LEFT = "top_left"
     CORNER_TOP_RIGHT = "top_right"
@@ -51,9 +150,52 @@ class AnkiImageCropper:
     COLOR_BLACK = "black"
     COLOR_WHITE = "white"
 
+    # Qualite d'encodage
+    JPEG_QUALITY = 85
+    AVIF_QUALITY = 80
+    WEBP_QUALITY = 80
+
+    # Formats possibles pour reencoder les images AVIF (plus rapides a encoder)
+    FORMAT_WEBP = "webp"
+    FORMAT_JPEG = "jpeg"
+
+    # Version du traitement : a incrementer si le rendu change, pour
+    # invalider le cache d'images
+    CACHE_VERSION = 2
+
+    # Images en cours de traitement par worker dans le pipeline (cf.
+    # stream_cropped_apkg) : assez pour que les workers n'attendent pas
+    # l'ecriture, peu pour borner la memoire et le dossier temporaire
+    PIPELINE_DEPTH = 2
+
+    # Taille d'un bloc DCT JPEG, en pixels
+    JPEG_BLOCK = 8
+
+    # Detection automatique de la mini-carte : taille de la miniature analysee
+    # (plus grand cote, en pixels) et taille de la mini-carte, en fraction de
+    # l'image (au-dela, les pourcentages fixes sont utilises)
+    AUTO_THUMB_SIZE = 256
+    AUTO_MIN_FRACTION = 0.05
+    AUTO_MAX_FRACTION = 0.6
+
+    # Lecture des images : taille des blocs lus dans l'archive, et taille
+    # au-dela de laquelle l'image decompressee passe de la memoire au disque
+    READ_CHUNK = 1024 * 1024
+    SPOOL_SIZE = 16 * 1024 * 1024
+
+    # Memoire de travail par pixel decode, en octets (cf. memory_budget_mb) :
+    # Pillow stocke un pixel RGB(A) sur 4 octets, et l'image decodee coexiste
+    # avec son resultat (crop, conversion d'une image en palette)
+    BYTES_PER_PIXEL = 8
+
     def __init__(self, input_file, mode=MODE_CROP, direction=DIR_RIGHT,
                  crop_percent=35, width_percent=35, height_percent=35,
-                 mask_color=COLOR_BLACK):
+                 mask_color=COLOR_BLACK, workers=1,
+                 compress_level=DEFAULT_COMPRESS_LEVEL, image_cache=None, temp_base=None,
+                 referenced_only=False, tags=None, decks=None, fields=None,
+                 png_compress_level=None, lossless_jpeg=True, avif_quality=AVIF_QUALITY,
+                 avif_speed=None, avif_codec="auto", avif_threads=None, transcode_avif=None,
+                 auto_detect=False, dedup_media=False, memory_budget_mb=None, max_size=None):
         """
         Initialise le cropper
 
@@ -66,6 +208,42 @@ class AnkiImageCropper:
             width_percent: Pourcentage de largeur du masque (pour mode mask)
             height_percent: Pourcentage de hauteur du masque (pour mode mask)
             mask_color: "black" ou "white" (pour mode mask)
+            workers: Nombre de processus pour traiter les images (1 = sequentiel)
+            compress_level: Niveau de compression deflate du fichier de sortie (0-9),
+                            les images deja compressees sont stockees telles quelles
+            image_cache: ImageCache pour reutiliser les images deja traitees (None = pas de cache)
+            temp_base: Dossier ou creer le dossier temporaire de ce traitement
+                       (None = dossier temporaire du systeme, ex: /dev/shm en RAM)
+            referenced_only: True pour ne traiter que les images affichees par les notes
+            tags: Ne traiter que les images des notes ayant l'un de ces tags (ou un sous-tag)
+            decks: Ne traiter que les images des notes de ces paquets (ou sous-paquets)
+            fields: Ne traiter que les images de ces champs (ex: ["Answer"])
+                    tags, decks et fields impliquent referenced_only ; sans
+                    aucun des quatre, toutes les images du deck sont traitees
+            png_compress_level: Niveau de compression zlib des PNG reecrits (0-9,
+                                None = defaut de Pillow ; 1 est bien plus rapide)
+            lossless_jpeg: True pour recadrer les JPEG sans perte avec jpegtran
+                           (s'il est installe), sans decoder ni reencoder l'image
+            avif_quality: Qualite des AVIF reencodes (0-100)
+            avif_speed: Vitesse de l'encodeur AVIF (0 = lent et compact, 10 = rapide,
+                        None = defaut du plugin, 6)
+            avif_codec: Encodeur AVIF : "auto", "aom", "rav1e" ou "svt" (cf. avif_encoder_codecs)
+            avif_threads: Threads de l'encodeur AVIF par image (None = defaut du plugin)
+            transcode_avif: "webp" ou "jpeg" pour reencoder les AVIF dans ce format
+                            (beaucoup plus rapide ; le nom du fichier ne change pas,
+                            le navigateur d'Anki reconnait le format au contenu),
+                            None pour garder l'AVIF
+            auto_detect: True pour detecter la mini-carte sur chaque image (NumPy) et
+                         retirer ou masquer exactement sa zone ; crop_percent,
+                         width_percent et height_percent servent quand rien n'est detecte
+            dedup_media: True pour ne garder qu'une copie des medias en double
+                         (cf. deduplicate_media)
+            memory_budget_mb: Memoire maximale pour decoder et traiter une image, en Mo
+                              (par worker) ; les images plus grandes sont laissees
+                              telles quelles (None = pas de limite)
+            max_size: Plus grand cote des images traitees, en pixels : les images plus
+                      grandes sont reduites (les JPEG sont decodes directement en
+                      taille reduite), None pour garder la taille d'origine
         """
         self.input_file = Path(input_file)
         self.mode = mode
@@ -74,7 +252,28 @@ class AnkiImageCropper:
         self.width_percent = width_percent
         self.height_percent = height_percent
         self.mask_color = mask_color
-        self.temp_dir = Path("temp_anki_crop")
+        self.workers = max(1, workers)
+        self.compress_level = compress_level
+        self.image_cache = image_cache
+        self.temp_base = temp_base
+        self.tags = list(tags or [])
+        self.decks = list(decks or [])
+        self.fields = list(fields or [])
+        self.referenced_only = referenced_only or bool(self.tags or self.decks or self.fields)
+        self.png_compress_level = png_compress_level
+        self.jpegtran = shutil.which('jpegtran') if lossless_jpeg else None
+        self.avif_quality = avif_quality
+        self.avif_speed = avif_speed
+        self.avif_codec = avif_codec
+        self.avif_threads = avif_threads
+        self.transcode_avif = transcode_avif
+        self.auto_detect = auto_detect
+        self.dedup_media = dedup_media
+        self.media_dedup = None
+        self.memory_budget_mb = memory_budget_mb
+        self.max_size = max_size
+        self.temp_dir = None
+        self.stats = ProcessStats()
 
         if not self.input_file.exists():
             raise FileNotFoundError(f"Le fichier {input_file} n'existe pas")
@@ -82,177 +281,670 @@ class AnkiImageCropper:
         if not self.input_file.suffix.lower() == '.apkg':
             raise ValueError("Le fichier doit etre un .apkg")
 
-    def extract_apkg(self):
-        """Extrait le contenu du fichier .apkg"""
-        print(f"Extraction de {self.input_file.name}...")
-
-        if self.temp_dir.exists():
-            shutil.rmtree(self.temp_dir)
-        self.temp_dir.mkdir()
+        if self.auto_detect:
+            load_numpy()
 
-        with zipfile.ZipFile(self.input_file, 'r') as zip_ref:
-            zip_ref.extractall(self.temp_dir)
+    def extract_apkg(self):
+        """
+        Prepare le dossier temporaire
 
-        print(f"Extraction terminee dans {self.temp_dir}")
+        Rien n'est extrait : les images sont lues directement dans le .apkg,
+        et seules les images modifiees sont ecrites dans le dossier temporaire.
+        Ce dossier est unique : plusieurs traitements peuvent tourner en
+        meme temps.
+        """
+        print(f"Lecture de {self.input_file.name}...")
+
+        self.temp_dir = Path(tempfile.mkdtemp(prefix="anki_crop_", dir=self.temp_base))
+
+    @property
+    def zip_file(self):
+        """Archive .apkg source, ouverte une seule fois par processus"""
+        if getattr(self, '_zip_file', None) is None:
+            self._zip_file = zipfile.ZipFile(self.input_file, 'r')
+        return self._zip_file
+
+    # Nombre d'octets (decompresses) lus pour reconnaitre le type d'une image
+    HEADER_SIZE = 64
+
+    def __getstate__(self):
+        """Copie pour les workers, sans les contextes zstd ni l'archive ouverte"""
+        state = self.__dict__.copy()
+        state.pop('_dctx', None)
+        state.pop('_cctx', None)
+        state.pop('_zip_file', None)
+        return state
+
+    @property
+    def dctx(self):
+        """Decompresseur zstd, cree une seule fois par processus"""
+        if getattr(self, '_dctx', None) is None:
+            self._dctx = load_zstd().ZstdDecompressor()
+        return self._dctx
+
+    @property
+    def cctx(self):
+        """Compresseur zstd, cree une seule fois par processus"""
+        if getattr(self, '_cctx', None) is None:
+            self._cctx = load_zstd().ZstdCompressor()
+        return self._cctx
 
     def decompress_zstd(self, data):
-        """Decompresse des donnees zstd"""
-        dctx = zstd.ZstdDecompressor()
-        try:
-            return dctx.decompress(data, max_output_size=10*1024*1024)
-        except zstd.ZstdError:
-            reader = dctx.stream_reader(BytesIO(data))
-            result = reader.read()
-            reader.close()
-            return result
+        """
+        Decompresse des donnees zstd
+
+        La taille du resultat est lue dans l'en-tete du flux (une seule
+        allocation) ; si elle n'y est pas, le flux est decompresse par blocs.
+        Pour les images, cf. read_image, qui ne garde pas l'entree compressee.
+        """
+        if load_zstd().frame_content_size(data) >= 0:
+            return self.dctx.decompress(data)
+        with self.dctx.stream_reader(BytesIO(data)) as reader:
+            return reader.read()
 
     def compress_zstd(self, data):
         """Compresse des donnees avec zstd"""
-        cctx = zstd.ZstdCompressor()
-        return cctx.compress(data)
+        return self.cctx.compress(data)
 
     def is_zstd(self, data):
         """Verifie si les donnees sont compressees avec zstd"""
         return data[:4] == b'(\xb5/\xfd' or data[:2] == b'\xb5\xfd'
 
-    def find_media_files(self):
-        """Trouve tous les fichiers media (images) dans le deck"""
-        import json
+    def read_header(self, name):
+        """
+        Lit le debut (decompresse) d'un fichier media, sans lire tout le fichier
+
+        Args:
+            name: Nom de l'entree dans le .apkg
+
+        Returns:
+            Tuple (premiers octets decompresses, True si le fichier est en zstd)
+        """
+        with self.zip_file.open(name) as f:
+            head = f.read(self.HEADER_SIZE)
+            if not self.is_zstd(head):
+                return head, False
+
+            # Decompresser seulement le debut du flux
+            f.seek(0)
+            try:
+                with self.dctx.stream_reader(f, closefd=False) as reader:
+                    chunks = []
+                    size = 0
+                    while size < self.HEADER_SIZE:
+                        chunk = reader.read(self.HEADER_SIZE - size)
+                        if not chunk:
+                            break
+                        chunks.append(chunk)
+                        size += len(chunk)
+                    return b''.join(chunks), True
+            except load_zstd().ZstdError:
+                f.seek(0)
+                return self.decompress_zstd(f.read())[:self.HEADER_SIZE], True
+
+    def detect_image_type(self, data):
+        """
+        Detecte le type d'image a partir des premiers octets
+
+        Returns:
+            'png', 'avif', 'jpeg' ou None
+        """
+        if data[:8] == b'\x89PNG\r\n\x1a\n':
+            return 'png'
+        elif b'ftyp' in data[:32] and (b'avif' in data[:32] or b'avis' in data[:32] or b'mif1' in data[:32]):
+            return 'avif'
+        elif data[:2] == b'\xff\xd8':
+            return 'jpeg'
+        return None
+
+    def selected_media(self):
+        """
+        Entrees de l'archive affichees par les notes selectionnees
+
+        Lit l'index des medias et les balises <img> des champs des notes
+        (filtrees par tag, paquet et nom de champ).
+
+        Returns:
+            Ensemble des noms d'entrees, ou None si aucune selection
+            (toutes les images sont traitees)
+        """
+        if not self.referenced_only:
+            return None
+
+        db_name = find_database(self.zip_file.namelist())
+        if db_name is None:
+            raise FileNotFoundError("Aucune base de donnees trouvee dans le deck")
+
+        conn = read_database(self.zip_file, db_name, self.temp_base)
+        try:
+            filenames = referenced_media(conn, tags=self.tags, decks=self.decks, fields=self.fields)
+        finally:
+            conn.close()
+
+        # Index nom du fichier media -> entree numerotee de l'archive
+        entries = {filename: entry for entry, filename in read_media_map(self.zip_file).items()}
+        selected = {entries[filename] for filename in filenames if filename in entries}
+        print(f"{len(selected)} medias references par les notes selectionnees")
+        return selected
 
+    def find_media_files(self):
+        """Trouve les fichiers media (images) du deck a traiter"""
         images = []
         skip_files = ['media', 'collection.anki2', 'collection.anki21', 'collection.anki21b', 'meta']
 
+        with self.stats.timer('select'):
+            selected = self.selected_media()
+
         print("Scan des fichiers...")
 
-        for file_path in self.temp_dir.iterdir():
-            if file_path.is_file() and file_path.name not in skip_files:
+        for info in self.zip_file.infolist():
+            name = info.filename
+            if selected is not None and name not in selected:
+                continue
+            if not info.is_dir() and name not in skip_files:
                 try:
-                    with open(file_path, 'rb') as f:
-                        data = f.read()
-
-                    # Decompresser si zstd
-                    is_compressed = self.is_zstd(data)
-                    if is_compressed:
-                        data = self.decompress_zstd(data)
+                    # Lire seulement l'en-tete (decompresse si zstd)
+                    header, is_compressed = self.read_header(name)
 
                     # Detecter le type d'image
-                    img_type = None
-                    if data[:8] == b'\x89PNG\r\n\x1a\n':
-                        img_type = 'png'
-                    elif b'ftyp' in data[:32] and (b'avif' in data[:32] or b'avis' in data[:32] or b'mif1' in data[:32]):
-                        img_type = 'avif'
-                    elif data[:2] == b'\xff\xd8':
-                        img_type = 'jpeg'
+                    img_type = self.detect_image_type(header)
 
                     if img_type:
                         images.append({
-                            'id': file_path.name,
-                            'path': file_path,
+                            'id': name,
+                            'path': self.temp_dir / name,
                             'type': img_type,
-                            'compressed': is_compressed
+                            'compressed': is_compressed,
+                            'crc': info.CRC,
+                            'size': info.file_size
                         })
 
+                except RuntimeError:
+                    # Dependance manquante (zstandard) : inutile d'insister
+                    raise
                 except Exception as e:
-                    print(f"  Erreur {file_path.name}: {e}")
+                    print(f"  Erreur {name}: {e}")
 
         print(f"Trouve {len(images)} images")
+
+        # Verifier des maintenant que le support AVIF est disponible
+        if any(image['type'] == 'avif' for image in images):
+            load_avif()
         return images
 
+    def settings(self):
+        """
+        Parametres qui determinent le resultat du traitement d'une image
+
+        Returns:
+            Dictionnaire serialisable en JSON
+        """
+        return {
+            'version': self.CACHE_VERSION,
+            'mode': self.mode,
+            'direction': self.direction,
+            'crop_percent': self.crop_percent,
+            'width_percent': self.width_percent,
+            'height_percent': self.height_percent,
+            'mask_color': self.mask_color,
+            'jpeg_quality': self.JPEG_QUALITY,
+            'avif_quality': self.avif_quality,
+            'avif_speed': self.avif_speed,
+            'avif_codec': self.avif_codec,
+            'transcode_avif': self.transcode_avif,
+            'webp_quality': self.WEBP_QUALITY,
+            'png_compress_level': self.png_compress_level,
+            'jpegtran': self.jpegtran is not None,
+            'auto_detect': self.auto_detect,
+            'max_size': self.max_size,
+        }
+
+    def cache_key(self, name):
+        """
+        Cle de cache d'une image : contenu source + parametres du traitement
+
+        Args:
+            name: Entree du .apkg (contenu compresse ou non), lue par blocs
+        """
+        key = hashlib.blake2b(digest_size=20)
+        key.update(json.dumps(self.settings(), sort_keys=True).encode('utf-8'))
+        with self.zip_file.open(name) as f:
+            for chunk in iter(lambda: f.read(self.READ_CHUNK), b''):
+                key.update(chunk)
+        return key.hexdigest()
+
+    def read_image(self, image_info):
+        """
+        Lit une image de l'archive, decompressee, dans un fichier temporaire
+
+        L'entree est lue et decompressee par blocs : ni l'entree compressee
+        ni une seconde copie de l'image ne restent en memoire. Le fichier
+        reste en memoire jusqu'a SPOOL_SIZE octets, puis passe sur disque.
+
+        Args:
+            image_info: Dict avec 'id' (entree du .apkg) et 'compressed'
+
+        Returns:
+            Fichier positionne au debut, a fermer apres le traitement
+        """
+        target = tempfile.SpooledTemporaryFile(max_size=self.SPOOL_SIZE, dir=self.temp_base)
+        try:
+            with self.zip_file.open(image_info['id']) as entry:
+                if image_info.get('compressed', False):
+                    self.dctx.copy_stream(entry, target, read_size=self.READ_CHUNK)
+                else:
+                    shutil.copyfileobj(entry, target, self.READ_CHUNK)
+        except BaseException:
+            target.close()
+            raise
+        target.seek(0)
+        return target
+
+    def _reduce_factor(self, width, height):
+        """Facteur de reduction entier pour que le plus grand cote tienne dans max_size"""
+        if self.max_size is None or max(width, height) <= self.max_size:
+            return 1
+        return -(-max(width, height) // self.max_size)
+
+    def _fits_memory_budget(self, img):
+        """
+        Verifie qu'une image (ouverte, pas encore decodee) tient dans memory_budget_mb
+
+        Les images trop grandes sont comptees (images_over_budget) et
+        laissees telles quelles : elles ne sont pas en echec (cf. IMAGE_SKIPPED).
+        """
+        if self.memory_budget_mb is None:
+            return True
+        width, height = img.size
+        needed = width * height * self.BYTES_PER_PIXEL
+        if needed <= self.memory_budget_mb * 1024 * 1024:
+            return True
+        print(f"  Image trop grande ({width}x{height}, ~{needed / 1024 / 1024:.0f} Mo "
+              f"> {self.memory_budget_mb} Mo) : laissee telle quelle")
+        self.stats.count('images_over_budget')
+        return False
+
     def process_image(self, image_info):
         """
         Traite une image selon le mode choisi (crop ou mask)
 
         Args:
-            image_info: Dict avec 'path', 'type', 'compressed'
+            image_info: Dict avec 'id' (entree du .apkg), 'path' (fichier de sortie),
+                        'type', 'compressed', 'size'
+
+        Les durees de chaque etape, les tailles avant/apres et le pic de
+        memoire du processus pendant l'image (Linux ; ailleurs, le pic
+        depuis le debut du processus) sont ajoutes a self.stats.
 
         Returns:
-            True si succes, False sinon
+            IMAGE_OK si l'image est traitee, IMAGE_SKIPPED si elle depasse
+            memory_budget_mb (l'original est garde), IMAGE_FAILED en cas d'erreur
         """
+        stats = self.stats
+        start = time.perf_counter()
+        reset_peak_memory()
         try:
             file_path = image_info['path']
             is_compressed = image_info.get('compressed', False)
             img_type = image_info.get('type', 'png')
+            bytes_in = image_info['size']
+
+            # Reprendre l'image du cache si elle a deja ete traitee
+            if self.image_cache is not None:
+                with stats.timer('cache'):
+                    key = self.cache_key(image_info['id'])
+                    cached = self.image_cache.get(key, file_path)
+                if cached:
+                    self._record_image(image_info, bytes_in, file_path.stat().st_size,
+                                       start, cached=True)
+                    return self.IMAGE_OK
+
+            # Lire (et decompresser) le fichier dans le .apkg
+            with stats.timer('read'):
+                source = self.read_image(image_info)
+
+            with source:
+                result_data = self._process_source(source, img_type)
+            if result_data is None:
+                return self.IMAGE_SKIPPED
 
-            # Lire le fichier
-            with open(file_path, 'rb') as f:
-                data = f.read()
-
-            # Decompresser si necessaire
+            # Recompresser si necessaire
             if is_compressed:
-                data = self.decompress_zstd(data)
+                with stats.timer('compress'):
+                    result_data = self.compress_zstd(result_data)
+
+            # Ecrire le fichier modifie (remplacera l'original dans le .apkg)
+            with stats.timer('write'):
+                with open(file_path, 'wb') as f:
+                    f.write(result_data)
 
-            # Ouvrir l'image
-            img = Image.open(BytesIO(data))
-            width, height = img.size
+            if self.image_cache is not None:
+                with stats.timer('cache'):
+                    self.image_cache.put(key, file_path)
+
+            self._record_image(image_info, bytes_in, len(result_data), start)
+            return self.IMAGE_OK
+
+        except Exception as e:
+            print(f"  Erreur: {e}")
+            stats.count('images_failed')
+            return self.IMAGE_FAILED
+
+    def _process_source(self, source, img_type):
+        """
+        Decode, traite et reencode une image
+
+        Args:
+            source: Fichier de l'image decompressee (cf. read_image)
+            img_type: 'png', 'jpeg' ou 'avif'
+
+        Returns:
+            Contenu de l'image traitee (non compresse), ou None si l'image
+            depasse memory_budget_mb
+        """
+        stats = self.stats
+
+        # Ouvrir l'image : seul l'en-tete est lu, le decodage se fait a la demande
+        from PIL import Image
+        if img_type == 'avif':
+            load_avif()
+        img = Image.open(source)
+
+        # Reduction (max_size) : les JPEG sont decodes directement a 1/2, 1/4
+        # ou 1/8 de leur taille (draft), le reste est reduit apres decodage
+        width, height = img.size
+        factor = self._reduce_factor(width, height)
+        if factor > 1 and img_type == 'jpeg':
+            img.draft(img.mode, (-(-width // factor), -(-height // factor)))
+            factor = self._reduce_factor(*img.size)
+        scaled = img.size != (width, height) or factor > 1
+
+        # Les JPEG sont decoupes sur la grille des blocs DCT : jpegtran
+        # recopie les blocs gardes sans perte ; sans lui, l'image est decodee
+        # puis reencodee avec les memes tables (perte reduite, pas nulle)
+        grid = self._jpeg_grid(img) if img_type == 'jpeg' and not scaled else (1, 1)
+
+        # jpegtran recadre sans decoder : pas de limite de memoire
+        lossless = (img_type == 'jpeg' and self.mode == self.MODE_CROP
+                    and self.jpegtran and not scaled)
+        if not lossless and not self._fits_memory_budget(img):
+            return None
+
+        # Zone de la mini-carte, detectee sur une miniature
+        region = None
+        if self.auto_detect:
+            with stats.timer('detect'):
+                region = self._detect_region(img, source, img_type)
+            stats.count('auto_detected' if region is not None else 'auto_fallback')
+
+        if lossless:
+            source.seek(0)
+            with stats.timer('jpegtran'):
+                result_data = self._jpegtran_crop(source.read(), self._crop_box(*img.size, grid, region))
+            if result_data is not None:
+                stats.count('jpeg_lossless')
+                return result_data
+            if not self._fits_memory_budget(img):
+                return None
 
+        with stats.timer('decode'):
+            img.load()
+        result = img
+        if factor > 1:
+            with stats.timer('reduce'):
+                result = img.reduce(factor)
+        if scaled:
+            stats.count('images_reduced')
+        width, height = result.size
+
+        with stats.timer('transform'):
             if self.mode == self.MODE_CROP:
-                result = self._crop_directional(img, width, height)
+                result = self._crop_directional(result, width, height, grid, region)
             else:
-                result = self._mask_corner(img, width, height)
-
-            # Sauvegarder dans le bon format
-            output = BytesIO()
-            if img_type == 'png':
-                result.save(output, 'PNG')
-            elif img_type == 'jpeg':
-                if result.mode in ('RGBA', 'P'):
-                    result = result.convert('RGB')
-                result.save(output, 'JPEG', quality=85)
-            else:  # avif
-                if result.mode in ('RGBA', 'P'):
-                    result = result.convert('RGB')
-                result.save(output, 'AVIF', quality=80)
+                result = self._mask_corner(result, width, height, grid, region, in_place=True)
 
-            # Recompresser si necessaire
-            result_data = output.getvalue()
-            if is_compressed:
-                result_data = self.compress_zstd(result_data)
+        # Sauvegarder dans le bon format
+        with stats.timer('encode'):
+            return self._encode(result, img, img_type)
 
-            # Ecrire le fichier
-            with open(file_path, 'wb') as f:
-                f.write(result_data)
+    def _record_image(self, image_info, bytes_in, bytes_out, start, cached=False):
+        """
+        Ajoute une image traitee aux statistiques (compteurs et detail par image)
 
-            return True
+        Le pic de memoire residente pendant l'image (cf. process_image) est
+        ajoute au detail (peak_rss_mb) et le plus grand est garde.
+        """
+        self.stats.count('images_processed')
+        if cached:
+            self.stats.count('images_from_cache')
+        self.stats.count('bytes_in', bytes_in)
+        self.stats.count('bytes_out', bytes_out)
+        item = {
+            'id': image_info['id'],
+            'type': image_info['type'],
+            'bytes_in': bytes_in,
+            'bytes_out': bytes_out,
+            'seconds': round(time.perf_counter() - start, 6),
+            'cached': cached,
+        }
+        peak = peak_memory()
+        if peak is not None:
+            item['peak_rss_mb'] = round(peak / 1024 / 1024, 1)
+            self.stats.peak('peak_rss_mb', item['peak_rss_mb'])
+        self.stats.items.append(item)
 
-        except Exception as e:
-            print(f"  Erreur: {e}")
-            return False
+    def _encode(self, result, source, img_type):
+        """
+        Encode l'image traitee dans le format d'origine
+
+        Args:
+            result: Image PIL traitee
+            source: Image PIL d'origine (tables de quantification et
+                    sous-echantillonnage des JPEG, reutilises pour limiter
+                    la perte du reencodage)
+            img_type: 'png', 'jpeg' ou 'avif'
 
-    def _crop_directional(self, img, width, height):
+        Returns:
+            Contenu du fichier encode
         """
-        Crop l'image depuis une direction donnee
+        from PIL import JpegImagePlugin
+
+        output = BytesIO()
+        if img_type == 'png':
+            options = {}
+            if self.png_compress_level is not None:
+                options['compress_level'] = self.png_compress_level
+            result.save(output, 'PNG', **options)
+        elif img_type == 'jpeg':
+            if result.mode in ('RGBA', 'P'):
+                result = result.convert('RGB')
+            quantization = getattr(source, 'quantization', None)
+            if quantization and result.mode == source.mode:
+                # Memes tables et meme sous-echantillonnage que l'original :
+                # perte de generation reduite, mais chaque pixel est decode
+                # puis reencode (seul jpegtran recadre sans perte)
+                result.save(output, 'JPEG', qtables=quantization,
+                            subsampling=JpegImagePlugin.get_sampling(source))
+            else:
+                result.save(output, 'JPEG', quality=self.JPEG_QUALITY)
+        else:  # avif
+            if result.mode in ('RGBA', 'P'):
+                result = result.convert('RGB')
+            if self.transcode_avif == self.FORMAT_WEBP:
+                result.save(output, 'WEBP', quality=self.WEBP_QUALITY)
+            elif self.transcode_avif == self.FORMAT_JPEG:
+                result.save(output, 'JPEG', quality=self.JPEG_QUALITY)
+            else:
+                result.save(output, 'AVIF', **self.avif_options())
+        return output.getvalue()
+
+    def avif_options(self):
+        """Options de l'encodeur AVIF (parametres de Image.save)"""
+        options = {'quality': self.avif_quality}
+        if self.avif_speed is not None:
+            options['speed'] = self.avif_speed
+        if self.avif_codec != "auto":
+            options['codec'] = self.avif_codec
+        if self.avif_threads is not None:
+            options['max_threads'] = self.avif_threads
+        return options
+
+    def _jpeg_grid(self, img):
+        """
+        Taille d'un MCU (bloc de base du JPEG, selon le sous-echantillonnage)
+
+        Returns:
+            Tuple (largeur, hauteur) en pixels
+        """
+        layers = getattr(img, 'layer', None)
+        if not layers or len(layers) == 1:
+            return (self.JPEG_BLOCK, self.JPEG_BLOCK)
+        return (self.JPEG_BLOCK * max(layer[1] for layer in layers),
+                self.JPEG_BLOCK * max(layer[2] for layer in layers))
+
+    def _jpegtran_crop(self, data, box):
+        """
+        Recadre un JPEG sans perte avec jpegtran
+
+        Args:
+            data: Contenu du JPEG
+            box: Zone a garder (gauche, haut, droite, bas), alignee sur les MCU
+
+        Returns:
+            Contenu du JPEG recadre, ou None si jpegtran a echoue
+        """
+        import subprocess
+
+        left, top, right, bottom = box
+        geometry = f"{right - left}x{bottom - top}+{left}+{top}"
+        try:
+            return subprocess.run([self.jpegtran, '-copy', 'all', '-crop', geometry],
+                                  input=data, capture_output=True, check=True).stdout
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    @staticmethod
+    def _align(value, step, up=False):
+        """Arrondit value a un multiple de step (inferieur, ou superieur si up)"""
+        if up:
+            return -(-value // step) * step
+        return value // step * step
+
+    def _detect_region(self, img, source, img_type):
+        """
+        Detecte la mini-carte sur une miniature de l'image
+
+        Les JPEG sont decodes directement en taille reduite (draft) ; les
+        autres formats sont decodes puis reduits.
+
+        Args:
+            img: Image PIL ouverte (pas forcement decodee)
+            source: Fichier de l'image (decompresse, cf. read_image)
+            img_type: 'png', 'jpeg' ou 'avif'
+
+        Returns:
+            Mode crop : fraction de l'image a retirer depuis le bord choisi
+            Mode mask : tuple (fraction de la largeur, fraction de la hauteur)
+            None si aucune mini-carte n'est detectee
+        """
+        from PIL import Image
+
+        width, height = img.size
+        factor = max(1, max(width, height) // self.AUTO_THUMB_SIZE)
+        if img_type == 'jpeg':
+            source.seek(0)
+            thumbnail = Image.open(source)
+            thumbnail.draft('RGB', (width // factor, height // factor))
+            thumbnail = thumbnail.convert('RGB')
+        else:
+            img.load()
+            thumbnail = img if img.mode in ('RGB', 'RGBA', 'L') else img.convert('RGB')
+            thumbnail = thumbnail.reduce(factor).convert('RGB')
+
+        pixels = load_numpy().asarray(thumbnail, dtype='float32')
+
+        if self.mode == self.MODE_MASK:
+            found = detect_minimap(pixels, self.direction,
+                                   self.AUTO_MIN_FRACTION, self.AUTO_MAX_FRACTION)
+            return found[:2] if found else None
+
+        # Mode crop : la mini-carte peut etre dans l'un des deux coins du bord retire
+        corners = {
+            self.DIR_RIGHT: (self.CORNER_BOTTOM_RIGHT, self.CORNER_TOP_RIGHT),
+            self.DIR_LEFT: (self.CORNER_BOTTOM_LEFT, self.CORNER_TOP_LEFT),
+            self.DIR_TOP: (self.CORNER_TOP_LEFT, self.CORNER_TOP_RIGHT),
+            self.DIR_BOTTOM: (self.CORNER_BOTTOM_LEFT, self.CORNER_BOTTOM_RIGHT),
+        }[self.direction]
+        found = [detect_minimap(pixels, corner, self.AUTO_MIN_FRACTION, self.AUTO_MAX_FRACTION)
+                 for corner in corners]
+        found = [item for item in found if item]
+        if not found:
+            return None
+        width_fraction, height_fraction, score = max(found, key=lambda item: item[2])
+        return width_fraction if self.direction in (self.DIR_RIGHT, self.DIR_LEFT) else height_fraction
+
+    def _crop_box(self, width, height, grid=(1, 1), region=None):
+        """
+        Zone a garder en mode crop
 
         Args:
-            img: Image PIL
             width: Largeur originale
             height: Hauteur originale
+            grid: Taille des blocs (JPEG) sur lesquels aligner la coupe ; le
+                  bord retire est arrondi au bloc superieur
+            region: Fraction a retirer detectee (cf. _detect_region),
+                    None = crop_percent
 
         Returns:
-            Image croppee
+            Tuple (gauche, haut, droite, bas)
         """
+        grid_x, grid_y = grid
+        percent = self.crop_percent if region is None else 100 * region
+
         if self.direction == self.DIR_RIGHT:
             # Retirer depuis la droite
-            new_width = int(width * (100 - self.crop_percent) / 100)
-            return img.crop((0, 0, new_width, height))
+            new_width = int(width * (100 - percent) / 100)
+            return (0, 0, new_width, height)
 
         elif self.direction == self.DIR_LEFT:
             # Retirer depuis la gauche
-            crop_width = int(width * self.crop_percent / 100)
-            return img.crop((crop_width, 0, width, height))
+            crop_width = int(width * percent / 100)
+            crop_width = min(self._align(crop_width, grid_x, up=True), width - 1)
+            return (crop_width, 0, width, height)
 
         elif self.direction == self.DIR_TOP:
             # Retirer depuis le haut
-            crop_height = int(height * self.crop_percent / 100)
-            return img.crop((0, crop_height, width, height))
+            crop_height = int(height * percent / 100)
+            crop_height = min(self._align(crop_height, grid_y, up=True), height - 1)
+            return (0, crop_height, width, height)
 
         elif self.direction == self.DIR_BOTTOM:
             # Retirer depuis le bas
-            new_height = int(height * (100 - self.crop_percent) / 100)
-            return img.crop((0, 0, width, new_height))
+            new_height = int(height * (100 - percent) / 100)
+            return (0, 0, width, new_height)
 
-        return img
+        return (0, 0, width, height)
 
-    def _mask_corner(self, img, width, height):
+    def _crop_directional(self, img, width, height, grid=(1, 1), region=None):
+        """
+        Crop l'image depuis une direction donnee
+
+        Args:
+            img: Image PIL
+            width: Largeur originale
+            height: Hauteur originale
+            grid: Taille des blocs sur lesquels aligner la coupe (cf. _crop_box)
+            region: Fraction a retirer detectee, None = crop_percent
+
+        Returns:
+            Image croppee
+        """
+        box = self._crop_box(width, height, grid, region)
+        if box == (0, 0, width, height):
+            return img
+        return img.crop(box)
+
+    def _mask_corner(self, img, width, height, grid=(1, 1), region=None, in_place=False):
         """
         Masque un coin de l'image avec une couleur unie
 
@@ -260,6 +952,12 @@ class AnkiImageCropper:
             img: Image PIL
             width: Largeur originale
             height: Hauteur originale
+            grid: Taille des blocs (JPEG) sur lesquels aligner le masque ; le
+                  masque est agrandi jusqu'au bord des blocs qu'il touche
+            region: Tuple (fraction de la largeur, fraction de la hauteur)
+                    detecte, None = width_percent et height_percent
+            in_place: True pour dessiner directement sur img, quand l'originale
+                      ne sert plus (une image en lecture seule est tout de meme copiee)
 
         Returns:
             Image avec le coin masque
@@ -267,11 +965,13 @@ class AnkiImageCropper:
         from PIL import ImageDraw
 
         # Convertir les images en mode palette (P) en RGB/RGBA pour permettre le dessin
+        # (la conversion est deja une copie)
         if img.mode == 'P':
             img = img.convert('RGBA' if 'transparency' in img.info else 'RGB')
+            in_place = True
 
         # Copier l'image pour ne pas modifier l'originale
-        result = img.copy()
+        result = img if in_place else img.copy()
         draw = ImageDraw.Draw(result)
 
         # Determiner la couleur
@@ -280,31 +980,49 @@ class AnkiImageCropper:
             color = color + (255,)
 
         # Calculer les dimensions du masque
-        mask_width = int(width * self.width_percent / 100)
-        mask_height = int(height * self.height_percent / 100)
+        if region is None:
+            mask_width = int(width * self.width_percent / 100)
+            mask_height = int(height * self.height_percent / 100)
+        else:
+            mask_width = int(math.ceil(width * region[0]))
+            mask_height = int(math.ceil(height * region[1]))
+
+        # Limites du masque (bornes incluses), alignees sur les blocs
+        grid_x, grid_y = grid
+        left = self._align(width - mask_width, grid_x)
+        top = self._align(height - mask_height, grid_y)
+        right = self._align(mask_width + 1, grid_x, up=True) - 1
+        bottom = self._align(mask_height + 1, grid_y, up=True) - 1
 
         # Dessiner le rectangle selon le coin choisi
         if self.direction == self.CORNER_TOP_LEFT:
-            draw.rectangle([0, 0, mask_width, mask_height], fill=color)
+            draw.rectangle([0, 0, right, bottom], fill=color)
 
         elif self.direction == self.CORNER_TOP_RIGHT:
-            draw.rectangle([width - mask_width, 0, width, mask_height], fill=color)
+            draw.rectangle([left, 0, width, bottom], fill=color)
 
         elif self.direction == self.CORNER_BOTTOM_LEFT:
-            draw.rectangle([0, height - mask_height, mask_width, height], fill=color)
+            draw.rectangle([0, top, right, height], fill=color)
 
         elif self.direction == self.CORNER_BOTTOM_RIGHT:
-            draw.rectangle([width - mask_width, height - mask_height, width, height], fill=color)
+            draw.rectangle([left, top, width, height], fill=color)
 
         return result
 
-    def process_all_images(self):
-        """Traite toutes les images du deck selon le mode choisi"""
-        images = self.find_media_files()
+    def scan_images(self):
+        """
+        Trouve les images a traiter et annonce le traitement
+
+        Returns:
+            Liste des images (cf. find_media_files)
+        """
+        with self.stats.timer('scan'):
+            images = self.find_media_files()
+        self.stats.count('images_found', len(images))
 
         if not images:
             print("Aucune image a traiter")
-            return 0
+            return images
 
         # Message adapte au mode
         if self.mode == self.MODE_CROP:
@@ -327,19 +1045,218 @@ class AnkiImageCropper:
             color_name = "noir" if self.mask_color == self.COLOR_BLACK else "blanc"
             print(f"\nMasquage coin {corner_name} de {len(images)} images "
                   f"({self.width_percent}% x {self.height_percent}%, {color_name})...")
+        return images
 
-        success_count = 0
-        for i, img_info in enumerate(images, 1):
-            print(f"  [{i}/{len(images)}] {img_info['id']}.{img_info['type']}", end="")
+    def process_all_images(self):
+        """
+        Traite toutes les images du deck selon le mode choisi
 
-            if self.process_image(img_info):
-                print(" - OK")
-                success_count += 1
+        Les images modifiees sont ecrites dans le dossier temporaire (cf.
+        image_replacements) ; process enchaine plutot traitement et
+        ecriture de l'archive (cf. stream_cropped_apkg). Les images ignorees
+        (cf. IMAGE_SKIPPED) n'ont pas de fichier : l'original est garde.
+
+        Returns:
+            Nombre d'images traitees avec succes
+        """
+        images = self.scan_images()
+        if not images:
+            return 0
+
+        # Les doublons (meme contenu sous plusieurs noms) ne sont traites qu'une fois
+        unique_images, duplicates = self._split_duplicates(images)
+
+        if self.workers > 1:
+            success_count = self._process_images_parallel(unique_images)
+        else:
+            success_count = 0
+            for i, img_info in enumerate(unique_images, 1):
+                print(f"  [{i}/{len(unique_images)}] {img_info['id']}.{img_info['type']}", end="")
+
+                result = self.process_image(img_info)
+                if result == self.IMAGE_OK:
+                    success_count += 1
+                print(f" - {self.IMAGE_LABELS[result]}")
+
+        if duplicates:
+            success_count += self._process_duplicates(duplicates)
+
+        self._prune_cache()
+        return success_count
+
+    def _prune_cache(self):
+        """Limite la taille du cache d'images, apres le traitement"""
+        if self.image_cache is not None:
+            removed = self.image_cache.prune()
+            if removed:
+                print(f"  Cache: {removed} ancienne(s) image(s) supprimee(s)")
+
+    def _split_duplicates(self, images):
+        """
+        Separe les images uniques des doublons probables (meme CRC et meme taille)
+
+        Args:
+            images: Liste des images (cf. find_media_files)
+
+        Returns:
+            Tuple (images a traiter, liste de tuples (doublon, image de reference))
+        """
+        unique_images = []
+        duplicates = []
+        first_by_content = {}
+        for img_info in images:
+            content_id = (img_info['crc'], img_info['size'])
+            original = first_by_content.get(content_id)
+            if original is None:
+                first_by_content[content_id] = img_info
+                unique_images.append(img_info)
             else:
-                print(" - ECHEC")
+                duplicates.append((img_info, original))
+        return unique_images, duplicates
+
+    def same_content(self, name, other):
+        """Compare deux entrees de l'archive, par blocs"""
+        with self.zip_file.open(name) as first, self.zip_file.open(other) as second:
+            while True:
+                chunk = first.read(self.READ_CHUNK)
+                if chunk != second.read(self.READ_CHUNK):
+                    return False
+                if not chunk:
+                    return True
+
+    def _process_duplicates(self, duplicates):
+        """
+        Copie le resultat de l'image de reference vers ses doublons
 
+        Le contenu est verifie octet par octet : en cas de collision de CRC,
+        ou si l'image de reference a echoue (ou a ete ignoree), le doublon est
+        traite normalement.
+
+        Args:
+            duplicates: Liste de tuples (doublon, image de reference)
+
+        Returns:
+            Nombre de doublons traites avec succes
+        """
+        print(f"  {len(duplicates)} doublon(s)")
+        success_count = 0
+        for img_info, original in duplicates:
+            same_content = (original['path'].exists() and
+                            self.same_content(img_info['id'], original['id']))
+            if same_content:
+                shutil.copyfile(original['path'], img_info['path'])
+                self.stats.count('duplicates')
+                result = self.IMAGE_OK
+            else:
+                result = self.process_image(img_info)
+
+            if result == self.IMAGE_OK:
+                success_count += 1
+            print(f"  {img_info['id']}.{img_info['type']} (doublon de {original['id']})"
+                  f" - {self.IMAGE_LABELS[result]}")
         return success_count
 
+    def _process_images_parallel(self, images):
+        """
+        Traite les images dans un pool de processus
+
+        Chaque worker recoit une copie du cropper (memes parametres).
+        L'echec d'une image, ou la mort d'un worker, n'arrete pas les autres.
+        Les statistiques de chaque image sont ajoutees a self.stats.
+
+        Args:
+            images: Liste des images (cf. find_media_files)
+
+        Returns:
+            Nombre d'images traitees avec succes
+        """
+        print(f"  {self.workers} processus en parallele")
+
+        from concurrent.futures import ProcessPoolExecutor, as_completed
+
+        counts = dict.fromkeys(self.IMAGE_LABELS, 0)
+        with ProcessPoolExecutor(max_workers=self.workers,
+                                 initializer=_init_worker,
+                                 initargs=(self,)) as executor:
+            futures = {executor.submit(_process_image_in_worker, img_info): img_info
+                       for img_info in images}
+
+            for i, future in enumerate(as_completed(futures), 1):
+                img_info = futures[future]
+                try:
+                    result, stats = future.result()
+                    self.stats.merge(stats)
+                except Exception as e:
+                    print(f"  Erreur: {e}")
+                    self.stats.count('images_failed')
+                    result = self.IMAGE_FAILED
+
+                counts[result] += 1
+                print(f"  [{i}/{len(images)}] {img_info['id']}.{img_info['type']}"
+                      f" - {self.IMAGE_LABELS[result]}")
+
+        self._print_unfinished(counts)
+        return counts[self.IMAGE_OK]
+
+    def _print_unfinished(self, counts):
+        """Affiche le nombre d'images ignorees et en echec (comptes par resultat)"""
+        if counts[self.IMAGE_SKIPPED]:
+            print(f"  {counts[self.IMAGE_SKIPPED]} image(s) ignoree(s) (trop grandes)")
+        if counts[self.IMAGE_FAILED]:
+            print(f"  {counts[self.IMAGE_FAILED]} image(s) en echec")
+
+    def deduplicate_media(self):
+        """
+        Ne garde qu'une copie de chaque media en double (meme contenu sous plusieurs noms)
+
+        Les notes qui affichaient une copie retiree affichent celle qui est
+        gardee (cf. anki_apkg.dedup_media) : la base est lue en memoire,
+        modifiee puis gardee avec les autres changements de l'archive dans
+        self.media_dedup, pour l'ecriture de l'archive. A appeler avant
+        stream_cropped_apkg : les medias retires ne sont pas traites.
+        """
+        print("\nRecherche des medias en double...")
+        db_name = find_database(self.zip_file.namelist())
+        if db_name is None:
+            raise FileNotFoundError("Aucune base de donnees trouvee dans le deck")
+
+        conn = read_database(self.zip_file, db_name, self.temp_base)
+        try:
+            self.media_dedup = dedup_media(self.zip_file, conn)
+            if self.media_dedup is not None:
+                self.media_dedup['replacements'][db_name] = database_bytes(conn, db_name, self.temp_base)
+        finally:
+            conn.close()
+
+        if self.media_dedup is None:
+            print("Aucun media en double")
+            return
+        duplicates = self.media_dedup['duplicates']
+        bytes_saved = self.media_dedup['bytes_saved']
+        self.stats.count('media_duplicates', duplicates)
+        self.stats.count('media_bytes_saved', bytes_saved)
+        print(f"{duplicates} media(s) en double retire(s) ({bytes_saved / 1024 / 1024:.1f} Mo gagnes)")
+
+    def media_replacements(self):
+        """
+        Changements des medias et de la base apres deduplicate_media
+
+        Returns:
+            Tuple (remplacements, renommages) (cf. rewrite_apkg)
+        """
+        if self.media_dedup is None:
+            return {}, None
+        return self.media_dedup['replacements'], self.media_dedup['renames']
+
+    def image_replacements(self):
+        """
+        Images modifiees, pretes a remplacer les originales dans l'archive
+
+        Returns:
+            Dictionnaire {nom de l'entree: chemin du fichier} (cf. rewrite_apkg)
+        """
+        return {file_path.name: file_path for file_path in self.temp_dir.iterdir()}
+
     def create_cropped_apkg(self, output_file=None):
         """Cree un nouveau fichier .apkg avec les images croppees"""
         if output_file is None:
@@ -348,18 +1265,222 @@ class AnkiImageCropper:
         output_path = Path(output_file)
         print(f"\nCreation de {output_path.name}...")
 
-        with zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            for file_path in self.temp_dir.rglob('*'):
-                if file_path.is_file():
-                    arcname = file_path.relative_to(self.temp_dir)
-                    zipf.write(file_path, arcname)
+        # Copier l'archive d'origine en remplacant seulement les images modifiees
+        # (et la base et l'index des medias s'il y avait des doublons)
+        replacements = self.image_replacements()
+        media, renames = self.media_replacements()
+        replacements.update(media)
+        rewrite_apkg(self.input_file, output_path, replacements,
+                     compresslevel=self.compress_level, renames=renames)
 
         print(f"Fichier cree: {output_path.absolute()}")
         return output_path
 
+    def stream_cropped_apkg(self, output_file=None):
+        """
+        Traite les images et ecrit le nouveau .apkg en meme temps
+
+        Les entrees de l'archive source sont parcourues dans l'ordre :
+        chaque image a traiter part aussitot dans le pool (processus, ou un
+        thread sans workers), et le processus principal ecrit la sortie dans
+        le meme ordre, au fur et a mesure. Les autres entrees sont recopiees
+        sans decompression, chaque image des que son traitement est fini
+        (son fichier temporaire est alors supprime). Au plus PIPELINE_DEPTH
+        images par worker sont en cours : lecture, calcul et ecriture se
+        recouvrent, avec une memoire et un dossier temporaire bornes. Le
+        fichier cree est identique a celui de process_all_images suivi de
+        create_cropped_apkg.
+
+        L'ecriture reste dans le processus principal plutot que dans un
+        thread : les workers sont crees par fork, qui n'est pas sur dans un
+        processus a plusieurs threads.
+
+        Args:
+            output_file: Nom du fichier de sortie (optionnel)
+
+        Returns:
+            Chemin du fichier cree, ou None si aucune image n'a ete traitee
+            (et aucun media en double retire)
+        """
+        if output_file is None:
+            output_file = self.input_file.stem + "_cropped.apkg"
+        output_path = Path(output_file)
+
+        media, renames = self.media_replacements()
+        renames = renames or {}
+        # Les medias retires par deduplicate_media ne sont pas traites
+        images = [img_info for img_info in self.scan_images()
+                  if renames.get(img_info['id'], img_info['id']) is not None]
+        to_process = {img_info['id']: img_info for img_info in images}
+        originals = {img_info['id']: original
+                     for img_info, original in self._split_duplicates(images)[1]}
+        # Entrees qui utiliseront le resultat de chaque image (elle-meme et ses doublons)
+        users = {}
+        for original in originals.values():
+            users[original['id']] = users.get(original['id'], 1) + 1
+        if not to_process and not media:
+            return None
+
+        print(f"\nCreation de {output_path.name}...")
+        if self.workers > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            print(f"  {self.workers} processus en parallele")
+            executor = ProcessPoolExecutor(max_workers=self.workers,
+                                           initializer=_init_worker, initargs=(self,))
+            task = _process_image_in_worker
+        else:
+            from concurrent.futures import ThreadPoolExecutor
+            executor = ThreadPoolExecutor(max_workers=1)
+            task = self._process_image_in_thread
+
+        # Archive ecrite a cote de la sortie, renommee a la fin : un fichier
+        # existant n'est remplace que par un resultat complet
+        tmp_path = output_path.with_name(f"{output_path.name}.{os.getpid()}.tmp")
+        progress = {'done': 0, 'total': len(to_process),
+                    **dict.fromkeys(self.IMAGE_LABELS, 0)}
+        try:
+            with zipfile.ZipFile(self.input_file, 'r') as zin, \
+                    open(self.input_file, 'rb') as source, \
+                    zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_DEFLATED) as zout:
+                # Entrees a ecrire, dans l'ordre de la source : (entree, nom
+                # dans la sortie, image ou None, traitement ou None)
+                pending = deque()
+                jobs = {}
+                running = 0
+                for info in zin.infolist():
+                    name = renames.get(info.filename, info.filename)
+                    if name is None:
+                        continue
+                    img_info = to_process.get(info.filename)
+                    job = None
+                    if img_info is not None:
+                        # Les doublons reprennent le resultat de l'image de reference
+                        original = originals.get(img_info['id'])
+                        if original is not None and original['id'] in jobs:
+                            job = jobs[original['id']]
+                            if not self.same_content(img_info['id'], original['id']):
+                                # Meme CRC, contenu different : traitee a part
+                                self._release_job(job)
+                                job = None
+                        if job is None:
+                            job = jobs[img_info['id']] = {
+                                'image': img_info, 'future': executor.submit(task, img_info),
+                                'result': None, 'waiting': users.get(img_info['id'], 1),
+                            }
+                            running += 1
+                    pending.append((info, name, img_info, job))
+
+                    # Ecrire les entrees pretes, en attendant les workers si
+                    # trop d'images sont en cours
+                    while pending and (pending[0][3] is None or pending[0][3]['future'].done()
+                                       or running > self.PIPELINE_DEPTH * self.workers):
+                        running -= self._write_stream_entry(zout, source, pending.popleft(),
+                                                            media, progress)
+
+                while pending:
+                    self._write_stream_entry(zout, source, pending.popleft(), media, progress)
+
+                # Nouvelles entrees (absentes de la source)
+                with self.stats.timer('repack'):
+                    source_names = set(zin.namelist())
+                    for name, replacement in media.items():
+                        if name not in source_names:
+                            write_entry(zout, name, replacement, self.compress_level)
+        except BaseException:
+            executor.shutdown(cancel_futures=True)
+            tmp_path.unlink(missing_ok=True)
+            raise
+        executor.shutdown()
+
+        self._print_unfinished(progress)
+        self._prune_cache()
+
+        if progress[self.IMAGE_OK] == 0 and not media:
+            tmp_path.unlink()
+            return None
+        os.replace(tmp_path, output_path)
+        print(f"Fichier cree: {output_path.absolute()}")
+        return output_path
+
+    def _process_image_in_thread(self, image_info):
+        """Traite une image dans le thread du pipeline (meme retour que dans un worker)"""
+        return self.process_image(image_info), None
+
+    @staticmethod
+    def _release_job(job):
+        """Une entree de moins attend le resultat d'une image ; le dernier supprime le fichier"""
+        job['waiting'] -= 1
+        if job['waiting'] == 0:
+            job['image']['path'].unlink(missing_ok=True)
+
+    def _write_stream_entry(self, zout, source, entry, media, progress):
+        """
+        Ecrit une entree du pipeline dans l'archive de sortie (cf. stream_cropped_apkg)
+
+        Attend si besoin la fin du traitement de l'image. Une image en echec
+        ou ignoree est recopiee telle quelle.
+
+        Args:
+            zout: ZipFile de sortie
+            source: Archive source, ouverte en binaire
+            entry: Tuple (entree source, nom dans la sortie, image ou None,
+                   traitement ou None)
+            media: Remplacements de deduplicate_media (base, index des medias)
+            progress: Compteurs d'avancement, mis a jour
+
+        Returns:
+            1 si le traitement de l'image est termine (premiere entree qui
+            l'utilise), 0 sinon
+        """
+        info, name, img_info, job = entry
+        if job is None:
+            with self.stats.timer('repack'):
+                if info.filename in media:
+                    write_entry(zout, name, media[info.filename], self.compress_level)
+                else:
+                    copy_entry_raw(source, info, zout, name)
+            return 0
+
+        finished = 0
+        if job['result'] is None:
+            with self.stats.timer('wait'):
+                try:
+                    result, stats = job['future'].result()
+                    if stats is not None:
+                        self.stats.merge(stats)
+                except Exception as e:
+                    print(f"  Erreur: {e}")
+                    self.stats.count('images_failed')
+                    result = self.IMAGE_FAILED
+            job['result'] = result
+            finished = 1
+
+        done = job['result'] == self.IMAGE_OK
+        output = job['image']['path']
+        with self.stats.timer('repack'):
+            if done:
+                write_entry(zout, name, output, self.compress_level)
+            else:
+                copy_entry_raw(source, info, zout, name)
+        self._release_job(job)
+
+        progress['done'] += 1
+        progress[job['result']] += 1
+        label = f"{img_info['id']}.{img_info['type']}"
+        if img_info is not job['image']:
+            label += f" (doublon de {job['image']['id']})"
+            if done:
+                self.stats.count('duplicates')
+        print(f"  [{progress['done']}/{progress['total']}] {label}"
+              f" - {self.IMAGE_LABELS[job['result']]}")
+        return finished
+
     def cleanup(self):
-        """Supprime les fichiers temporaires"""
-        if self.temp_dir.exists():
+        """Ferme l'archive source et supprime les fichiers temporaires"""
+        if getattr(self, '_zip_file', None) is not None:
+            self._zip_file.close()
+            self._zip_file = None
+        if self.temp_dir is not None and self.temp_dir.exists():
             shutil.rmtree(self.temp_dir)
         print("Fichiers temporaires supprimes")
 
@@ -367,6 +1488,8 @@ class AnkiImageCropper:
         """
         Processus complet de traitement
 
+        Les durees de chaque etape et les compteurs sont dans self.stats.
+
         Args:
             output_file: Nom du fichier de sortie (optionnel)
 
@@ -374,17 +1497,178 @@ class AnkiImageCropper:
             Chemin vers le fichier traite
         """
         try:
-            self.extract_apkg()
-            processed_count = self.process_all_images()
-
-            if processed_count > 0:
-                output_path = self.create_cropped_apkg(output_file)
-                return output_path
-            else:
+            with self.stats.timer('extract'):
+                self.extract_apkg()
+            # Les doublons retires ne sont ni traites ni ecrits : a chercher avant
+            if self.dedup_media:
+                with self.stats.timer('dedup_media'):
+                    self.deduplicate_media()
+
+            with self.stats.timer('pipeline'):
+                output_path = self.stream_cropped_apkg(output_file)
+            if output_path is None:
                 print("Aucune image traitee, pas de fichier genere")
-                return None
+            return output_path
         finally:
-            self.cleanup()
+            with self.stats.timer('cleanup'):
+                self.cleanup()
+
+
+# Contraste minimal (marche moyenne, en niveaux 0-255) des bords d'une mini-carte detectee
+MINIMAP_MIN_CONTRAST = 12
+
+# Part du meilleur contraste a partir de laquelle un coin candidat est retenu
+MINIMAP_KEEP_RATIO = 0.5
+
+
+def load_numpy():
+    """
+    Importe NumPy a la demande (necessaire seulement pour la detection automatique)
+
+    Returns:
+        Le module numpy
+    """
+    try:
+        import numpy
+    except ImportError:
+        raise RuntimeError("La detection automatique de la mini-carte utilise NumPy : "
+                           "installez-le (pip install numpy)") from None
+    return numpy
+
+
+def detect_minimap(pixels, corner, min_fraction=0.05, max_fraction=0.6):
+    """
+    Cherche le rectangle de la mini-carte dans un coin d'une miniature
+
+    La mini-carte est un rectangle colle au coin : on cherche le coin
+    interieur (x0, y0) dont les deux bords (vertical de y0 jusqu'au bord de
+    l'image, horizontal de x0 jusqu'au bord) forment une marche de couleur
+    nette. Les differences signees sont moyennees le long de chaque bord :
+    le bruit de l'image s'annule, un bord rectiligne reste. Tous les coins
+    candidats sont evalues d'un coup avec des sommes cumulees.
+
+    Args:
+        pixels: Tableau NumPy hauteur x largeur x 3 (float) de la miniature
+        corner: Coin cherche ("top_left", "top_right", "bottom_left", "bottom_right")
+        min_fraction: Taille minimale de la mini-carte, en fraction de l'image
+        max_fraction: Taille maximale de la mini-carte, en fraction de l'image
+
+    Returns:
+        Tuple (fraction de la largeur, fraction de la hauteur, contraste),
+        ou None si aucun bord assez net n'est trouve
+    """
+    np = load_numpy()
+
+    # Ramener le coin cherche en bas a droite
+    if corner.endswith('left'):
+        pixels = pixels[:, ::-1]
+    if corner.startswith('top'):
+        pixels = pixels[::-1]
+    height, width = pixels.shape[:2]
+
+    x_min = max(2, int(width * (1 - max_fraction)))
+    x_max = int(width * (1 - min_fraction))
+    y_min = max(2, int(height * (1 - max_fraction)))
+    y_max = int(height * (1 - min_fraction))
+    if x_min > x_max or y_min > y_max:
+        return None
+
+    # Marches de couleur sur 2 pixels (bords adoucis par la reduction)
+    step_x = pixels[:, 2:] - pixels[:, :-2]
+    step_y = pixels[2:] - pixels[:-2]
+    # Sommes depuis le bas (bords verticaux) et depuis la droite (bords horizontaux)
+    below = np.cumsum(step_x[::-1], axis=0)[::-1]
+    right = np.cumsum(step_y[:, ::-1], axis=1)[:, ::-1]
+
+    ys = np.arange(y_min, y_max + 1)
+    xs = np.arange(x_min, x_max + 1)
+    # Bord vertical entre les colonnes x0 - 1 et x0, de y0 jusqu'en bas
+    vertical = np.linalg.norm(below[ys][:, xs - 1], axis=-1) / (height - ys)[:, None]
+    # Bord horizontal entre les lignes y0 - 1 et y0, de x0 jusqu'a droite
+    horizontal = np.linalg.norm(right[ys - 1][:, xs], axis=-1) / (width - xs)[None, :]
+
+    score = np.minimum(vertical, horizontal)
+    if score.max() < MINIMAP_MIN_CONTRAST:
+        return None
+
+    # Les bords interieurs de la mini-carte (son cadre cote coin, ses routes)
+    # peuvent etre aussi nets que son bord exterieur : parmi les coins assez
+    # nets, garder le plus grand rectangle
+    candidates = score >= max(MINIMAP_MIN_CONTRAST, MINIMAP_KEEP_RATIO * score.max())
+    area = np.where(candidates, (height - ys)[:, None] * (width - xs)[None, :], -1)
+    best_y, best_x = np.unravel_index(np.argmax(area), area.shape)
+    contrast = float(score[best_y, best_x])
+
+    # Un pixel de marge (bord adouci par la reduction)
+    x0, y0 = xs[best_x] - 1, ys[best_y] - 1
+    return (width - x0) / width, (height - y0) / height, contrast
+
+
+# Encodeurs AVIF connus (les disponibles dependent de la compilation du plugin)
+AVIF_CODECS = ['aom', 'rav1e', 'svt']
+
+
+def load_avif():
+    """
+    Active le support AVIF de Pillow a la demande (seulement si le deck contient des AVIF)
+
+    pillow-avif-plugin est prefere s'il est installe (plus d'encodeurs),
+    sinon le support AVIF integre a Pillow (>= 11.2) est utilise.
+
+    Returns:
+        Le module _avif utilise (cf. avif_encoder_codecs)
+    """
+    try:
+        import pillow_avif  # noqa: F401 (enregistre le format AVIF dans Pillow)
+        from pillow_avif import _avif
+    except ImportError:
+        try:
+            from PIL import _avif
+        except ImportError:
+            raise RuntimeError("Ce deck contient des images AVIF : installez le module "
+                               "pillow-avif-plugin (pip install pillow-avif-plugin)") from None
+    return _avif
+
+
+def avif_encoder_codecs():
+    """
+    Encodeurs AVIF disponibles
+
+    Returns:
+        Liste parmi AVIF_CODECS
+    """
+    _avif = load_avif()
+    return [codec for codec in AVIF_CODECS if _avif.encoder_codec_available(codec)]
+
+
+# Choix de --direction selon le mode
+CROP_DIRECTIONS = [AnkiImageCropper.DIR_RIGHT, AnkiImageCropper.DIR_LEFT,
+                   AnkiImageCropper.DIR_TOP, AnkiImageCropper.DIR_BOTTOM]
+MASK_CORNERS = [AnkiImageCropper.CORNER_BOTTOM_RIGHT, AnkiImageCropper.CORNER_BOTTOM_LEFT,
+                AnkiImageCropper.CORNER_TOP_RIGHT, AnkiImageCropper.CORNER_TOP_LEFT]
+
+
+# Cropper du processus courant, quand il sert de worker a process_all_images
+_worker_cropper = None
+
+
+def _init_worker(cropper):
+    """
+    Prepare un worker avec une copie du cropper
+
+    Avec fork, le cropper n'est pas serialise : la copie (cf. __getstate__)
+    evite de lire l'archive ouverte par le processus parent, dont la
+    position de lecture est partagee entre les processus.
+    """
+    global _worker_cropper
+    _worker_cropper = copy.copy(cropper)
+
+
+def _process_image_in_worker(image_info):
+    """Traite une image dans un worker, avec les statistiques de l'image"""
+    _worker_cropper.stats = ProcessStats()
+    result = _worker_cropper.process_image(image_info)
+    return result, _worker_cropper.stats
 
 
 def get_int_input(prompt, default, min_val=1, max_val=90):
@@ -400,18 +1684,128 @@ def get_int_input(prompt, default, min_val=1, max_val=90):
     return value
 
 
-def main():
-    """Fonction principale"""
-    print("=" * 60)
-    print("ANKI IMAGE CROPPER")
-    print("Crop ou masque les images d'un deck Anki")
-    print("=" * 60)
-    print()
-
-    # Demander le fichier
-    input_file = input("Chemin vers le fichier .apkg : ").strip().strip('"').strip("'")
-    print()
-
+def add_crop_arguments(parser):
+    """
+    Ajoute les reglages du traitement des images a un parser argparse
+
+    Cf. crop_options_from_args pour les convertir en parametres du cropper.
+    """
+    group = parser.add_argument_group("traitement des images")
+    group.add_argument('--mode', choices=[AnkiImageCropper.MODE_CROP, AnkiImageCropper.MODE_MASK],
+                       default=AnkiImageCropper.MODE_CROP,
+                       help="crop: recadrer, mask: masquer un coin (defaut: crop)")
+    group.add_argument('--direction', choices=CROP_DIRECTIONS + MASK_CORNERS,
+                       help="Bord a retirer (crop, defaut: right) ou coin a masquer "
+                            "(mask, defaut: bottom_right)")
+    group.add_argument('--percent', type=int, default=35, choices=range(1, 91), metavar='1-90',
+                       help="Pourcentage a retirer en mode crop (defaut: 35)")
+    group.add_argument('--mask-width', type=int, default=35, choices=range(1, 91), metavar='1-90',
+                       help="Largeur du masque en %% (defaut: 35)")
+    group.add_argument('--mask-height', type=int, default=35, choices=range(1, 91), metavar='1-90',
+                       help="Hauteur du masque en %% (defaut: 35)")
+    group.add_argument('--color', choices=[AnkiImageCropper.COLOR_BLACK, AnkiImageCropper.COLOR_WHITE],
+                       default=AnkiImageCropper.COLOR_BLACK,
+                       help="Couleur du masque (defaut: black)")
+    group.add_argument('--auto', dest='auto_detect', action='store_true',
+                       help="Detecter la mini-carte sur chaque image (NumPy requis) ; "
+                            "les pourcentages servent si rien n'est detecte")
+    group.add_argument('--png-compress-level', type=int, choices=range(10), metavar='0-9',
+                       help="Compression des PNG reecrits (defaut: celle de Pillow, 6 ; "
+                            "1 est beaucoup plus rapide, fichiers un peu plus gros)")
+    group.add_argument('--no-lossless-jpeg', dest='lossless_jpeg', action='store_false',
+                       help="Ne pas utiliser jpegtran pour recadrer les JPEG sans perte")
+    group.add_argument('--max-size', type=int, metavar='PX',
+                       help="Reduire les images dont le plus grand cote depasse PX pixels "
+                            "(les JPEG sont decodes directement en taille reduite)")
+    group.add_argument('--memory-budget', type=int, metavar='MO',
+                       help="Memoire maximale pour traiter une image, par worker : les images "
+                            "plus grandes sont laissees telles quelles (defaut: pas de limite)")
+
+    group = parser.add_argument_group("encodage AVIF",
+                                      "L'encodage AVIF est de loin l'etape la plus lente ; "
+                                      "cf. anki_benchmark.py --only encode pour comparer les reglages")
+    group.add_argument('--avif-quality', type=int, default=AnkiImageCropper.AVIF_QUALITY,
+                       choices=range(101), metavar='0-100',
+                       help=f"Qualite des AVIF (defaut: {AnkiImageCropper.AVIF_QUALITY})")
+    group.add_argument('--avif-speed', type=int, choices=range(11), metavar='0-10',
+                       help="Vitesse de l'encodeur (0: lent et compact, 10: rapide ; defaut: 6)")
+    group.add_argument('--avif-codec', choices=['auto'] + AVIF_CODECS, default='auto',
+                       help="Encodeur AVIF (defaut: auto)")
+    group.add_argument('--avif-threads', type=int, metavar='N',
+                       help="Threads de l'encodeur par image (defaut: ceux du plugin)")
+    group.add_argument('--transcode-avif', choices=[AnkiImageCropper.FORMAT_WEBP,
+                                                    AnkiImageCropper.FORMAT_JPEG],
+                       help="Reencoder les AVIF en WebP ou JPEG (bien plus rapide)")
+
+    group = parser.add_argument_group("selection des images",
+                                      "Sans ces options, toutes les images du deck sont traitees")
+    group.add_argument('--referenced-only', action='store_true',
+                       help="Ne traiter que les images affichees par les notes (<img src=...>)")
+    group.add_argument('--tag', action='append', dest='tags', metavar='TAG',
+                       help="Seulement les notes ayant ce tag ou un sous-tag (repetable)")
+    group.add_argument('--deck', action='append', dest='decks', metavar='PAQUET',
+                       help="Seulement les notes de ce paquet ou d'un sous-paquet (repetable)")
+    group.add_argument('--field', action='append', dest='fields', metavar='CHAMP',
+                       help="Seulement les images de ce champ, ex: Answer (repetable)")
+
+
+def crop_options_from_args(args, parser):
+    """
+    Convertit les options de add_crop_arguments en parametres de AnkiImageCropper
+
+    Returns:
+        Dictionnaire (mode, direction, crop_percent, width_percent,
+        height_percent, mask_color, referenced_only, tags, decks, fields,
+        png_compress_level, lossless_jpeg, auto_detect, max_size, memory_budget_mb,
+        avif_quality, avif_speed, avif_codec, avif_threads, transcode_avif)
+    """
+    if args.mode == AnkiImageCropper.MODE_CROP:
+        direction = args.direction or AnkiImageCropper.DIR_RIGHT
+        allowed = CROP_DIRECTIONS
+    else:
+        direction = args.direction or AnkiImageCropper.CORNER_BOTTOM_RIGHT
+        allowed = MASK_CORNERS
+    if direction not in allowed:
+        parser.error(f"--direction {direction} invalide en mode {args.mode} "
+                     f"(choix: {', '.join(allowed)})")
+    if args.avif_codec != 'auto' and args.avif_codec not in avif_encoder_codecs():
+        parser.error(f"--avif-codec {args.avif_codec} non disponible "
+                     f"(disponibles: {', '.join(avif_encoder_codecs()) or 'aucun'})")
+    for option, value in (('--max-size', args.max_size), ('--memory-budget', args.memory_budget)):
+        if value is not None and value < 1:
+            parser.error(f"{option} doit etre positif")
+
+    return {
+        'mode': args.mode,
+        'direction': direction,
+        'crop_percent': args.percent,
+        'width_percent': args.mask_width,
+        'height_percent': args.mask_height,
+        'mask_color': args.color,
+        'referenced_only': args.referenced_only,
+        'tags': args.tags,
+        'decks': args.decks,
+        'fields': args.fields,
+        'png_compress_level': args.png_compress_level,
+        'lossless_jpeg': args.lossless_jpeg,
+        'auto_detect': args.auto_detect,
+        'max_size': args.max_size,
+        'memory_budget_mb': args.memory_budget,
+        'avif_quality': args.avif_quality,
+        'avif_speed': args.avif_speed,
+        'avif_codec': args.avif_codec,
+        'avif_threads': args.avif_threads,
+        'transcode_avif': args.transcode_avif,
+    }
+
+
+def ask_crop_options():
+    """
+    Demande les reglages du traitement a l'utilisateur
+
+    Returns:
+        Dictionnaire de parametres de AnkiImageCropper (cf. crop_options_from_args)
+    """
     # Choix du mode
     print("Mode de traitement:")
     print("  1. Crop (recadrer l'image)")
@@ -441,53 +1835,120 @@ def main():
         crop_percent = get_int_input("Pourcentage a retirer [35] : ", 35)
         print()
 
-        cropper = AnkiImageCropper(
-            input_file,
-            mode=mode,
-            direction=direction,
-            crop_percent=crop_percent
-        )
+        return {'mode': mode, 'direction': direction, 'crop_percent': crop_percent}
+
+    # Options pour le masquage
+    print("Coin a masquer:")
+    print("  1. Bas-droite")
+    print("  2. Bas-gauche")
+    print("  3. Haut-droite")
+    print("  4. Haut-gauche")
+    corner_input = input("Choix [1] : ").strip()
+
+    corners = {
+        "1": AnkiImageCropper.CORNER_BOTTOM_RIGHT,
+        "2": AnkiImageCropper.CORNER_BOTTOM_LEFT,
+        "3": AnkiImageCropper.CORNER_TOP_RIGHT,
+        "4": AnkiImageCropper.CORNER_TOP_LEFT
+    }
+    direction = corners.get(corner_input, AnkiImageCropper.CORNER_BOTTOM_RIGHT)
+    print()
 
-    else:
-        # Options pour le masquage
-        print("Coin a masquer:")
-        print("  1. Bas-droite")
-        print("  2. Bas-gauche")
-        print("  3. Haut-droite")
-        print("  4. Haut-gauche")
-        corner_input = input("Choix [1] : ").strip()
+    width_percent = get_int_input("Largeur du masque en % [35] : ", 35)
+    height_percent = get_int_input("Hauteur du masque en % [35] : ", 35)
+    print()
 
-        corners = {
-            "1": AnkiImageCropper.CORNER_BOTTOM_RIGHT,
-            "2": AnkiImageCropper.CORNER_BOTTOM_LEFT,
-            "3": AnkiImageCropper.CORNER_TOP_RIGHT,
-            "4": AnkiImageCropper.CORNER_TOP_LEFT
-        }
-        direction = corners.get(corner_input, AnkiImageCropper.CORNER_BOTTOM_RIGHT)
-        print()
+    print("Couleur du masque:")
+    print("  1. Noir")
+    print("  2. Blanc")
+    color_input = input("Choix [1] : ").strip()
+    mask_color = AnkiImageCropper.COLOR_WHITE if color_input == "2" else AnkiImageCropper.COLOR_BLACK
+    print()
 
-        width_percent = get_int_input("Largeur du masque en % [35] : ", 35)
-        height_percent = get_int_input("Hauteur du masque en % [35] : ", 35)
-        print()
+    return {
+        'mode': mode,
+        'direction': direction,
+        'width_percent': width_percent,
+        'height_percent': height_percent,
+        'mask_color': mask_color,
+    }
+
+
+def main():
+    """
+    Fonction principale
+
+    Sans fichier en argument, les reglages sont demandes a l'utilisateur ;
+    avec un fichier, ils viennent des options (aucune question posee).
+
+    Returns:
+        Code de sortie (0 = succes, 1 = erreur)
+    """
+    parser = argparse.ArgumentParser(description="Crop ou masque les images d'un deck Anki (.apkg)")
+    parser.add_argument('input_file', nargs='?',
+                        help="Fichier .apkg a traiter (sans fichier, les reglages sont demandes)")
+    parser.add_argument('--output', metavar='FICHIER',
+                        help="Fichier de sortie (defaut: <nom>_cropped.apkg)")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Nombre de processus pour traiter les images (defaut: 1)")
+    parser.add_argument('--compress-level', type=int, default=DEFAULT_COMPRESS_LEVEL,
+                        choices=range(10), metavar='0-9',
+                        help=f"Niveau de compression du fichier de sortie (defaut: {DEFAULT_COMPRESS_LEVEL})")
+    parser.add_argument('--cache', nargs='?', const=str(DEFAULT_CACHE_DIR), metavar='DOSSIER',
+                        help=f"Reutilise les images deja traitees (defaut: {DEFAULT_CACHE_DIR})")
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_SIZE_MB, metavar='MO',
+                        help=f"Taille maximale du cache en Mo (defaut: {DEFAULT_CACHE_SIZE_MB})")
+    parser.add_argument('--temp-dir', metavar='DOSSIER',
+                        help="Dossier des fichiers temporaires (defaut: celui du systeme, "
+                             "ex: /dev/shm pour travailler en RAM)")
+    parser.add_argument('--dedup-media', action='store_true',
+                        help="Ne garde qu'une copie des medias en double (meme contenu "
+                             "sous plusieurs noms) et met a jour les notes qui les affichent")
+    parser.add_argument('--stats', metavar='FICHIER',
+                        help="Ecrit les durees par etape et la taille de chaque image en JSON")
+    parser.add_argument('--profile', metavar='FICHIER',
+                        help="Ecrit un profil cProfile du traitement (ex: profil.prof)")
+    add_crop_arguments(parser)
+    args = parser.parse_args()
+    image_cache = ImageCache(args.cache, args.cache_size) if args.cache else None
+
+    print("=" * 60)
+    print("ANKI IMAGE CROPPER")
+    print("Crop ou masque les images d'un deck Anki")
+    print("=" * 60)
+    print()
 
-        print("Couleur du masque:")
-        print("  1. Noir")
-        print("  2. Blanc")
-        color_input = input("Choix [1] : ").strip()
-        mask_color = AnkiImageCropper.COLOR_WHITE if color_input == "2" else AnkiImageCropper.COLOR_BLACK
+    if args.input_file is None:
+        # Mode interactif : demander le fichier et les reglages
+        input_file = input("Chemin vers le fichier .apkg : ").strip().strip('"').strip("'")
         print()
+        options = ask_crop_options()
+    else:
+        input_file = args.input_file
+        options = crop_options_from_args(args, parser)
 
+    try:
         cropper = AnkiImageCropper(
             input_file,
-            mode=mode,
-            direction=direction,
-            width_percent=width_percent,
-            height_percent=height_percent,
-            mask_color=mask_color
+            workers=args.workers,
+            compress_level=args.compress_level,
+            image_cache=image_cache,
+            temp_base=args.temp_dir,
+            dedup_media=args.dedup_media,
+            **options
         )
 
-    try:
-        output_path = cropper.process()
+        if args.profile:
+            output_path = run_profiled(args.profile, cropper.process, args.output)
+        else:
+            output_path = cropper.process(args.output)
+
+        if args.stats:
+            cropper.stats.write_json(args.stats)
+            print()
+            print(f"Statistiques ({args.stats}) :")
+            for line in cropper.stats.summary():
+                print(line)
 
         print()
         print("=" * 60)
@@ -501,6 +1962,7 @@ def main():
         else:
             print("AUCUNE IMAGE TRAITEE")
             print("=" * 60)
+        return 0
 
     except Exception as e:
         print()
@@ -510,15 +1972,20 @@ def main():
         print(f"Une erreur s'est produite : {e}")
         import traceback
         traceback.print_exc()
+        return 1
 
 
 if __name__ == "__main__":
+    exit_code = 1
     try:
-        main()
+        exit_code = main()
     except Exception as e:
         print(f"\nErreur: {e}")
         import traceback
         traceback.print_exc()
     finally:
-        print()
-        input("Appuyez sur Entree pour fermer...")
+        # Garder la fenetre ouverte seulement en mode interactif (double-clic)
+        if len(sys.argv) == 1 and sys.stdin.isatty():
+            print()
+            input("Appuyez sur Entree pour fermer...")
+    sys.exit(exit_code)
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""
+Statistiques d'execution (durees par etape, compteurs, regles)
+Utilise par anki_deck_cleaner.py et anki_image_cropper.py
+"""
+
+import cProfile
+import json
+import sys
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+
+class ProcessStats:
+    """
+    Durees et compteurs d'un traitement
+
+    - timings : secondes cumulees par etape (extract, clean, encode...)
+    - counters : compteurs (notes modifiees, octets ecrits...)
+    - rules : par regle de nettoyage ou tag, nombre d'essais, de
+      correspondances et temps passe (seulement en mode detaille)
+    - peaks : maximums (ex: pic de memoire d'une image), le plus grand est garde
+    - items : un enregistrement par element traite (ex: chaque image)
+
+    Les durees mesurees dans des workers sont additionnees : en parallele,
+    elles representent du temps processeur, pas du temps ecoule.
+    """
+
+    def __init__(self):
+        self.timings = {}
+        self.counters = {}
+        self.rules = {}
+        self.peaks = {}
+        self.items = []
+
+    @contextmanager
+    def timer(self, name):
+        """Mesure la duree d'un bloc et l'ajoute a l'etape name"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name, seconds):
+        """Ajoute une duree a une etape"""
+        self.timings[name] = self.timings.get(name, 0.0) + seconds
+
+    def count(self, name, value=1):
+        """Incremente un compteur"""
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def peak(self, name, value):
+        """Garde le maximum d'une mesure"""
+        if name not in self.peaks or value > self.peaks[name]:
+            self.peaks[name] = value
+
+    def rule(self, name, seconds=0.0, hits=0, calls=1):
+        """
+        Enregistre un essai de regle
+
+        Args:
+            name: Nom de la regle (ex: 'bloc:header_block', 'tag:chile')
+            seconds: Temps passe dans la regle
+            hits: Nombre de correspondances
+            calls: Nombre d'essais
+        """
+        entry = self.rules.get(name)
+        if entry is None:
+            entry = self.rules[name] = {'calls': 0, 'hits': 0, 'seconds': 0.0}
+        entry['calls'] += calls
+        entry['hits'] += hits
+        entry['seconds'] += seconds
+
+    def merge(self, other):
+        """Ajoute les statistiques d'un autre objet (ex: renvoye par un worker)"""
+        for name, seconds in other.timings.items():
+            self.add_time(name, seconds)
+        for name, value in other.counters.items():
+            self.count(name, value)
+        for name, entry in other.rules.items():
+            self.rule(name, entry['seconds'], entry['hits'], entry['calls'])
+        for name, value in other.peaks.items():
+            self.peak(name, value)
+        self.items.extend(other.items)
+
+    def slowest_rules(self, limit=10):
+        """Regles les plus couteuses, de la plus lente a la plus rapide"""
+        ranked = sorted(self.rules.items(), key=lambda item: item[1]['seconds'], reverse=True)
+        return ranked[:limit]
+
+    def to_dict(self):
+        """Statistiques serialisables en JSON"""
+        return {
+            'timings': {name: round(seconds, 6) for name, seconds in self.timings.items()},
+            'counters': dict(self.counters),
+            'rules': {name: dict(entry, seconds=round(entry['seconds'], 6))
+                      for name, entry in self.rules.items()},
+            'peaks': dict(self.peaks),
+            'items': self.items,
+        }
+
+    def write_json(self, path):
+        """Ecrit les statistiques dans un fichier JSON"""
+        Path(path).write_text(json.dumps(self.to_dict(), indent=2, ensure_ascii=False) + '\n',
+                              encoding='utf-8')
+
+    def summary(self, rules=5):
+        """
+        Resume lisible des statistiques
+
+        Args:
+            rules: Nombre de regles les plus lentes a afficher
+
+        Returns:
+            Liste de lignes
+        """
+        lines = ['  ' + ', '.join(f"{name} {seconds:.3f}s" for name, seconds in self.timings.items())]
+        if self.counters:
+            lines.append('  ' + ', '.join(f"{name} {value}" for name, value in self.counters.items()))
+        if self.peaks:
+            lines.append('  max: ' + ', '.join(f"{name} {value}" for name, value in self.peaks.items()))
+        for name, entry in self.slowest_rules(rules):
+            lines.append(f"  {name}: {entry['seconds']:.3f}s, "
+                         f"{entry['hits']} correspondance(s) / {entry['calls']} essai(s)")
+        return lines
+
+
+def reset_peak_memory():
+    """
+    Remet le pic de memoire residente du processus a sa valeur actuelle
+
+    Possible seulement sous Linux (/proc/self/clear_refs) : ailleurs, le pic
+    mesure par peak_memory est celui depuis le debut du processus.
+
+    Returns:
+        True si le pic a ete remis a zero
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_memory():
+    """
+    Pic de memoire residente du processus (depuis reset_peak_memory sous Linux)
+
+    Returns:
+        Taille en octets, ou None si elle n'est pas disponible
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Octets sous macOS, Ko ailleurs
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def run_profiled(profile_file, func, *args, **kwargs):
+    """
+    Execute une fonction sous cProfile et ecrit le profil
+
+    Le fichier s'ouvre avec pstats ou snakeviz. Seul le processus courant
+    est profile (pas les workers).
+
+    Args:
+        profile_file: Fichier de sortie (.prof)
+        func: Fonction a executer
+
+    Returns:
+        Le resultat de func
+    """
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func, *args, **kwargs)
+    finally:
+        profiler.dump_stats(profile_file)